@@ -1,5 +1,9 @@
 from django.contrib import admin
-from .models import Patient
+from .models import ActionJob, BucketCounter, Patient, PatientTransition, RuleSet
 admin.site.register(Patient)
+admin.site.register(PatientTransition)
+admin.site.register(ActionJob)
+admin.site.register(RuleSet)
+admin.site.register(BucketCounter)
 
 # Register your models here.
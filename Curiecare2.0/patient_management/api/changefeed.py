@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import PatientTransition
+from .rulesets import DISPOSITION_ACTIONS
+
+# Change feed of the bucket transitions made by disposition actions (GET api/changes/
+# as a long poll, GET api/changes/stream/ as Server-Sent Events).
+#
+# A transition's sequence number is its PatientTransition id. Ids are AUTOINCREMENT
+# and SQLite has a single writer, which holds the write lock from BEGIN (transaction
+# mode IMMEDIATE) to COMMIT, so ids become visible in increasing order: a consumer
+# that has read up to sequence N never later finds a transition below N. Consumers
+# keep the last sequence they processed and ask for what follows it.
+#
+# Waiting consumers re-read the table every CHANGE_FEED_POLL_INTERVAL seconds, a seek
+# on the primary key, so transitions written by any process are picked up.
+
+FEED_FIELDS = ['id', 'patient_id', 'from_cohort', 'from_bucket', 'to_cohort', 'to_bucket', 'action',
+               'rule_name', 'rule_version', 'created_at']
+
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_STREAM_SECONDS = 300
+# Seconds without transitions after which a stream sends a comment line, so proxies
+# and clients see the connection is alive
+HEARTBEAT_SECONDS = 15
+# Transitions per page of the long poll and per read of a stream
+PAGE_SIZE = 500
+
+
+def poll_interval() -> float:
+    return getattr(settings, "CHANGE_FEED_POLL_INTERVAL", DEFAULT_POLL_INTERVAL)
+
+
+def stream_seconds() -> float:
+    return getattr(settings, "CHANGE_FEED_STREAM_SECONDS", DEFAULT_STREAM_SECONDS)
+
+
+def feed_row(values: Dict[str, Any]) -> Dict[str, Any]:
+    row = dict(values)
+    row['sequence'] = row.pop('id')
+    row['rule'] = row.pop('rule_name')
+    return row
+
+
+# Up to `limit` transitions with a sequence above `after`, oldest first
+def changes_after(after: int, limit: int = PAGE_SIZE) -> List[Dict[str, Any]]:
+    rows = (PatientTransition.objects.filter(id__gt=after, action__in=DISPOSITION_ACTIONS)
+            .order_by('id').values(*FEED_FIELDS)[:limit])
+    return [feed_row(row) for row in rows]
+
+
+# changes_after, waiting up to `timeout` seconds for a transition when there is none yet
+def wait_for_changes(after: int, limit: int = PAGE_SIZE, timeout: float = 0) -> List[Dict[str, Any]]:
+    deadline = time.monotonic() + timeout
+    while True:
+        rows = changes_after(after, limit)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows
+        time.sleep(min(remaining, poll_interval()))
+
+
+async def await_changes(after: int, limit: int = PAGE_SIZE, timeout: float = 0) -> List[Dict[str, Any]]:
+    deadline = time.monotonic() + timeout
+    while True:
+        rows = await sync_to_async(changes_after)(after, limit)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows
+        await asyncio.sleep(min(remaining, poll_interval()))
+
+
+# An SSE message per transition; the id lets a reconnecting EventSource resume
+# through its Last-Event-ID header
+def sse_messages(rows: List[Dict[str, Any]]) -> str:
+    return "".join(f"id: {row['sequence']}\nevent: transition\ndata: {json.dumps(row, cls=DjangoJSONEncoder)}\n\n"
+                   for row in rows)
+
+
+# Event stream of the transitions after `after` for `duration` seconds; the client
+# then reconnects. stream_changes is served by WSGI servers, astream_changes by ASGI
+# servers (each kind of server would buffer the other's stream to the end).
+def stream_changes(after: int, duration: float) -> Iterator[str]:
+    deadline = time.monotonic() + duration
+    while (remaining := deadline - time.monotonic()) > 0:
+        rows = wait_for_changes(after, timeout=min(remaining, HEARTBEAT_SECONDS))
+        if rows:
+            after = rows[-1]['sequence']
+            yield sse_messages(rows)
+        else:
+            yield ": keepalive\n\n"
+
+
+async def astream_changes(after: int, duration: float) -> AsyncIterator[str]:
+    deadline = time.monotonic() + duration
+    while (remaining := deadline - time.monotonic()) > 0:
+        rows = await await_changes(after, timeout=min(remaining, HEARTBEAT_SECONDS))
+        if rows:
+            after = rows[-1]['sequence']
+            yield sse_messages(rows)
+        else:
+            yield ": keepalive\n\n"
@@ -0,0 +1,91 @@
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .models import BucketCounter, Patient
+
+# Incrementally maintained per-bucket occupancy (BucketCounter rows).
+#
+# Writers collect the (cohort, bucket, active) state of every patient before and
+# after a change into a Counter of deltas and apply it with apply_deltas() inside
+# the transaction that writes the patients, so the counters never disagree with
+# committed patient rows. A bulk write touches one counter row per bucket it
+# changes, not one per patient. rebuild() recounts everything from the Patient table.
+
+BucketKey = Tuple[str, str, bool]
+
+
+def state_key(patient: Patient) -> BucketKey:
+    return (patient.current_cohort, patient.current_actionable_bucket, bool(patient.lead_management_active))
+
+
+# Account for one patient going from state `before` (None: new patient) to `after`
+def track(deltas: Counter, before: Optional[BucketKey], after: Optional[BucketKey]):
+    if before == after:
+        return
+    if before is not None:
+        deltas[before] -= 1
+    if after is not None:
+        deltas[after] += 1
+
+
+# Add the deltas to the counter rows; call inside the transaction of the patient writes
+def apply_deltas(deltas: Counter):
+    for (cohort, bucket, active), delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        counter = BucketCounter.objects.filter(cohort=cohort, bucket=bucket, lead_management_active=active)
+        if counter.update(count=F('count') + delta):
+            continue
+        try:
+            with transaction.atomic():
+                BucketCounter.objects.create(cohort=cohort, bucket=bucket, lead_management_active=active,
+                                             count=delta)
+        except IntegrityError:
+            # Created by a concurrent transaction in the meantime
+            counter.update(count=F('count') + delta)
+
+
+# Counter rows as dicts, optionally for active or ended patients only. With
+# active=None the two flags are summed per bucket.
+def occupancy(active: Optional[bool] = None) -> List[Dict[str, Any]]:
+    counters = BucketCounter.objects.filter(count__gt=0)
+    if active is not None:
+        return list(counters.filter(lead_management_active=active)
+                    .order_by('cohort', 'bucket').values('cohort', 'bucket', 'count'))
+    return list(counters.values('cohort', 'bucket').annotate(count=Sum('count')).order_by('cohort', 'bucket'))
+
+
+def actual_counts() -> Dict[BucketKey, int]:
+    groups = (Patient.objects.values('current_cohort', 'current_actionable_bucket', 'lead_management_active')
+              .annotate(count=Count('id')).order_by())
+    return {(group['current_cohort'], group['current_actionable_bucket'], group['lead_management_active']):
+            group['count'] for group in groups}
+
+
+def stored_counts() -> Dict[BucketKey, int]:
+    return {(counter.cohort, counter.bucket, counter.lead_management_active): counter.count
+            for counter in BucketCounter.objects.all()}
+
+
+# Differences between the counters and a full recount, as (key, stored, actual)
+def drift() -> List[Tuple[BucketKey, int, int]]:
+    with transaction.atomic():
+        stored = stored_counts()
+        actual = actual_counts()
+    return [(key, stored.get(key, 0), actual.get(key, 0)) for key in sorted(set(stored) | set(actual))
+            if stored.get(key, 0) != actual.get(key, 0)]
+
+
+# Replace all counter rows with a recount of the Patient table
+def rebuild() -> List[Tuple[BucketKey, int, int]]:
+    with transaction.atomic():
+        found = drift()
+        BucketCounter.objects.all().delete()
+        BucketCounter.objects.bulk_create([
+            BucketCounter(cohort=cohort, bucket=bucket, lead_management_active=active, count=count)
+            for (cohort, bucket, active), count in actual_counts().items()
+        ])
+    return found
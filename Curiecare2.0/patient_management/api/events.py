@@ -0,0 +1,251 @@
+import atexit
+import collections
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+
+from . import metrics
+
+# Structured event log of what was done to patients: the bucket actions that ran
+# (inline or in the action worker) and the bucket moves that were committed.
+#
+# Events are JSON lines {"ts", "event", "patient_id", ...}. emit() only samples the
+# event and appends it to a bounded queue, without locking or waiting; a writer
+# thread drains the queue and appends to settings.EVENT_LOG_FILE one batch at a
+# time, so encoding and I/O stay off the processing threads. Without a file the
+# lines go to the "api.events" logger (stdout, see settings.LOGGING), and nothing
+# is queued while that logger is silenced. When the queue is full
+# the event is dropped (counted in curiecare_events_total) rather than slowing
+# processing down.
+# Sampling keeps a fixed share of patients, chosen by a hash of the id, so every
+# patient that is logged has a complete trail.
+#
+# read_events() filters a log afterwards (manage.py events).
+
+# Event types
+ACTION = "action"
+TRANSITION = "transition"
+
+# Sampling rates are resolved to this many steps
+SAMPLE_SCALE = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def _sample_threshold(rate: float) -> int:
+    return max(0, min(SAMPLE_SCALE, int(round(rate * SAMPLE_SCALE))))
+
+
+# ISO 8601 UTC timestamps, with the date and time formatted once per second
+class _Timestamps:
+    def __init__(self):
+        self._second = None
+        self._prefix = ''
+
+    def format(self, seconds: float) -> str:
+        second = int(seconds)
+        if second != self._second:
+            self._second = second
+            self._prefix = datetime.datetime.fromtimestamp(second, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+        return f"{self._prefix}.{int((seconds - second) * 1000000):06d}+00:00"
+
+
+class EventLog:
+    def __init__(self, path: Optional[str] = None, queue_size: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 1.0, sampling: Optional[Mapping[str, float]] = None):
+        self.path = str(path) if path else None
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        sampling = dict(sampling or {})
+        self._default_threshold = _sample_threshold(sampling.pop("*", 1.0))
+        self._thresholds = {event: _sample_threshold(rate) for event, rate in sampling.items()}
+        self._init_queue()
+
+    # deque appends and pops are atomic, so emit() takes no lock; the writer is woken
+    # when a batch is full, otherwise it drains the queue every flush_interval
+    def _init_queue(self):
+        self._pending: Deque[Any] = collections.deque()
+        self._wake = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    # Whether emitted events are written anywhere
+    def active(self) -> bool:
+        return self.path is not None or logger.isEnabledFor(logging.INFO)
+
+    # Whether the patient's events of this type are logged
+    def sampled(self, event: str, patient_id: Any) -> bool:
+        threshold = self._thresholds.get(event, self._default_threshold)
+        if threshold >= SAMPLE_SCALE:
+            return True
+        if threshold <= 0:
+            return False
+        return zlib.crc32(str(patient_id).encode('utf-8')) % SAMPLE_SCALE < threshold
+
+    def emit(self, event: str, patient_id: Any, fields: Dict[str, Any]):
+        if not self.sampled(event, patient_id) or not self.active():
+            return
+        pending = self._pending
+        size = len(pending)
+        if size >= self.queue_size:
+            metrics.inc(metrics.EVENTS, (event, "dropped"))
+            return
+        pending.append((time.time(), event, patient_id, fields))
+        if self._writer is None:
+            self._start()
+        elif size + 1 == self.batch_size:
+            self._wake.set()
+
+    # Block until the events emitted so far are written (or the timeout passes)
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        if self._writer is None:
+            return True
+        done = threading.Event()
+        self._pending.append(done)
+        self._wake.set()
+        return done.wait(timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="event-log-writer", daemon=True)
+                self._writer.start()
+
+    # A forked child has the queue but not the writer thread
+    def _after_fork(self):
+        self._init_queue()
+
+    def _run(self):
+        timestamps = _Timestamps()
+        pending = self._pending
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            while pending:
+                batch = []
+                done = []
+                while pending and len(batch) < self.batch_size:
+                    item = pending.popleft()
+                    if isinstance(item, threading.Event):
+                        done.append(item)
+                    else:
+                        batch.append(item)
+                self._write(batch, timestamps)
+                for item in done:
+                    item.set()
+
+    def _write(self, batch: List[Tuple[float, str, Any, Dict[str, Any]]], timestamps: _Timestamps):
+        if not batch:
+            return
+        lines = []
+        counts = collections.Counter()
+        for seconds, event, patient_id, fields in batch:
+            record = {"ts": timestamps.format(seconds), "event": event, "patient_id": patient_id, **fields}
+            lines.append(json.dumps(record, separators=(',', ':'), default=str))
+            counts[event] += 1
+        if self.path is None:
+            for line in lines:
+                logger.info(line)
+            outcome = "written"
+        else:
+            try:
+                # Opened per batch, so a rotated file is picked up
+                with open(self.path, "a", encoding="utf-8") as log_file:
+                    log_file.write("\n".join(lines) + "\n")
+                outcome = "written"
+            except OSError:
+                outcome = "dropped"
+        for event, count in counts.items():
+            metrics.inc(metrics.EVENTS, (event, outcome), count)
+
+
+_log = EventLog()
+
+
+# Install the event log settings.EVENT_LOG_FILE and friends describe, or one with
+# the given overrides (path=None writes to the logger); returns it
+def configure(**overrides) -> EventLog:
+    global _log
+    _log.flush(timeout=5)
+    options = {
+        "path": getattr(settings, "EVENT_LOG_FILE", None),
+        "queue_size": getattr(settings, "EVENT_LOG_QUEUE_SIZE", 10000),
+        "batch_size": getattr(settings, "EVENT_LOG_BATCH_SIZE", 500),
+        "flush_interval": getattr(settings, "EVENT_LOG_FLUSH_INTERVAL", 1.0),
+        "sampling": getattr(settings, "EVENT_LOG_SAMPLING", None),
+    }
+    options.update(overrides)
+    _log = EventLog(**options)
+    return _log
+
+
+def enabled() -> bool:
+    return _log.active()
+
+
+def emit(event: str, patient_id: Any, **fields):
+    _log.emit(event, patient_id, fields)
+
+
+# Emit (patient_id, fields) events once the current transaction commits, so rolled
+# back or retried work is never logged
+def emit_on_commit(event: str, items: Iterable[Tuple[Any, Dict[str, Any]]]):
+    log = _log
+    if not log.active():
+        return
+    items = list(items)
+    transaction.on_commit(lambda: [log.emit(event, patient_id, fields) for patient_id, fields in items])
+
+
+def flush(timeout: Optional[float] = None) -> bool:
+    return _log.flush(timeout)
+
+
+def _flush_at_exit():
+    flush(timeout=5)
+
+
+def _after_fork():
+    _log._after_fork()
+
+
+# Events of a log file matching every given filter, oldest first. Lines that are not
+# events (a partly written last line) are skipped.
+def read_events(path: str, patient_id: Optional[str] = None, event: Optional[str] = None,
+                action: Optional[str] = None, since: Optional[datetime.datetime] = None,
+                until: Optional[datetime.datetime] = None) -> Iterator[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as log_file:
+        for line in log_file:
+            # Cheap substring test before decoding the line
+            if patient_id is not None and patient_id not in line:
+                continue
+            try:
+                record = json.loads(line)
+                ts = datetime.datetime.fromisoformat(record["ts"])
+            except (ValueError, KeyError, TypeError):
+                continue
+            if patient_id is not None and str(record.get("patient_id")) != patient_id:
+                continue
+            if event is not None and record.get("event") != event:
+                continue
+            if action is not None and record.get("action") != action:
+                continue
+            if since is not None and ts < since:
+                continue
+            if until is not None and ts >= until:
+                continue
+            yield record
+
+
+configure()
+atexit.register(_flush_at_exit)
+os.register_at_fork(after_in_child=_after_fork)
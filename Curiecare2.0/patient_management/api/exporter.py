@@ -0,0 +1,167 @@
+import base64
+import binascii
+import csv
+import datetime
+import json
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_datetime
+
+from .importer import CSV, NDJSON, csv_value
+from .models import Patient, PatientTransition
+
+# Streaming exports of patients and transitions (GET api/export/..., manage.py export_patients).
+#
+# Rows are read one keyset page at a time rather than through one long-lived
+# QuerySet.iterator(): SQLite holds its read lock for as long as a cursor is open,
+# which for a large export would block writers for the whole download. Memory stays
+# bounded by the page size either way.
+#
+# An export covers the rows up to the newest one when it starts and returns a cursor
+# for that position; passing it to the next export returns only what was written
+# after it. Patients are ordered by (updated_at, id), transitions by id.
+
+EXPORT_CHUNK_SIZE = 2000
+
+PATIENT_EXPORT_FIELDS = [field.name for field in Patient._meta.concrete_fields]
+TRANSITION_EXPORT_FIELDS = [field.attname for field in PatientTransition._meta.concrete_fields]
+
+
+class Export(NamedTuple):
+    fields: List[str]
+    rows: Iterator[Dict[str, Any]]
+    cursor: Optional[str]   # position of the last row, for the next incremental export
+
+
+def encode_cursor(key: List[Any]) -> str:
+    raw = json.dumps(key).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+# Raises ValueError on a malformed cursor
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError, binascii.Error) as exc:
+        raise ValueError("Invalid cursor") from exc
+    if not isinstance(key, list) or len(key) != size:
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def _patient_key(cursor: str):
+    updated_at, patient_id = decode_cursor(cursor, 2)
+    updated_at = parse_datetime(updated_at) if isinstance(updated_at, str) else None
+    if updated_at is None:
+        raise ValueError("Invalid cursor")
+    return updated_at, str(patient_id)
+
+
+# Patients updated at or after `since` and after `cursor`, up to the newest row now
+def export_patients(since: Optional[datetime.datetime] = None, cursor: Optional[str] = None,
+                    chunk_size: int = EXPORT_CHUNK_SIZE) -> Export:
+    after = _patient_key(cursor) if cursor else None
+    patients = Patient.objects.all()
+    if since is not None:
+        patients = patients.filter(updated_at__gte=since)
+    end = patients.order_by('-updated_at', '-id').values_list('updated_at', 'id').first()
+    if end is None or (after is not None and end <= after):
+        return Export(PATIENT_EXPORT_FIELDS, iter(()), cursor)
+    return Export(PATIENT_EXPORT_FIELDS, _patient_pages(patients, after, end, chunk_size),
+                  encode_cursor([end[0].isoformat(), end[1]]))
+
+
+# Same two index seeks per page as services.due_chunk: the rest of the last row's
+# updated_at tie group, then the later timestamps
+def _patient_pages(patients, after, end, chunk_size: int) -> Iterator[Dict[str, Any]]:
+    patients = patients.filter(updated_at__lte=end[0]).order_by('updated_at', 'id').values(*PATIENT_EXPORT_FIELDS)
+    while True:
+        if after is None:
+            rows = list(patients[:chunk_size])
+        else:
+            updated_at, last_id = after
+            rows = list(patients.filter(updated_at=updated_at, id__gt=last_id)[:chunk_size])
+            if len(rows) < chunk_size:
+                rows.extend(patients.filter(updated_at__gt=updated_at)[:chunk_size - len(rows)])
+        # Rows written with the end timestamp after the export started
+        rows = [row for row in rows if (row['updated_at'], row['id']) <= end]
+        if not rows:
+            return
+        yield from rows
+        after = (rows[-1]['updated_at'], rows[-1]['id'])
+
+
+# Transitions recorded at or after `since` and after `cursor`, up to the newest row now
+def export_transitions(since: Optional[datetime.datetime] = None, cursor: Optional[str] = None,
+                       chunk_size: int = EXPORT_CHUNK_SIZE) -> Export:
+    after = decode_cursor(cursor, 1)[0] if cursor else 0
+    if not isinstance(after, int):
+        raise ValueError("Invalid cursor")
+    transitions = PatientTransition.objects.all()
+    if since is not None:
+        transitions = transitions.filter(created_at__gte=since)
+    end = transitions.order_by('-id').values_list('id', flat=True).first()
+    if end is None or end <= after:
+        return Export(TRANSITION_EXPORT_FIELDS, iter(()), cursor)
+    return Export(TRANSITION_EXPORT_FIELDS, _transition_pages(transitions, after, end, chunk_size),
+                  encode_cursor([end]))
+
+
+def _transition_pages(transitions, after: int, end: int, chunk_size: int) -> Iterator[Dict[str, Any]]:
+    transitions = transitions.filter(id__lte=end).order_by('id').values(*TRANSITION_EXPORT_FIELDS)
+    while True:
+        rows = list(transitions.filter(id__gt=after)[:chunk_size])
+        if not rows:
+            return
+        yield from rows
+        after = rows[-1]['id']
+
+
+def ndjson_lines(rows: Iterator[Dict[str, Any]]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+
+
+# First characters a JSON document can start with; other strings never parse as one
+JSON_START = frozenset('-0123456789tfn"[{ \t\r\n')
+
+
+# Inverse of importer.csv_value: strings that would read back as another JSON value
+# are quoted, so an exported CSV imports unchanged
+def csv_cell(value: Any) -> str:
+    if value is None:
+        return ''
+    if type(value) is str:
+        if not value or value[0] not in JSON_START or isinstance(csv_value(value), str):
+            return value
+        return json.dumps(value)
+    if type(value) is bool:
+        return 'true' if value else 'false'
+    if type(value) is int:
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return json.dumps(value, cls=DjangoJSONEncoder)
+
+
+# csv.writer needs a file; this one hands each formatted line back instead of storing it
+class _Echo:
+    def write(self, value: str) -> str:
+        return value
+
+
+def csv_lines(rows: Iterator[Dict[str, Any]], fields: List[str]) -> Iterator[str]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([csv_cell(row[field]) for field in fields])
+
+
+def export_lines(export: Export, file_format: str) -> Iterator[str]:
+    if file_format == CSV:
+        return csv_lines(export.rows, export.fields)
+    return ndjson_lines(export.rows)
+
+
+CONTENT_TYPES = {CSV: "text/csv; charset=utf-8", NDJSON: "application/x-ndjson"}
@@ -0,0 +1,132 @@
+import csv
+import datetime
+import json
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+from rest_framework.exceptions import ValidationError
+
+from .models import Patient
+from .rules import EvaluationContext
+from .rulesets import Rules
+from .services import (
+    evaluate_patient, merge_stored_state, posted_record, processed_fields, result_steps, retry_on_conflict,
+    upsert_patients,
+)
+from .validation import patient_validator
+
+# Streaming patient import (manage.py import_patients).
+#
+# Records are read one line at a time, so memory is bounded by the batch size, and
+# the file position after a committed batch is a checkpoint the import can resume
+# from after a failure.
+
+CSV = "csv"
+NDJSON = "ndjson"
+FORMATS = (CSV, NDJSON)
+
+
+def detect_format(path: str) -> str:
+    return CSV if path.lower().endswith(".csv") else NDJSON
+
+
+def _lines(stream: TextIO) -> Iterator[str]:
+    # readline() rather than iteration keeps stream.tell() usable
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        yield line
+
+
+# CSV cells are JSON values where they parse as one (true, 3, null), strings otherwise;
+# empty cells are left out so they fall back to the model defaults
+def csv_value(cell: str) -> Any:
+    try:
+        return json.loads(cell)
+    except ValueError:
+        return cell
+
+
+# Records of the stream from `position` (a stream.tell() value) on; a record that
+# cannot be parsed is yielded as None. Lines are only read as records are consumed,
+# so stream.tell() between two records is where the next one starts.
+def read_records(stream: TextIO, file_format: str, position: Optional[int] = None
+                 ) -> Iterator[Optional[Dict[str, Any]]]:
+    if file_format == CSV:
+        header = next(csv.reader([stream.readline()]), None)
+        if not header:
+            return
+        if position is not None:
+            stream.seek(position)
+        for row in csv.reader(_lines(stream)):
+            if not any(row):
+                continue
+            if len(row) != len(header):
+                yield None
+                continue
+            yield {key: csv_value(cell) for key, cell in zip(header, row) if cell != ''}
+        return
+
+    if position is not None:
+        stream.seek(position)
+    for line in _lines(stream):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield record if isinstance(record, dict) else None
+
+
+# Validate and upsert one batch of records in one transaction. With process, the
+# rule engine runs on every record first (chained with `chain`) and its transitions
+# are recorded; the bucket actions it produces are only enqueued with
+# enqueue_actions. Returns (imported, errors), errors as (index in batch, detail).
+def import_batch(records: List[Optional[Dict[str, Any]]], as_of: datetime.date, rules: Rules,
+                 process: bool = False, chain: bool = False,
+                 enqueue_actions: bool = False) -> Tuple[int, List[Tuple[int, Any]]]:
+    errors = []
+    valid = []
+    for index, record in enumerate(records):
+        if record is None:
+            errors.append((index, {"non_field_errors": ["Malformed record."]}))
+            continue
+        try:
+            valid.append((record, patient_validator.validate(record)))
+        except ValidationError as exc:
+            errors.append((index, exc.detail))
+
+    # A later record of a patient supersedes an earlier one of the same batch
+    latest = {}
+    for record, validated in valid:
+        latest[validated["id"]] = (record, validated)
+    valid = list(latest.values())
+
+    # Read, evaluate and write; repeated from a fresh read if a patient is written concurrently
+    context = EvaluationContext(as_of)
+
+    def attempt():
+        existing = Patient.objects.in_bulk([validated["id"] for _, validated in valid])
+        rows = []
+        results = []
+        for record, validated in valid:
+            record = posted_record(record, validated)
+            row = dict(validated)
+            if process:
+                merge_stored_state(record, existing.get(row["id"]))
+                result = evaluate_patient(record, rules, chain, context=context)
+                if not enqueue_actions:
+                    for step in result_steps([result]):
+                        step.pop("actions", None)
+                results.append(result)
+            fields = processed_fields(record, row, as_of, rules)
+            if not process:
+                # Imported as-is, not evaluated by any rule version
+                del fields["rule_version"]
+            row.update(fields)
+            rows.append(row)
+        upsert_patients(rows, results, existing)
+        return len(rows)
+
+    return retry_on_conflict(attempt), errors
@@ -0,0 +1,42 @@
+import json
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.events import read_events
+from api.management.commands.export_patients import aware_datetime
+
+
+class Command(BaseCommand):
+    help = "Print the event log entries (actions run, bucket moves) matching the given filters."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", help="Event log to read, defaults to settings.EVENT_LOG_FILE.")
+        parser.add_argument("--patient", help="Only events of this patient id.")
+        parser.add_argument("--event", help="Only events of this type (action, transition).")
+        parser.add_argument("--action", help="Only events of this action.")
+        parser.add_argument("--since", type=aware_datetime, default=None,
+                            help="Only events at or after this ISO 8601 datetime.")
+        parser.add_argument("--until", type=aware_datetime, default=None,
+                            help="Only events before this ISO 8601 datetime.")
+        parser.add_argument("--summary", action="store_true",
+                            help="Print the number of matching events per type, action and outcome instead.")
+
+    def handle(self, *args, **options):
+        path = options["file"] or settings.EVENT_LOG_FILE
+        if not path:
+            raise CommandError("No event log: pass --file or set EVENT_LOG_FILE.")
+        matching = read_events(path, patient_id=options["patient"], event=options["event"],
+                               action=options["action"], since=options["since"], until=options["until"])
+        try:
+            if options["summary"]:
+                counts = Counter((event["event"], event.get("action", ""), event.get("outcome", ""))
+                                 for event in matching)
+                for (event, action, outcome), count in sorted(counts.items()):
+                    self.stdout.write(f"{count:>8}  {event} {action} {outcome}".rstrip())
+            else:
+                for event in matching:
+                    self.stdout.write(json.dumps(event))
+        except OSError as exc:
+            raise CommandError(str(exc))
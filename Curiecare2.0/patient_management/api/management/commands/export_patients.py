@@ -0,0 +1,51 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.exporter import export_lines, export_patients, export_transitions
+from api.importer import FORMATS, NDJSON, detect_format
+
+
+def aware_datetime(value):
+    parsed = datetime.datetime.fromisoformat(value)
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+class Command(BaseCommand):
+    help = ("Stream patients (or their transition history) to an NDJSON or CSV file, optionally only "
+            "the rows written since a timestamp or since the cursor of a previous export.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="File to write, defaults to standard output.")
+        parser.add_argument("--format", choices=FORMATS,
+                            help="File format, by default from the --output extension (NDJSON on stdout).")
+        parser.add_argument("--transitions", action="store_true", help="Export transition history instead.")
+        parser.add_argument("--since", type=aware_datetime, default=None,
+                            help="Only rows written at or after this ISO 8601 datetime.")
+        parser.add_argument("--cursor", help="Only rows written after the cursor printed by a previous export.")
+
+    def handle(self, *args, **options):
+        output = options["output"]
+        file_format = options["format"] or (detect_format(output) if output else NDJSON)
+        export = export_transitions if options["transitions"] else export_patients
+        try:
+            result = export(options["since"], options["cursor"])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        rows = 0
+        stream = open(output, "w", encoding="utf-8", newline="") if output else None
+        try:
+            for line in export_lines(result, file_format):
+                if stream:
+                    stream.write(line)
+                else:
+                    self.stdout.write(line, ending="")
+                rows += 1
+        finally:
+            if stream:
+                stream.close()
+        if file_format != NDJSON:
+            rows -= 1  # header row
+        self.stderr.write(f"Exported {max(rows, 0)} rows. Next cursor: {result.cursor or '(none)'}")
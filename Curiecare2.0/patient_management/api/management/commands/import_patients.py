@@ -0,0 +1,106 @@
+import contextlib
+import datetime
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.importer import FORMATS, detect_format, import_batch, read_records
+from api.rulesets import current_rules
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = ("Import patients from a CSV (header row of field names) or NDJSON file in batches, "
+            "resuming from the last committed batch after a failure.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=FORMATS, help="File format, by default from the file extension.")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Records validated and upserted per transaction.")
+        parser.add_argument("--process", action="store_true",
+                            help="Run the rule engine on every record and record its transitions.")
+        parser.add_argument("--chain", action="store_true", help="With --process, follow moves until stable.")
+        parser.add_argument("--enqueue-actions", action="store_true",
+                            help="With --process, enqueue the bucket actions (off for historical backfills).")
+        parser.add_argument("--as-of", type=datetime.date.fromisoformat, default=None,
+                            help="Date the day counts are relative to (YYYY-MM-DD), defaults to today.")
+        parser.add_argument("--checkpoint", help="Checkpoint file, defaults to PATH.checkpoint.")
+        parser.add_argument("--errors", help="NDJSON file rejected records are appended to, defaults to PATH.errors.")
+        parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or detect_format(path)
+        checkpoint_path = options["checkpoint"] or f"{path}.checkpoint"
+        errors_path = options["errors"] or f"{path}.errors"
+        as_of = options["as_of"] or datetime.date.today()
+        batch_size = max(1, options["batch_size"])
+
+        try:
+            size = os.path.getsize(path)
+        except OSError as exc:
+            raise CommandError(str(exc))
+        state = {"path": os.path.abspath(path), "size": size, "position": None,
+                 "records": 0, "imported": 0, "errors": 0}
+        if not options["restart"] and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as checkpoint_file:
+                saved = json.load(checkpoint_file)
+            if (saved.get("path"), saved.get("size")) != (state["path"], size):
+                raise CommandError(f"{checkpoint_path} belongs to another file; use --restart to start over.")
+            state = saved
+            self.stdout.write(f"Resuming after record {state['records']}.")
+
+        started = time.monotonic()
+        resumed_from = state["records"]
+        errors_file = None
+        # The errors file is opened at the first rejected record and closed however the import ends
+        with contextlib.ExitStack() as stack:
+            stream = stack.enter_context(open(path, encoding="utf-8-sig", newline=""))
+            records = read_records(stream, file_format, state["position"])
+            while True:
+                batch = [record for _, record in zip(range(batch_size), records)]
+                if not batch:
+                    break
+                # Rules are looked up per batch so a newly activated version is picked up
+                imported, errors = import_batch(batch, as_of, current_rules(), options["process"],
+                                                options["chain"], options["enqueue_actions"])
+                if errors and errors_file is None:
+                    errors_file = stack.enter_context(open(errors_path, "a"))
+                for index, detail in errors:
+                    record = batch[index]
+                    errors_file.write(json.dumps({
+                        "record": state["records"] + index + 1,
+                        "id": record.get("id") if record else None,
+                        "errors": detail,
+                    }) + "\n")
+                if errors:
+                    errors_file.flush()
+
+                state["position"] = stream.tell()
+                state["records"] += len(batch)
+                state["imported"] += imported
+                state["errors"] += len(errors)
+                self.save_checkpoint(checkpoint_path, state)
+
+                elapsed = time.monotonic() - started
+                rate = (state["records"] - resumed_from) / elapsed if elapsed else 0
+                self.stdout.write(
+                    f"{state['records']} records ({state['imported']} imported, {state['errors']} rejected), "
+                    f"{state['position'] / size:.0%} of the file, {rate:.0f} records/s"
+                )
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write(f"Imported {state['imported']} patients, rejected {state['errors']} records"
+                          f"{f' (see {errors_path})' if state['errors'] else ''}.")
+
+    # Written to a temporary file first, so a crash never leaves a truncated checkpoint
+    def save_checkpoint(self, checkpoint_path, state):
+        temporary = f"{checkpoint_path}.tmp"
+        with open(temporary, "w") as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(temporary, checkpoint_path)
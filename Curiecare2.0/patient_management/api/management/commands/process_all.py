@@ -0,0 +1,45 @@
+import datetime
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.reevaluation import process_all
+from api.services import BULK_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Re-evaluate every active patient, sharded by id range across worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Worker processes (default: one per CPU); 1 runs in this process.")
+        parser.add_argument("--as-of", type=datetime.date.fromisoformat, default=None,
+                            help="Evaluate as of this date (YYYY-MM-DD), defaults to today.")
+        parser.add_argument("--chunk-size", type=int, default=BULK_BATCH_SIZE,
+                            help="Patients read and written per chunk.")
+        parser.add_argument("--chain", action="store_true",
+                            help="Follow each patient's moves until no rule fires any more.")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1.")
+        as_of = options["as_of"] or datetime.date.today()
+        started = time.monotonic()
+
+        def progress(stats, done, total):
+            self.stdout.write(f"[{done}/{total}] {stats['processed']} patients processed "
+                              f"in {time.monotonic() - started:.2f}s")
+
+        stats = process_all(as_of, options["workers"], options["chunk_size"], chain=options["chain"],
+                            progress=progress)
+        elapsed = time.monotonic() - started
+        rate = stats["processed"] / elapsed if elapsed else 0
+        self.stdout.write(
+            f"Processed {stats['processed']} active patients as of {as_of} with {options['workers']} worker(s): "
+            f"{stats['moved']} moved, {stats['ended']} ended lead management in {elapsed:.2f}s "
+            f"({rate:.0f} patients/s)."
+        )
+        if stats["conflicts"]:
+            self.stdout.write(f"{stats['conflicts']} patients kept changing concurrently and were left "
+                              f"for the next run.")
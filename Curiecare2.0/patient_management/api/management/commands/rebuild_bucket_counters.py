@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from api import counters
+
+
+class Command(BaseCommand):
+    help = "Recount patients per bucket and replace the materialized bucket counters."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true",
+                            help="Only report counters that differ from a recount; exit with status 1 if any do.")
+
+    def handle(self, *args, **options):
+        found = counters.drift() if options["check"] else counters.rebuild()
+        for (cohort, bucket, active), stored, actual in found:
+            state = "active" if active else "ended"
+            self.stdout.write(f"{cohort}.{bucket} ({state}): counter {stored}, actual {actual}")
+        if options["check"]:
+            self.stdout.write(f"{len(found)} counter(s) out of date.")
+            if found:
+                raise SystemExit(1)
+        else:
+            self.stdout.write(f"Rebuilt bucket counters, {len(found)} corrected.")
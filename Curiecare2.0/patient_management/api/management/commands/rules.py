@@ -0,0 +1,79 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import RuleSet
+from api.rule_analysis import rule_findings
+from api.rules import get_compiled
+from api.rulesets import BUILTIN_VERSION, activate_version, build_rules, builtin_document, create_ruleset, load_version
+
+
+class Command(BaseCommand):
+    help = "List, export, import and activate versioned rule sets."
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest="subcommand", required=True)
+        subcommands.add_parser("list", help="List stored rule set versions.")
+        export = subcommands.add_parser("export", help="Print a rule document as JSON.")
+        export.add_argument("version", type=int, nargs="?", default=BUILTIN_VERSION,
+                            help="Version to export, 0 (the default) is the built-in rules.")
+        load = subcommands.add_parser("import", help="Store a JSON rule document as the next version.")
+        load.add_argument("path")
+        load.add_argument("--description", default="")
+        load.add_argument("--activate", action="store_true", help="Make the new version active.")
+        activate = subcommands.add_parser("activate", help="Make a stored version active (0: built-in rules).")
+        activate.add_argument("version", type=int)
+        check = subcommands.add_parser("check", help="Report unreachable and shadowed disposition rules.")
+        check.add_argument("version", type=int, nargs="?", default=BUILTIN_VERSION,
+                           help="Version to check, 0 (the default) is the built-in rules.")
+        check.add_argument("--file", help="Check a JSON rule document instead of a stored version.")
+        check.add_argument("--strict", action="store_true", help="Fail when any rule is reported.")
+
+    def handle(self, *args, **options):
+        subcommand = options["subcommand"]
+        try:
+            if subcommand == "list":
+                self.list_versions()
+            elif subcommand == "export":
+                self.export(options["version"])
+            elif subcommand == "import":
+                with open(options["path"]) as document_file:
+                    document = json.load(document_file)
+                ruleset = create_ruleset(document, options["description"], options["activate"])
+                state = "active" if ruleset.is_active else "inactive"
+                self.stdout.write(f"Stored rule set version {ruleset.version} ({state}).")
+            elif subcommand == "activate":
+                activate_version(options["version"])
+                self.stdout.write(f"Rule set version {options['version']} is active.")
+            elif subcommand == "check":
+                self.check_rules(options["version"], options["file"], options["strict"])
+        except (OSError, ValueError, RuleSet.DoesNotExist) as exc:
+            raise CommandError(str(exc))
+
+    def list_versions(self):
+        active = RuleSet.objects.filter(is_active=True).exists()
+        self.stdout.write(f"{'*' if not active else ' '} {BUILTIN_VERSION:>4}  built-in rules")
+        for ruleset in RuleSet.objects.order_by('version'):
+            marker = "*" if ruleset.is_active else " "
+            self.stdout.write(f"{marker} {ruleset.version:>4}  {ruleset.created_at:%Y-%m-%d %H:%M}  "
+                              f"{ruleset.description}")
+
+    def export(self, version):
+        if version == BUILTIN_VERSION:
+            document = builtin_document()
+        else:
+            document = RuleSet.objects.get(version=version).document
+        self.stdout.write(json.dumps(document, indent=2))
+
+    def check_rules(self, version, path, strict):
+        if path:
+            with open(path) as document_file:
+                rules = build_rules(version, json.load(document_file))
+        else:
+            rules = load_version(version)
+        findings = rule_findings(get_compiled(rules.cohorts))
+        for finding in findings:
+            self.stdout.write(str(finding))
+        self.stdout.write(f"{len(findings)} rule(s) can never fire.")
+        if findings and strict:
+            raise CommandError("Rule check failed.")
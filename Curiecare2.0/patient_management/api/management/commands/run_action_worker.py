@@ -0,0 +1,29 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from api.outbox import DEFAULT_CONCURRENCY, DEFAULT_MAX_ATTEMPTS, ActionWorker
+
+
+class Command(BaseCommand):
+    help = "Run queued patient actions (the action outbox) on a bounded worker pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                            help="Maximum number of actions running at once.")
+        parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                            help="Attempts before a failing action is marked failed.")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit once no due actions are left instead of polling.")
+
+    def handle(self, *args, **options):
+        worker = ActionWorker(options["concurrency"], options["max_attempts"], options["poll_interval"])
+        signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+        try:
+            stats = worker.run(once=options["once"])
+        except KeyboardInterrupt:
+            worker.stop()
+            stats = worker.stats
+        self.stdout.write(f"Actions succeeded: {stats['succeeded']}, failed attempts: {stats['failed']}.")
@@ -0,0 +1,77 @@
+import datetime
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import RuleSet
+from api.rulesets import build_rules, current_rules, load_version
+from api.simulation import compare_rule_sets
+
+
+# KEY=VALUE with a JSON value (numbers, lists, ...), or a plain string
+def config_value(text):
+    key, separator, value = text.partition("=")
+    if not separator or not key:
+        raise ValueError(f"Expected KEY=VALUE, got '{text}'.")
+    try:
+        return key, json.loads(value)
+    except json.JSONDecodeError:
+        return key, value
+
+
+class Command(BaseCommand):
+    help = ("Project bucket occupancy of the active patients over the next days under two rule sets "
+            "(for example the active one and a changed CONFIG threshold) and print them side by side.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=30, help="Days to simulate.")
+        parser.add_argument("--as-of", type=datetime.date.fromisoformat, default=None,
+                            help="First simulated day (YYYY-MM-DD), defaults to today.")
+        parser.add_argument("--baseline", type=int, default=None,
+                            help="Rule set version to compare against (0: built-in), defaults to the active one.")
+        parser.add_argument("--candidate", type=int, default=None,
+                            help="Rule set version to project, defaults to the baseline.")
+        parser.add_argument("--candidate-file", help="JSON rule document to project instead of a stored version.")
+        parser.add_argument("--set", dest="config", action="append", default=[], metavar="KEY=VALUE",
+                            help="Replace a config value of the candidate, e.g. --set Y=7 (repeatable).")
+        parser.add_argument("--json", action="store_true", help="Print the full report as JSON.")
+
+    def handle(self, *args, **options):
+        try:
+            config = dict(config_value(text) for text in options["config"])
+            baseline_version = options["baseline"]
+            baseline = current_rules() if baseline_version is None else load_version(baseline_version)
+            if options["candidate_file"]:
+                with open(options["candidate_file"]) as document_file:
+                    document = json.load(document_file)
+                if config:
+                    document["config"] = {**(document.get("config") or {}), **config}
+                candidate = build_rules(document.get("version", 0), document)
+            else:
+                candidate_version = options["candidate"] if options["candidate"] is not None else baseline.version
+                candidate = load_version(candidate_version, config)
+        except (OSError, ValueError, RuleSet.DoesNotExist) as exc:
+            raise CommandError(str(exc))
+        if config and candidate.cohorts == baseline.cohorts:
+            self.stderr.write("The config values do not change any rule of the candidate.")
+
+        report = compare_rule_sets(baseline, candidate, options["days"], options["as_of"])
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.write_table(report)
+
+    def write_table(self, report):
+        baseline, candidate = report["baseline"], report["candidate"]
+        self.stdout.write(
+            f"{report['patients']} active patients, {report['days']} days from {report['as_of']} "
+            f"(snapshot {report['snapshot_seconds']}s, simulation {baseline['seconds']}s + {candidate['seconds']}s)"
+        )
+        final = [run["days"][-1]["occupancy"] if run["days"] else {} for run in (baseline, candidate)]
+        buckets = sorted(set(final[0]) | set(final[1]))
+        self.stdout.write(f"{'bucket':<10}{'v' + str(baseline['version']):>12}{'v' + str(candidate['version']):>12}"
+                          f"{'change':>10}")
+        rows = [(bucket, final[0].get(bucket, 0), final[1].get(bucket, 0)) for bucket in buckets]
+        rows.append(("ended", baseline["ended"], candidate["ended"]))
+        for bucket, before, after in rows:
+            self.stdout.write(f"{bucket:<10}{before:>12}{after:>12}{after - before:>+10}")
@@ -0,0 +1,37 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.services import BULK_BATCH_SIZE, sweep_due_patients
+
+
+class Command(BaseCommand):
+    help = "Re-evaluate patients whose time-based disposition rules have come due."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--as-of", type=datetime.date.fromisoformat, default=None,
+                            help="Evaluate as of this date (YYYY-MM-DD), defaults to today.")
+        parser.add_argument("--chunk-size", type=int, default=BULK_BATCH_SIZE,
+                            help="Patients read and written per chunk.")
+        parser.add_argument("--interval", type=float, default=0,
+                            help="Keep running and sweep again every INTERVAL seconds.")
+        parser.add_argument("--chain", action="store_true",
+                            help="Follow each patient's moves until no rule fires any more.")
+
+    def handle(self, *args, **options):
+        while True:
+            as_of = options["as_of"] or datetime.date.today()
+            started = time.monotonic()
+            stats = sweep_due_patients(as_of, options["chunk_size"], chain=options["chain"])
+            self.stdout.write(
+                f"Swept {stats['processed']} due patients as of {as_of}: "
+                f"{stats['moved']} moved, {stats['ended']} ended lead management "
+                f"in {time.monotonic() - started:.2f}s."
+            )
+            if stats["conflicts"]:
+                self.stdout.write(f"{stats['conflicts']} patients kept changing concurrently and were left "
+                                  f"for the next sweep.")
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
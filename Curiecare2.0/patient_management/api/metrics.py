@@ -0,0 +1,181 @@
+import bisect
+import threading
+from typing import Dict, List, NamedTuple, Tuple
+
+# In-process counters and latency histograms, rendered in the Prometheus text format.
+#
+# Every thread records into its own shard, so the hot path is a couple of dict
+# operations without locks; only a thread's first record takes the registry lock.
+# A scrape sums all shards, and shards of finished threads are folded into one
+# retired shard so thread-per-request servers don't grow the registry. Values are
+# per process: with several worker processes each one exposes its own totals.
+
+COUNTER = "counter"
+HISTOGRAM = "histogram"
+
+# Latency buckets (seconds) of every histogram
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_HISTOGRAM_SIZE = len(LATENCY_BUCKETS) + 2
+
+
+class Metric(NamedTuple):
+    name: str
+    kind: str
+    help: str
+    labels: Tuple[str, ...]
+
+
+METRICS: Dict[str, Metric] = {}
+
+
+def register(name: str, kind: str, help: str, labels: Tuple[str, ...] = ()) -> str:
+    METRICS[name] = Metric(name, kind, help, labels)
+    return name
+
+
+PATIENTS_EVALUATED = register("curiecare_patients_evaluated_total", COUNTER,
+                              "Patients evaluated against their bucket's rules.", ("cohort", "bucket"))
+RULE_FIRED = register("curiecare_rule_fired_total", COUNTER,
+                      "Disposition rules that matched, per bucket and rule.", ("cohort", "bucket", "rule"))
+CRITERIA_MISMATCH = register("curiecare_criteria_mismatch_total", COUNTER,
+                             "Patients rejected because they do not meet their bucket's criteria.",
+                             ("cohort", "bucket"))
+ACTIONS = register("curiecare_actions_total", COUNTER,
+                   "Bucket actions executed, by outcome.", ("action", "outcome"))
+VERSION_CONFLICTS = register("curiecare_version_conflicts_total", COUNTER,
+                              "Patient writes rejected because the row changed after it was read.")
+PATIENT_CACHE = register("curiecare_patient_cache_lookups_total", COUNTER,
+                         "Patient cache lookups of the processing path, by result (hit or miss).", ("result",))
+EVENTS = register("curiecare_events_total", COUNTER,
+                  "Event log entries, by outcome (written, or dropped because the queue was full "
+                  "or the file could not be written).", ("event", "outcome"))
+STAGE_SECONDS = register("curiecare_stage_duration_seconds", HISTOGRAM,
+                         "Time spent per hot-path stage.", ("stage",))
+
+# Stages of STAGE_SECONDS
+VALIDATION = "validation"
+DB_SAVE = "db_save"
+RULE_EVALUATION = "rule_evaluation"
+ACTION = "action"
+
+
+class Shard:
+    __slots__ = ("thread", "counters", "histograms")
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.counters: Dict[Tuple[str, Tuple[str, ...]], float] = {}
+        # Per series: one count per latency bucket, then the +Inf count and the sum
+        self.histograms: Dict[Tuple[str, Tuple[str, ...]], List[float]] = {}
+
+    def merge(self, other: "Shard"):
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in list(other.histograms.items()):
+            mine = self.histograms.get(key)
+            if mine is None:
+                self.histograms[key] = list(values)
+            else:
+                for index, value in enumerate(values):
+                    mine[index] += value
+
+
+_lock = threading.Lock()
+_shards: List[Shard] = []
+_retired = Shard()
+
+
+# Thread-local holder; __init__ runs once in every thread that records a value
+class _Local(threading.local):
+    def __init__(self):
+        self.shard = Shard(threading.current_thread())
+        with _lock:
+            _shards.append(self.shard)
+
+
+_local = _Local()
+
+
+def inc(name: str, labels: Tuple[str, ...] = (), amount: float = 1):
+    counters = _local.shard.counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name: str, labels: Tuple[str, ...], seconds: float):
+    histograms = _local.shard.histograms
+    key = (name, labels)
+    values = histograms.get(key)
+    if values is None:
+        values = histograms[key] = [0] * _HISTOGRAM_SIZE
+    values[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    values[-1] += seconds
+
+
+def observe_stage(stage: str, seconds: float):
+    observe(STAGE_SECONDS, (stage,), seconds)
+
+
+# Totals over all threads
+def collect() -> Shard:
+    total = Shard()
+    with _lock:
+        for shard in [shard for shard in _shards if not shard.thread.is_alive()]:
+            _retired.merge(shard)
+            _shards.remove(shard)
+        total.merge(_retired)
+        shards = list(_shards)
+    for shard in shards:
+        total.merge(shard)
+    return total
+
+
+def reset():
+    with _lock:
+        for shard in _shards:
+            shard.counters.clear()
+            shard.histograms.clear()
+        _retired.counters.clear()
+        _retired.histograms.clear()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# Prometheus text exposition format (version 0.0.4)
+def render() -> str:
+    total = collect()
+    lines = []
+    for metric in sorted(METRICS.values()):
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        if metric.kind == COUNTER:
+            series = sorted((labels, value) for (name, labels), value in total.counters.items()
+                            if name == metric.name)
+            for labels, value in series:
+                lines.append(f"{metric.name}{_label_text(metric.labels, labels)} {_number(value)}")
+            continue
+        series = sorted((labels, values) for (name, labels), values in total.histograms.items()
+                        if name == metric.name)
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), values[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{metric.name}_bucket{_label_text(metric.labels, labels, le)} {_number(cumulative)}")
+            lines.append(f"{metric.name}_sum{_label_text(metric.labels, labels)} {repr(float(values[-1]))}")
+            lines.append(f"{metric.name}_count{_label_text(metric.labels, labels)} {_number(cumulative)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.2 on 2026-10-17 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_patient_lead_management_active'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='attributes',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='last_contact_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='next_due_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(condition=models.Q(('lead_management_active', True)), fields=['next_due_date'], name='patient_due_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-17 17:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_patient_attributes_patient_last_contact_date_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='patient',
+            name='patient_due_idx',
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(condition=models.Q(('lead_management_active', True)), fields=['next_due_date', 'id'], name='patient_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['current_cohort', 'current_actionable_bucket', 'lead_management_active', '-days_since_last_contact', 'id'], name='patient_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['lead_management_active', '-days_since_last_contact', 'id'], name='patient_active_queue_idx'),
+        ),
+    ]
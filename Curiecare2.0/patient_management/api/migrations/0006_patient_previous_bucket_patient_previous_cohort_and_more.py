@@ -0,0 +1,42 @@
+# Generated by Django 5.1.2 on 2026-10-17 17:44
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_patient_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='previous_bucket',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='previous_cohort',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.CreateModel(
+            name='PatientTransition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_cohort', models.CharField(max_length=10)),
+                ('from_bucket', models.CharField(max_length=10)),
+                ('to_cohort', models.CharField(blank=True, max_length=10, null=True)),
+                ('to_bucket', models.CharField(blank=True, max_length=10, null=True)),
+                ('rule_name', models.CharField(max_length=100)),
+                ('action', models.CharField(max_length=50)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('patient', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transitions', to='api.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient', 'created_at'], name='transition_patient_idx'), models.Index(fields=['created_at'], name='transition_created_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.2 on 2026-10-17 18:02
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_actionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='rule_version',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='patienttransition',
+            name='rule_version',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='RuleSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(unique=True)),
+                ('document', models.JSONField()),
+                ('description', models.CharField(blank=True, default='', max_length=200)),
+                ('is_active', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('is_active',), name='ruleset_single_active')],
+            },
+        ),
+    ]
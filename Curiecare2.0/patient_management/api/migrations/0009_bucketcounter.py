@@ -0,0 +1,41 @@
+# Generated by Django 5.1.2 on 2026-10-17 18:18
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+# Start the counters from the patients already stored
+def count_patients(apps, schema_editor):
+    Patient = apps.get_model('api', 'Patient')
+    BucketCounter = apps.get_model('api', 'BucketCounter')
+    groups = (Patient.objects.values('current_cohort', 'current_actionable_bucket', 'lead_management_active')
+              .annotate(count=Count('id')).order_by())
+    BucketCounter.objects.bulk_create([
+        BucketCounter(cohort=group['current_cohort'], bucket=group['current_actionable_bucket'],
+                      lead_management_active=group['lead_management_active'], count=group['count'])
+        for group in groups
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_ruleset_and_rule_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BucketCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cohort', models.CharField(max_length=10)),
+                ('bucket', models.CharField(max_length=10)),
+                ('lead_management_active', models.BooleanField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('cohort', 'bucket', 'lead_management_active'), name='bucketcounter_unique')],
+            },
+        ),
+        migrations.RunPython(count_patients, migrations.RunPython.noop),
+    ]
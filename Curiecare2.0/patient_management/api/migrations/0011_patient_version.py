@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_patient_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
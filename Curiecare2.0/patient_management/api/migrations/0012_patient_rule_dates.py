@@ -0,0 +1,69 @@
+import datetime
+
+from django.db import migrations, models
+
+RULE_DATE_FIELDS = ['scheduled_date', 'new_scheduled_date', 'follow_up_date']
+BATCH_SIZE = 500
+
+
+def _parse(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None
+
+
+# Move the rule dates out of the attributes; values that are not dates stay there
+def attributes_to_columns(apps, schema_editor):
+    Patient = apps.get_model('api', 'Patient')
+    changed = []
+    for patient in Patient.objects.only('id', 'attributes', *RULE_DATE_FIELDS).iterator(chunk_size=BATCH_SIZE):
+        attributes = patient.attributes or {}
+        moved = False
+        for name in RULE_DATE_FIELDS:
+            value = _parse(attributes.get(name))
+            if value is not None:
+                setattr(patient, name, value)
+                del attributes[name]
+                moved = True
+        if moved:
+            changed.append(patient)
+    Patient.objects.bulk_update(changed, ['attributes', *RULE_DATE_FIELDS], batch_size=BATCH_SIZE)
+
+
+def columns_to_attributes(apps, schema_editor):
+    Patient = apps.get_model('api', 'Patient')
+    changed = []
+    for patient in Patient.objects.only('id', 'attributes', *RULE_DATE_FIELDS).iterator(chunk_size=BATCH_SIZE):
+        values = {name: getattr(patient, name) for name in RULE_DATE_FIELDS if getattr(patient, name) is not None}
+        if values:
+            patient.attributes = {**(patient.attributes or {}),
+                                  **{name: value.strftime('%Y-%m-%d') for name, value in values.items()}}
+            changed.append(patient)
+    Patient.objects.bulk_update(changed, ['attributes'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_patient_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='scheduled_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='new_scheduled_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='follow_up_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.RunPython(attributes_to_columns, columns_to_attributes),
+    ]
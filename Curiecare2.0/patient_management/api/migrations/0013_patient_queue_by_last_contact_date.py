@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-17 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_patient_rule_dates'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='patient',
+            name='patient_queue_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='patient',
+            name='patient_active_queue_idx',
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['current_cohort', 'current_actionable_bucket', 'lead_management_active', 'last_contact_date', 'id'], name='patient_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['lead_management_active', 'last_contact_date', 'id'], name='patient_active_queue_idx'),
+        ),
+    ]
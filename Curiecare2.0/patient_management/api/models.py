@@ -1,4 +1,6 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 
 class Patient(models.Model):
     id = models.CharField(max_length=10, primary_key=True)
@@ -11,5 +13,144 @@ class Patient(models.Model):
     days_since_last_contact = models.IntegerField(default=0)
     quotation_accepted=models.BooleanField(default=False)
     lead_management_active = models.BooleanField(default=True)
+    # Bucket the patient was in before its last move, used to re-engage E1 patients
+    previous_cohort = models.CharField(max_length=10, null=True, blank=True)
+    previous_bucket = models.CharField(max_length=10, null=True, blank=True)
+    # Payload keys without a column of their own (response_received, admission_status, ...)
+    attributes = models.JSONField(default=dict, blank=True)
+    last_contact_date = models.DateField(null=True, blank=True)
+    # Dates the rules read; stored as payload attributes until 0012, and like those
+    # replaced by every post of the patient (services.processed_fields)
+    scheduled_date = models.DateField(null=True, blank=True)
+    new_scheduled_date = models.DateField(null=True, blank=True)
+    follow_up_date = models.DateField(null=True, blank=True)
+    # Next day a time-based rule can fire, maintained for the re-evaluation sweeper
+    next_due_date = models.DateField(null=True, blank=True)
+    # RuleSet version that last evaluated the patient (0 is the built-in COHORTS)
+    rule_version = models.PositiveIntegerField(null=True, blank=True)
+    # Last write of the row, for incremental exports (bulk_update callers set it themselves)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Incremented by every write of the processing paths, which only write back a row
+    # whose version is still the one they read (services.VersionConflict otherwise)
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_due_date', 'id'], name='patient_due_idx',
+                         condition=models.Q(lead_management_active=True)),
+            # Work queues: filter by cohort/bucket/active, least recently contacted first,
+            # id as tie-breaker
+            models.Index(fields=['current_cohort', 'current_actionable_bucket', 'lead_management_active',
+                                 'last_contact_date', 'id'], name='patient_queue_idx'),
+            models.Index(fields=['lead_management_active', 'last_contact_date', 'id'],
+                         name='patient_active_queue_idx'),
+            models.Index(fields=['updated_at', 'id'], name='patient_updated_idx'),
+        ]
+
     def __str__(self):
         return self.id
+
+
+# Append-only history of the moves made by disposition rules
+class PatientTransition(models.Model):
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='transitions', db_index=False)
+    from_cohort = models.CharField(max_length=10)
+    from_bucket = models.CharField(max_length=10)
+    to_cohort = models.CharField(max_length=10, null=True, blank=True)
+    to_bucket = models.CharField(max_length=10, null=True, blank=True)
+    rule_name = models.CharField(max_length=100)
+    action = models.CharField(max_length=50)
+    rule_version = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Per-patient history and per-day funnel range scans
+            models.Index(fields=['patient', 'created_at'], name='transition_patient_idx'),
+            models.Index(fields=['created_at'], name='transition_created_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Patient transitions are append-only.")
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.patient_id}: {self.from_bucket} -> {self.to_bucket} ({self.rule_name})"
+
+
+# Outbox of bucket actions, enqueued in the same transaction as the state change
+# and drained by the action worker (manage.py run_action_worker)
+class ActionJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='action_jobs', db_index=False)
+    action = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at', 'id'], name='actionjob_pending_idx',
+                         condition=models.Q(status='pending')),
+            # Per-patient ordering: a job waits for unfinished jobs of the same patient with a lower id
+            models.Index(fields=['patient', 'status', 'id'], name='actionjob_patient_idx'),
+            models.Index(fields=['locked_at'], name='actionjob_running_idx',
+                         condition=models.Q(status='running')),
+        ]
+
+    def __str__(self):
+        return f"{self.action} for {self.patient_id} ({self.status})"
+
+
+# Versioned rule documents ({"config": {...}, "cohorts": {...}}, see api/rulesets.py).
+# Exactly one version is active; workers pick up a newly activated one without a restart.
+class RuleSet(models.Model):
+    version = models.PositiveIntegerField(unique=True)
+    document = models.JSONField()
+    description = models.CharField(max_length=200, blank=True, default='')
+    is_active = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['is_active'], condition=models.Q(is_active=True),
+                                    name='ruleset_single_active'),
+        ]
+
+    def __str__(self):
+        return f"Rules v{self.version}{' (active)' if self.is_active else ''}"
+
+
+# Materialized number of patients per (cohort, bucket, active flag). Kept up to date
+# by api/counters.py in the same transaction as every patient state change made by
+# the services; writes that bypass them (admin edits, deletes) are fixed up by
+# manage.py rebuild_bucket_counters.
+class BucketCounter(models.Model):
+    cohort = models.CharField(max_length=10)
+    bucket = models.CharField(max_length=10)
+    lead_management_active = models.BooleanField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cohort', 'bucket', 'lead_management_active'],
+                                    name='bucketcounter_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.cohort}.{self.bucket}{'' if self.lead_management_active else ' (ended)'}: {self.count}"
@@ -0,0 +1,186 @@
+import datetime
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional
+
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from . import events, metrics
+from .models import ActionJob
+from .patient_data import ACTION_MAPPING
+
+# Durable action dispatch (transactional outbox).
+#
+# Request handlers only insert ActionJob rows, in the same transaction as the
+# patient's state change. A worker claims due jobs, runs the ACTION_MAPPING
+# functions on a bounded thread pool and retries failures with exponential
+# backoff. A job is only claimed once every earlier job of the same patient has
+# finished, so each patient's actions run in the order they were enqueued.
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 300.0
+# Running jobs whose lock is older than this are assumed orphaned by a dead worker
+LOCK_TIMEOUT = datetime.timedelta(minutes=5)
+
+
+# ActionJob rows for the deferred actions of process_patient results
+def action_jobs(results: List[Dict[str, Any]]) -> List[ActionJob]:
+    now = timezone.now()
+    jobs = []
+    for result in results:
+        for action in result.get("actions", ()):
+            jobs.append(ActionJob(
+                patient_id=result["patient_id"],
+                action=action,
+                payload=result.get("action_patient", {}),
+                available_at=now,
+                created_at=now,
+            ))
+    return jobs
+
+
+def enqueue_actions(results: List[Dict[str, Any]], batch_size: Optional[int] = None) -> int:
+    jobs = action_jobs(results)
+    ActionJob.objects.bulk_create(jobs, batch_size=batch_size)
+    return len(jobs)
+
+
+def backoff_delay(attempts: int) -> float:
+    delay = min(BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)), BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+# Claim up to `limit` due jobs, at most one per patient, and mark them running
+def claim_jobs(limit: int) -> List[ActionJob]:
+    now = timezone.now()
+    earlier_unfinished = ActionJob.objects.filter(
+        patient_id=OuterRef('patient_id'),
+        id__lt=OuterRef('id'),
+        status__in=[ActionJob.PENDING, ActionJob.RUNNING],
+    )
+    with transaction.atomic():
+        candidates = list(
+            ActionJob.objects.filter(status=ActionJob.PENDING, available_at__lte=now)
+            .filter(~Exists(earlier_unfinished))
+            .order_by('available_at', 'id')[:limit]
+        )
+        if not candidates:
+            return []
+        ActionJob.objects.filter(id__in=[job.id for job in candidates], status=ActionJob.PENDING) \
+            .update(status=ActionJob.RUNNING, locked_at=now)
+    for job in candidates:
+        job.status = ActionJob.RUNNING
+        job.locked_at = now
+    return candidates
+
+
+# Put running jobs abandoned by a dead worker back in the queue
+def release_stale_jobs() -> int:
+    cutoff = timezone.now() - LOCK_TIMEOUT
+    return ActionJob.objects.filter(status=ActionJob.RUNNING, locked_at__lt=cutoff) \
+        .update(status=ActionJob.PENDING, locked_at=None)
+
+
+# Event log entry of one run of a job
+def log_job(job: ActionJob, outcome: str, attempts: int, seconds: Optional[float] = None, error: str = ''):
+    fields = {"action": job.action, "outcome": outcome, "cohort": job.payload.get("current_cohort"),
+              "bucket": job.payload.get("current_actionable_bucket"), "job": job.id, "attempt": attempts}
+    if seconds is not None:
+        fields["seconds"] = round(seconds, 6)
+    if error:
+        fields["error"] = error
+    events.emit(events.ACTION, job.patient_id, **fields)
+
+
+# Run one claimed job and record the outcome
+def run_job(job: ActionJob, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> bool:
+    attempts = job.attempts + 1
+    func = ACTION_MAPPING.get(job.action)
+    if func is None:
+        metrics.inc(metrics.ACTIONS, (job.action, "unknown"))
+        log_job(job, "unknown", attempts)
+        ActionJob.objects.filter(id=job.id).update(
+            status=ActionJob.FAILED, attempts=attempts, locked_at=None,
+            last_error=f"Action '{job.action}' not recognized.")
+        return False
+    started = time.perf_counter()
+    try:
+        func({"id": job.patient_id, **job.payload})
+    except Exception as exc:
+        elapsed = time.perf_counter() - started
+        outcome = "failed" if attempts >= max_attempts else "retried"
+        metrics.observe_stage(metrics.ACTION, elapsed)
+        metrics.inc(metrics.ACTIONS, (job.action, outcome))
+        log_job(job, outcome, attempts, elapsed, repr(exc))
+        if attempts >= max_attempts:
+            ActionJob.objects.filter(id=job.id).update(
+                status=ActionJob.FAILED, attempts=attempts, locked_at=None, last_error=repr(exc))
+        else:
+            ActionJob.objects.filter(id=job.id).update(
+                status=ActionJob.PENDING, attempts=attempts, locked_at=None, last_error=repr(exc),
+                available_at=timezone.now() + datetime.timedelta(seconds=backoff_delay(attempts)))
+        return False
+    elapsed = time.perf_counter() - started
+    metrics.observe_stage(metrics.ACTION, elapsed)
+    metrics.inc(metrics.ACTIONS, (job.action, "succeeded"))
+    log_job(job, "succeeded", attempts, elapsed)
+    ActionJob.objects.filter(id=job.id).update(
+        status=ActionJob.DONE, attempts=attempts, locked_at=None, last_error='')
+    return True
+
+
+# Each pool thread keeps its own connection for CONN_MAX_AGE, like a request thread;
+# connections that expired or broke are replaced around each job
+def _run_job_in_thread(job: ActionJob, max_attempts: int) -> bool:
+    close_old_connections()
+    try:
+        return run_job(job, max_attempts)
+    finally:
+        close_old_connections()
+
+
+# Drains the outbox with a bounded pool of threads
+class ActionWorker:
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 poll_interval: float = 1.0):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.stats = {"succeeded": 0, "failed": 0}
+
+    def stop(self):
+        self.stop_event.set()
+
+    # Claim and run jobs until the queue is empty (once=True) or stop() is called.
+    # Free pool slots are refilled as soon as any job finishes.
+    def run(self, once: bool = False) -> Dict[str, int]:
+        release_stale_jobs()
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while not self.stop_event.is_set():
+                close_old_connections()
+                free = self.concurrency - len(in_flight)
+                for job in (claim_jobs(free) if free else []):
+                    in_flight.add(pool.submit(_run_job_in_thread, job, self.max_attempts))
+                if not in_flight:
+                    if once:
+                        break
+                    self.stop_event.wait(self.poll_interval)
+                    release_stale_jobs()
+                    continue
+                done, in_flight = wait(in_flight, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                self._count(done)
+            # Jobs still running when stop() was called
+            self._count(wait(in_flight).done)
+        return self.stats
+
+    def _count(self, done):
+        for future in done:
+            self.stats["succeeded" if future.result() else "failed"] += 1
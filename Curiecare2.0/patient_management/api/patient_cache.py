@@ -0,0 +1,161 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import metrics
+from .models import Patient
+
+# In-process LRU cache of Patient rows in front of the processing path's lookups.
+#
+# Rows are kept as field values and handed out as new instances, so callers may
+# change what they get. Writers store the state they wrote once their transaction
+# commits (write-through). A write by another process is noticed when the entry
+# expires, or when writing back an evaluation of the stale entry fails the version
+# check: services.retry_on_conflict evicts it and the retry reads the database.
+# Inside a transaction the cache is bypassed, the transaction reads its own snapshot.
+
+FIELD_NAMES = [field.attname for field in Patient._meta.concrete_fields]
+_ATTRIBUTES = FIELD_NAMES.index('attributes')
+_VERSION = FIELD_NAMES.index('version')
+
+Values = Tuple[Any, ...]
+
+
+def _snapshot(patient: Patient) -> Values:
+    values = [getattr(patient, name) for name in FIELD_NAMES]
+    values[_ATTRIBUTES] = copy.deepcopy(values[_ATTRIBUTES])
+    return tuple(values)
+
+
+def _patient(values: Values) -> Patient:
+    values = list(values)
+    values[_ATTRIBUTES] = copy.deepcopy(values[_ATTRIBUTES])
+    return Patient.from_db('default', FIELD_NAMES, values)
+
+
+class PatientCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, Tuple[float, Values]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # Stored values of a patient, None on a miss (counted in metrics.PATIENT_CACHE)
+    def get(self, patient_id: str) -> Optional[Values]:
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[patient_id]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(patient_id)
+        metrics.inc(metrics.PATIENT_CACHE, ("hit" if entry is not None else "miss",))
+        return entry[1] if entry is not None else None
+
+    def put(self, items: Iterable[Tuple[str, Values]]):
+        if self.max_size <= 0:
+            return
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for patient_id, values in items:
+                entry = self._entries.get(patient_id)
+                # A read that raced a write must not replace the written state
+                if entry is not None and entry[1][_VERSION] > values[_VERSION]:
+                    continue
+                self._entries[patient_id] = (expires, values)
+                self._entries.move_to_end(patient_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, patient_ids: Iterable[str]):
+        with self._lock:
+            for patient_id in patient_ids:
+                self._entries.pop(patient_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = PatientCache(settings.PATIENT_CACHE_SIZE, settings.PATIENT_CACHE_TTL)
+
+
+def _enabled() -> bool:
+    return _cache.max_size > 0 and not connection.in_atomic_block
+
+
+# The stored patient (None if there is none), from the cache or read through it
+def get_patient(patient_id: str) -> Optional[Patient]:
+    if not _enabled():
+        return Patient.objects.filter(pk=patient_id).first()
+    values = _cache.get(patient_id)
+    if values is not None:
+        return _patient(values)
+    patient = Patient.objects.filter(pk=patient_id).first()
+    if patient is not None:
+        _cache.put([(patient_id, _snapshot(patient))])
+    return patient
+
+
+# Async code never runs inside a transaction
+async def aget_patient(patient_id: str) -> Optional[Patient]:
+    values = _cache.get(patient_id) if _cache.max_size > 0 else None
+    if values is not None:
+        return _patient(values)
+    patient = await Patient.objects.filter(pk=patient_id).afirst()
+    if patient is not None:
+        _cache.put([(patient_id, _snapshot(patient))])
+    return patient
+
+
+# in_bulk() of the given ids, with only the cache misses read from the database
+def get_patients(patient_ids: List[str]) -> Dict[str, Patient]:
+    if not _enabled():
+        return Patient.objects.in_bulk(patient_ids)
+    found = {}
+    missing = []
+    for patient_id in dict.fromkeys(patient_ids):
+        values = _cache.get(patient_id)
+        if values is not None:
+            found[patient_id] = _patient(values)
+        else:
+            missing.append(patient_id)
+    if missing:
+        stored = Patient.objects.in_bulk(missing)
+        _cache.put((patient_id, _snapshot(patient)) for patient_id, patient in stored.items())
+        found.update(stored)
+    return found
+
+
+# Write-through: cache the state just written once the surrounding transaction
+# commits (right away outside of one); a rolled back write is never cached
+def store(patients: Iterable[Patient]):
+    if _cache.max_size <= 0:
+        return
+    items = [(patient.pk, _snapshot(patient)) for patient in patients]
+    _cache.invalidate(patient_id for patient_id, _ in items)
+    transaction.on_commit(lambda: _cache.put(items))
+
+
+def invalidate(patient_ids: Iterable[str]):
+    _cache.invalidate(patient_ids)
+
+
+def clear():
+    _cache.clear()
+
+
+# Saves and deletes outside the processing path (the admin, scripts)
+@receiver([post_save, post_delete], sender=Patient, dispatch_uid="patient_cache_invalidate")
+def _invalidate_saved(sender, instance, **kwargs):
+    _cache.invalidate([instance.pk])
@@ -1,6 +1,10 @@
 import datetime
+import time
 from typing import Dict, Any, List, Optional
 
+from . import events, metrics
+from .rules import OP_EQ, EvaluationContext, compile_condition, get_compiled, invalidate
+
 # Configurable Parameters
 CONFIG = {
     "Y": 5,        # Days since last contact to trigger certain actions
@@ -8,395 +12,406 @@ CONFIG = {
     "Final": 3     # Number of follow-up attempts considered final
 }
 
-# Define the cohort configuration as a nested dictionary
-COHORTS = {
-    "A": {
-        "name": "Pre-Admission",
-        "actionable_buckets": {
-            "A1": {
-                "name": "New Recommendations",
-                "criteria": {"status": "IP Recommended"},
-                "actions": ["inform_recommendation", "assess_additional_requirements"],
-                "disposition_rules": {
-                    "if_clinical_intervention_needed": {
-                        "condition": {"clinical_intervention_required": True},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "A",
-                        "target_actionable_bucket": "A2"
-                    },
-                    "if_quotation_phase_needed": {
-                        "condition": {
-                            "quotation_phase_required": True,
-                            "clinical_intervention_required": False
+# Define the cohort configuration as a nested dictionary, with the thresholds taken from config
+def build_cohorts(config: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "A": {
+            "name": "Pre-Admission",
+            "actionable_buckets": {
+                "A1": {
+                    "name": "New Recommendations",
+                    "criteria": {"status": "IP Recommended"},
+                    "actions": ["inform_recommendation", "assess_additional_requirements"],
+                    "disposition_rules": {
+                        "if_clinical_intervention_needed": {
+                            "condition": {"clinical_intervention_required": True},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "A",
+                            "target_actionable_bucket": "A2"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "A",
-                        "target_actionable_bucket": "A3"
-                    },
-                    "if_both_needed": {
-                        "condition": {
-                            "clinical_intervention_required": True,
-                            "quotation_phase_required": True
+                        "if_quotation_phase_needed": {
+                            "condition": {
+                                "quotation_phase_required": True,
+                                "clinical_intervention_required": False
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "A",
+                            "target_actionable_bucket": "A3"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "A",
-                        "target_actionable_bucket": "A2"
-                    },
-                    "if_ready_to_schedule": {
-                        "condition": {
-                            "clinical_intervention_required": False,
-                            "quotation_phase_required": False,
-                            "patient_ready": True
+                        "if_both_needed": {
+                            "condition": {
+                                "clinical_intervention_required": True,
+                                "quotation_phase_required": True
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "A",
+                            "target_actionable_bucket": "A2"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "A",
-                        "target_actionable_bucket": "A4"
+                        "if_ready_to_schedule": {
+                            "condition": {
+                                "clinical_intervention_required": False,
+                                "quotation_phase_required": False,
+                                "patient_ready": True
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "A",
+                            "target_actionable_bucket": "A4"
+                        }
                     }
-                }
-            },
-            "A2": {
-                "name": "Clinical Intervention",
-                "criteria": {"status": "Clinical Intervention Required"},
-                "actions": ["schedule_clinical_intervention", "notify_patient_clinical_steps"],
-                "disposition_rules": {
-                    "on_clinical_intervention_completed_quotation_needed": {
-                        "condition": {
-                            "clinical_intervention_completed": True,
-                            "quotation_phase_required": True
-                        },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "A",
-                        "target_actionable_bucket": "A3"
-                    },
-                    "on_clinical_intervention_completed_no_quotation_needed": {
-                        "condition": {
-                            "clinical_intervention_completed": True,
-                            "quotation_phase_required": False
+                },
+                "A2": {
+                    "name": "Clinical Intervention",
+                    "criteria": {"status": "Clinical Intervention Required"},
+                    "actions": ["schedule_clinical_intervention", "notify_patient_clinical_steps"],
+                    "disposition_rules": {
+                        "on_clinical_intervention_completed_quotation_needed": {
+                            "condition": {
+                                "clinical_intervention_completed": True,
+                                "quotation_phase_required": True
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "A",
+                            "target_actionable_bucket": "A3"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "A",
-                        "target_actionable_bucket": "A4"
-                    },
-                    "on_no_response": {
-                        "condition": {
-                            "days_since_last_contact": f">= {CONFIG['Y']}",
-                            "clinical_intervention_completed": False
+                        "on_clinical_intervention_completed_no_quotation_needed": {
+                            "condition": {
+                                "clinical_intervention_completed": True,
+                                "quotation_phase_required": False
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "A",
+                            "target_actionable_bucket": "A4"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "C",
-                        "target_actionable_bucket": "C2"
+                        "on_no_response": {
+                            "condition": {
+                                "days_since_last_contact": f">= {config['Y']}",
+                                "clinical_intervention_completed": False
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "C",
+                            "target_actionable_bucket": "C2"
+                        }
                     }
-                }
-            },
-            "A3": {
-                "name": "Quotation Phase",
-                "criteria": {"status": "Quotation Phase Required"},
-                "actions": ["provide_quotation", "discuss_financial_options"],
-                "disposition_rules": {
-                    "on_quotation_accepted": {
-                        "condition": {"quotation_accepted": True},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "A",
-                        "target_actionable_bucket": "A4"
-                    },
-                    "on_no_response": {
-                        "condition": {
-                            "days_since_last_contact": f">= {CONFIG['Y']}",
-                            "quotation_accepted": False
+                },
+                "A3": {
+                    "name": "Quotation Phase",
+                    "criteria": {"status": "Quotation Phase Required"},
+                    "actions": ["provide_quotation", "discuss_financial_options"],
+                    "disposition_rules": {
+                        "on_quotation_accepted": {
+                            "condition": {"quotation_accepted": True},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "A",
+                            "target_actionable_bucket": "A4"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "C",
-                        "target_actionable_bucket": "C3"
+                        "on_no_response": {
+                            "condition": {
+                                "days_since_last_contact": f">= {config['Y']}",
+                                "quotation_accepted": False
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "C",
+                            "target_actionable_bucket": "C3"
+                        }
                     }
-                }
-            },
-            "A4": {
-                "name": "Ready to Schedule",
-                "criteria": {"status": "Ready to Schedule Admission"},
-                "actions": ["follow_up_to_schedule_admission"],
-                "disposition_rules": {
-                    "on_admission_scheduled": {
-                        "condition": {"scheduled_admission": True},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "B",
-                        "target_actionable_bucket": "B1"
-                    },
-                    "on_no_response": {
-                        "condition": {
-                            "days_since_last_contact": f">= {CONFIG['Y']}",
-                            "scheduled_admission": False
+                },
+                "A4": {
+                    "name": "Ready to Schedule",
+                    "criteria": {"status": "Ready to Schedule Admission"},
+                    "actions": ["follow_up_to_schedule_admission"],
+                    "disposition_rules": {
+                        "on_admission_scheduled": {
+                            "condition": {"scheduled_admission": True},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "B",
+                            "target_actionable_bucket": "B1"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "C",
-                        "target_actionable_bucket": "C1"
+                        "on_no_response": {
+                            "condition": {
+                                "days_since_last_contact": f">= {config['Y']}",
+                                "scheduled_admission": False
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "C",
+                            "target_actionable_bucket": "C1"
+                        }
                     }
                 }
             }
-        }
-    },
-    "B": {
-        "name": "Scheduled Admissions",
-        "actionable_buckets": {
-            "B1": {
-                "name": "Pre-Admission Prep",
-                "criteria": {
-                    "status": "Admission Scheduled",
-                    "scheduled_date_exists": True,
-                    "scheduled_date_in_future": True
-                },
-                "actions": ["provide_pre_admission_instructions", "confirm_admission_details"],
-                "disposition_rules": {
-                    "when_admission_date_approaches": {
-                        "condition": {"days_until_admission": f"<= {CONFIG['Z']}"},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "B",
-                        "target_actionable_bucket": "B2"
-                    },
-                    "on_admission_postponed": {
-                        "condition": {"admission_status": "Postponed"},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "C",
-                        "target_actionable_bucket": "C1"
+        },
+        "B": {
+            "name": "Scheduled Admissions",
+            "actionable_buckets": {
+                "B1": {
+                    "name": "Pre-Admission Prep",
+                    "criteria": {
+                        "status": "Admission Scheduled",
+                        "scheduled_date_exists": True,
+                        "scheduled_date_in_future": True
                     },
-                    "on_due_date_passed_without_admission": {
-                        "condition": {
-                            "scheduled_date_in_past": True,
-                            "admission_completed": False
+                    "actions": ["provide_pre_admission_instructions", "confirm_admission_details"],
+                    "disposition_rules": {
+                        "when_admission_date_approaches": {
+                            "condition": {"days_until_admission": f"<= {config['Z']}"},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "B",
+                            "target_actionable_bucket": "B2"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "C",
-                        "target_actionable_bucket": "C1"
+                        "on_admission_postponed": {
+                            "condition": {"admission_status": "Postponed"},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "C",
+                            "target_actionable_bucket": "C1"
+                        },
+                        "on_due_date_passed_without_admission": {
+                            "condition": {
+                                "scheduled_date_in_past": True,
+                                "admission_completed": False
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "C",
+                            "target_actionable_bucket": "C1"
+                        }
                     }
-                }
-            },
-            "B2": {
-                "name": "Admission Soon",
-                "criteria": {
-                    "status": "Admission Scheduled",
-                    "days_until_admission_between": [0, CONFIG['Z']]
                 },
-                "actions": ["confirm_patient_readiness", "send_admission_reminders"],
-                "disposition_rules": {
-                    "on_admission_completed": {
-                        "condition": {"admission_completed": True},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "D",
-                        "target_actionable_bucket": "D1"
+                "B2": {
+                    "name": "Admission Soon",
+                    "criteria": {
+                        "status": "Admission Scheduled",
+                        "days_until_admission_between": [0, config['Z']]
                     },
-                    "on_admission_cancelled": {
-                        "condition": {"admission_status": "Cancelled"},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "C",
-                        "target_actionable_bucket": "C1"
-                    },
-                    "on_due_date_passed_without_admission": {
-                        "condition": {
-                            "scheduled_date_in_past": True,
-                            "admission_completed": False
+                    "actions": ["confirm_patient_readiness", "send_admission_reminders"],
+                    "disposition_rules": {
+                        "on_admission_completed": {
+                            "condition": {"admission_completed": True},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "D",
+                            "target_actionable_bucket": "D1"
+                        },
+                        "on_admission_cancelled": {
+                            "condition": {"admission_status": "Cancelled"},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "C",
+                            "target_actionable_bucket": "C1"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "C",
-                        "target_actionable_bucket": "C1"
+                        "on_due_date_passed_without_admission": {
+                            "condition": {
+                                "scheduled_date_in_past": True,
+                                "admission_completed": False
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "C",
+                            "target_actionable_bucket": "C1"
+                        }
                     }
                 }
             }
-        }
-    },
-    "C": {
-        "name": "Not Admitted",
-        "actionable_buckets": {
-            "C1": {
-                "name": "Postponed Admissions",
-                "criteria": {"status": "Admission Postponed"},
-                "actions": ["reschedule_admission_date", "update_patient_instructions"],
-                "disposition_rules": {
-                    "on_rescheduled": {
-                        "condition": {"new_scheduled_date_exists": True},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "B",
-                        "target_actionable_bucket": "B1"
-                    },
-                    "on_no_response": {
-                        "condition": {
-                            "days_since_last_contact": f">= {CONFIG['Y']}",
-                            "new_scheduled_date_exists": False
+        },
+        "C": {
+            "name": "Not Admitted",
+            "actionable_buckets": {
+                "C1": {
+                    "name": "Postponed Admissions",
+                    "criteria": {"status": "Admission Postponed"},
+                    "actions": ["reschedule_admission_date", "update_patient_instructions"],
+                    "disposition_rules": {
+                        "on_rescheduled": {
+                            "condition": {"new_scheduled_date_exists": True},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "B",
+                            "target_actionable_bucket": "B1"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "E",
-                        "target_actionable_bucket": "E1"
+                        "on_no_response": {
+                            "condition": {
+                                "days_since_last_contact": f">= {config['Y']}",
+                                "new_scheduled_date_exists": False
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "E",
+                            "target_actionable_bucket": "E1"
+                        }
                     }
-                }
-            },
-            "C2": {
-                "name": "Clinical Stage",
-                "criteria": {"status": "Clinical Intervention Required", "admission_completed": False},
-                "actions": ["reassess_clinical_requirements", "follow_up_for_intervention"],
-                "disposition_rules": {
-                    "on_clinical_intervention_completed": {
-                        "condition": {"clinical_intervention_completed": True},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "A",
-                        "target_actionable_bucket": "A3"
-                    },
-                    "on_no_response": {
-                        "condition": {
-                            "days_since_last_contact": f">= {CONFIG['Y']}"
+                },
+                "C2": {
+                    "name": "Clinical Stage",
+                    "criteria": {"status": "Clinical Intervention Required", "admission_completed": False},
+                    "actions": ["reassess_clinical_requirements", "follow_up_for_intervention"],
+                    "disposition_rules": {
+                        "on_clinical_intervention_completed": {
+                            "condition": {"clinical_intervention_completed": True},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "A",
+                            "target_actionable_bucket": "A3"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "E",
-                        "target_actionable_bucket": "E1"
+                        "on_no_response": {
+                            "condition": {
+                                "days_since_last_contact": f">= {config['Y']}"
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "E",
+                            "target_actionable_bucket": "E1"
+                        }
                     }
-                }
-            },
-            "C3": {
-                "name": "Quotation Stage",
-                "criteria": {"status": "Quotation Phase Required", "admission_completed": False},
-                "actions": ["revisit_quotation", "offer_alternate_financial_options"],
-                "disposition_rules": {
-                    "on_quotation_accepted": {
-                        "condition": {"quotation_accepted": True},
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "A",
-                        "target_actionable_bucket": "A4"
-                    },
-                    "on_no_response": {
-                        "condition": {
-                            "days_since_last_contact": f">= {CONFIG['Y']}"
+                },
+                "C3": {
+                    "name": "Quotation Stage",
+                    "criteria": {"status": "Quotation Phase Required", "admission_completed": False},
+                    "actions": ["revisit_quotation", "offer_alternate_financial_options"],
+                    "disposition_rules": {
+                        "on_quotation_accepted": {
+                            "condition": {"quotation_accepted": True},
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "A",
+                            "target_actionable_bucket": "A4"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "E",
-                        "target_actionable_bucket": "E1"
+                        "on_no_response": {
+                            "condition": {
+                                "days_since_last_contact": f">= {config['Y']}"
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "E",
+                            "target_actionable_bucket": "E1"
+                        }
                     }
                 }
             }
-        }
-    },
-    "D": {
-        "name": "Admitted Patients",
-        "actionable_buckets": {
-            "D1": {
-                "name": "Inpatient Transition",
-                "criteria": {"status": "Admitted"},
-                "actions": ["transition_to_inpatient_care", "update_patient_records"],
-                "disposition_rules": {
-                    "lead_management_ends": {
-                        "condition": {},  # No conditions, end lead management
-                        "action": "end_lead_management"
+        },
+        "D": {
+            "name": "Admitted Patients",
+            "actionable_buckets": {
+                "D1": {
+                    "name": "Inpatient Transition",
+                    "criteria": {"status": "Admitted"},
+                    "actions": ["transition_to_inpatient_care", "update_patient_records"],
+                    "disposition_rules": {
+                        "lead_management_ends": {
+                            "condition": {},  # No conditions, end lead management
+                            "action": "end_lead_management"
+                        }
                     }
                 }
             }
-        }
-    },
-    "E": {
-        "name": "At Risk",
-        "actionable_buckets": {
-            "E1": {
-                "name": "Final Outreach",
-                "criteria": {"status": "Unresponsive"},
-                "actions": ["make_final_contact_attempts", "assess_non_response_reasons"],
-                "disposition_rules": {
-                    "on_patient_reengaged": {
-                        "condition": {"response_received": True},
-                        "action": "move_to_previous_actionable_bucket"
-                    },
-                    "on_no_response_after_final_attempts": {
-                        "condition": {
-                            "follow_up_attempts": f">= {CONFIG['Final']}",
-                            "response_received": False
+        },
+        "E": {
+            "name": "At Risk",
+            "actionable_buckets": {
+                "E1": {
+                    "name": "Final Outreach",
+                    "criteria": {"status": "Unresponsive"},
+                    "actions": ["make_final_contact_attempts", "assess_non_response_reasons"],
+                    "disposition_rules": {
+                        "on_patient_reengaged": {
+                            "condition": {"response_received": True},
+                            "action": "move_to_previous_actionable_bucket"
                         },
-                        "action": "move_to_actionable_bucket",
-                        "target_cohort": "E",
-                        "target_actionable_bucket": "E2"
+                        "on_no_response_after_final_attempts": {
+                            "condition": {
+                                "follow_up_attempts": f">= {config['Final']}",
+                                "response_received": False
+                            },
+                            "action": "move_to_actionable_bucket",
+                            "target_cohort": "E",
+                            "target_actionable_bucket": "E2"
+                        }
                     }
-                }
-            },
-            "E2": {
-                "name": "Closure Analysis",
-                "criteria": {
-                    "status": "Lost",
-                    "reason": "Declined or Unresponsive"
                 },
-                "actions": ["record_loss_reason", "analyze_for_improvement"],
-                "disposition_rules": {
-                    "lead_management_ends": {
-                        "condition": {},  # No conditions, end lead management
-                        "action": "end_lead_management"
+                "E2": {
+                    "name": "Closure Analysis",
+                    "criteria": {
+                        "status": "Lost",
+                        "reason": "Declined or Unresponsive"
+                    },
+                    "actions": ["record_loss_reason", "analyze_for_improvement"],
+                    "disposition_rules": {
+                        "lead_management_ends": {
+                            "condition": {},  # No conditions, end lead management
+                            "action": "end_lead_management"
+                        }
                     }
                 }
             }
         }
     }
-}
 
-# Placeholder action functions
+
+COHORTS = build_cohorts(CONFIG)
+
+# Compile the rule tree once at import; reload_rules() recompiles after COHORTS/CONFIG edits
+def reload_rules():
+    invalidate(COHORTS)
+    return get_compiled(COHORTS)
+
+reload_rules()
+
+# Placeholder action functions; every run is recorded in the event log by their callers
 def inform_recommendation(patient: Dict[str, Any]):
-    print(f"Action: Informing recommendation for patient {patient['id']}.")
+    pass
 
 def assess_additional_requirements(patient: Dict[str, Any]):
-    print(f"Action: Assessing additional requirements for patient {patient['id']}.")
+    pass
 
 def schedule_clinical_intervention(patient: Dict[str, Any]):
-    print(f"Action: Scheduling clinical intervention for patient {patient['id']}.")
+    pass
 
 def notify_patient_clinical_steps(patient: Dict[str, Any]):
-    print(f"Action: Notifying patient {patient['id']} of clinical steps.")
+    pass
 
 def provide_quotation(patient: Dict[str, Any]):
-    print(f"Action: Providing quotation to patient {patient['id']}.")
+    pass
 
 def discuss_financial_options(patient: Dict[str, Any]):
-    print(f"Action: Discussing financial options with patient {patient['id']}.")
+    pass
 
 def follow_up_to_schedule_admission(patient: Dict[str, Any]):
-    print(f"Action: Following up to schedule admission for patient {patient['id']}.")
+    pass
 
 def provide_pre_admission_instructions(patient: Dict[str, Any]):
-    print(f"Action: Providing pre-admission instructions to patient {patient['id']}.")
+    pass
 
 def confirm_admission_details(patient: Dict[str, Any]):
-    print(f"Action: Confirming admission details for patient {patient['id']}.")
+    pass
 
 def confirm_patient_readiness(patient: Dict[str, Any]):
-    print(f"Action: Confirming patient readiness for admission {patient['id']}.")
+    pass
 
 def send_admission_reminders(patient: Dict[str, Any]):
-    print(f"Action: Sending admission reminders to patient {patient['id']}.")
+    pass
 
 def transition_to_inpatient_care(patient: Dict[str, Any]):
-    print(f"Action: Transitioning patient {patient['id']} to inpatient care.")
+    pass
 
 def update_patient_records(patient: Dict[str, Any]):
-    print(f"Action: Updating patient records for patient {patient['id']}.")
+    pass
 
 def reschedule_admission_date(patient: Dict[str, Any]):
-    print(f"Action: Rescheduling admission date for patient {patient['id']}.")
+    pass
 
 def update_patient_instructions(patient: Dict[str, Any]):
-    print(f"Action: Updating patient instructions for patient {patient['id']}.")
+    pass
 
 def reassess_clinical_requirements(patient: Dict[str, Any]):
-    print(f"Action: Reassessing clinical requirements for patient {patient['id']}.")
+    pass
 
 def follow_up_for_intervention(patient: Dict[str, Any]):
-    print(f"Action: Following up for intervention with patient {patient['id']}.")
+    pass
 
 def revisit_quotation(patient: Dict[str, Any]):
-    print(f"Action: Revisiting quotation for patient {patient['id']}.")
+    pass
 
 def offer_alternate_financial_options(patient: Dict[str, Any]):
-    print(f"Action: Offering alternate financial options to patient {patient['id']}.")
+    pass
 
 def make_final_contact_attempts(patient: Dict[str, Any]):
-    print(f"Action: Making final contact attempts to patient {patient['id']}.")
+    pass
 
 def assess_non_response_reasons(patient: Dict[str, Any]):
-    print(f"Action: Assessing non-response reasons for patient {patient['id']}.")
+    pass
 
 def record_loss_reason(patient: Dict[str, Any]):
-    print(f"Action: Recording loss reason for patient {patient['id']}.")
+    pass
 
 def analyze_for_improvement(patient: Dict[str, Any]):
-    print(f"Action: Analyzing for improvement based on patient {patient['id']} data.")
+    pass
 
 # Mapping of action names to functions
 ACTION_MAPPING = {
@@ -430,133 +445,49 @@ def execute_actions(actions: List[str], patient: Dict[str, Any]):
     for action in actions:
         func = ACTION_MAPPING.get(action)
         if func:
+            started = time.perf_counter()
             func(patient)
+            elapsed = time.perf_counter() - started
+            metrics.observe_stage(metrics.ACTION, elapsed)
+            metrics.inc(metrics.ACTIONS, (action, "succeeded"))
+            events.emit(events.ACTION, patient.get('id'), action=action, outcome="succeeded",
+                        cohort=patient.get('current_cohort'), bucket=patient.get('current_actionable_bucket'),
+                        seconds=round(elapsed, 6))
         else:
-            print(f"Action '{action}' not recognized for patient {patient['id']}.")
-
-# Function to evaluate conditions
-def evaluate_condition(condition: Dict[str, Any], patient: Dict[str, Any]) -> bool:
-    for key, value in condition.items():
-        if isinstance(value, str) and value.startswith(">="):
-            operator, threshold = value.split()
-            try:
-                patient_value = int(patient.get(key, 0))
-                threshold = int(threshold)
-                if operator == ">=" and not (patient_value >= threshold):
-                    return False
-                elif operator == "<=" and not (patient_value <= threshold):
-                    return False
-                else:
-                    return False  # Unsupported operator
-            except ValueError:
-                return False
-        elif isinstance(value, str) and value.startswith("<="):
-            operator, threshold = value.split()
-            try:
-                patient_value = int(patient.get(key, 0))
-                threshold = int(threshold)
-                if operator == "<=" and not (patient_value <= threshold):
-                    return False
-                elif operator == ">=" and not (patient_value >= threshold):
-                    return False
-                else:
-                    return False  # Unsupported operator
-            except ValueError:
-                return False
-        elif key == "follow_up_attempts":
-            if isinstance(value, str) and value.startswith(">="):
-                operator, threshold = value.split()
-                try:
-                    patient_value = int(patient.get(key, 0))
-                    threshold = int(threshold)
-                    if operator == ">=" and not (patient_value >= threshold):
-                        return False
-                except ValueError:
-                    return False
-        elif key == "days_until_admission_between":
-            if isinstance(value, list) and len(value) == 2:
-                lower, upper = value
-                patient_value = patient.get("days_until_admission")
-                if patient_value is None:
-                    return False
-                try:
-                    patient_value = int(patient_value)
-                    lower = int(lower)
-                    upper = int(upper)
-                    if not (lower <= patient_value <= upper):
-                        return False
-                except ValueError:
-                    return False
-        elif key == "scheduled_date_in_past":
-            if value:
-                scheduled_date = patient.get("scheduled_date")
-                if not scheduled_date:
-                    return False
-                try:
-                    scheduled_date_obj = datetime.datetime.strptime(scheduled_date, "%Y-%m-%d").date()
-                    today = datetime.date.today()
-                    if not (scheduled_date_obj < today):
-                        return False
-                except ValueError:
-                    return False
-        elif key == "scheduled_date_in_future":
-            if value:
-                scheduled_date = patient.get("scheduled_date")
-                if not scheduled_date:
-                    return False
-                try:
-                    scheduled_date_obj = datetime.datetime.strptime(scheduled_date, "%Y-%m-%d").date()
-                    today = datetime.date.today()
-                    if not (scheduled_date_obj > today):
-                        return False
-                except ValueError:
-                    return False
-        elif key == "follow_up_date":
-            if value == "today":
-                today = datetime.date.today().strftime('%Y-%m-%d')
-                if patient.get("follow_up_date") != today:
-                    return False
-        elif key == "reason":
-            if patient.get("reason") != value:
-                return False
-        elif key == "status":
-            if patient.get("status") != value:
-                return False
-        elif key == "admission_status":
-            if patient.get("admission_status") != value:
-                return False
-        elif key == "new_scheduled_date_exists":
-            if value and not patient.get("new_scheduled_date"):
-                return False
-            elif not value and patient.get("new_scheduled_date"):
-                return False
-        elif key == "response_received":
-            if patient.get("response_received") != value:
-                return False
-        else:
-            # Generic equality check
-            if patient.get(key) != value:
-                return False
-    return True
+            metrics.inc(metrics.ACTIONS, (action, "unknown"))
+            events.emit(events.ACTION, patient.get('id'), action=action, outcome="unknown",
+                        cohort=patient.get('current_cohort'), bucket=patient.get('current_actionable_bucket'))
+
+# Function to evaluate conditions (one-off; process_patient uses the precompiled rules)
+def evaluate_condition(condition: Dict[str, Any], patient: Dict[str, Any],
+                       context: Optional[EvaluationContext] = None) -> bool:
+    return compile_condition(condition)(patient, context or EvaluationContext())
 
 # Function to move patient to a different actionable bucket
 def move_to_actionable_bucket(patient: Dict[str, Any], target_cohort: str, target_bucket: str):
-    print(f"Moving patient {patient['id']} to cohort {target_cohort} bucket {target_bucket}.")
+    patient['previous_cohort'] = patient.get('current_cohort')
+    patient['previous_bucket'] = patient.get('current_actionable_bucket')
     patient['current_cohort'] = target_cohort
     patient['current_actionable_bucket'] = target_bucket
 
+# Bucket re-engaged patients return to (cohort, bucket) when no previous bucket is known
+DEFAULT_REENGAGE_BUCKET = ("A", "A1")
+
+# Previous (cohort, bucket) of a patient, from the denormalized previous_* fields
+def previous_actionable_bucket(patient: Dict[str, Any]):
+    previous = (patient.get('previous_cohort'), patient.get('previous_bucket'))
+    return previous if all(previous) else DEFAULT_REENGAGE_BUCKET
+
 # Function to move patient to the previous actionable bucket (used in cohort E1)
 def move_to_previous_actionable_bucket(patient: Dict[str, Any]):
-    # This function would need logic to determine the previous bucket.
-    # For simplicity, let's assume it moves back to a specific cohort and bucket.
-    print(f"Re-engaging patient {patient['id']} and moving back to previous actionable bucket.")
-    # Example: moving back to Pre-Admission A1
-    patient['current_cohort'] = "A"
-    patient['current_actionable_bucket'] = "A1"
+    target_cohort, target_bucket = previous_actionable_bucket(patient)
+    patient['previous_cohort'] = patient.get('current_cohort')
+    patient['previous_bucket'] = patient.get('current_actionable_bucket')
+    patient['current_cohort'] = target_cohort
+    patient['current_actionable_bucket'] = target_bucket
 
 # Function to end lead management
 def end_lead_management(patient: Dict[str, Any]):
-    print(f"Ending lead management for patient {patient['id']}.")
     patient['lead_management_active'] = False
 
 # Function to handle disposition actions
@@ -570,10 +501,29 @@ def handle_disposition_action(action: str, patient: Dict[str, Any], rule: Dict[s
     elif action == "end_lead_management":
         end_lead_management(patient)
     else:
-        print(f"Disposition action '{action}' not recognized for patient {patient['id']}.")
+        events.emit(events.ACTION, patient.get('id'), action=action, outcome="unknown",
+                    cohort=patient.get('current_cohort'), bucket=patient.get('current_actionable_bucket'))
 
-# Main processing function
-def process_patient(patient: Dict[str, Any], cohorts: Dict[str, Any]):
+# Record of the bucket move (or end of lead management) a disposition rule made
+def transition_record(patient: Dict[str, Any], rule_name: str, action: str, from_cohort: str, from_bucket: str):
+    return {
+        "patient_id": patient.get('id'),
+        "rule_name": rule_name,
+        "action": action,
+        "from_cohort": from_cohort,
+        "from_bucket": from_bucket,
+        "to_cohort": patient.get('current_cohort'),
+        "to_bucket": patient.get('current_actionable_bucket'),
+    }
+
+# Main processing function. With defer_actions the bucket's actions are not run here but
+# returned as "actions" (with the patient as it was when they were due) for the caller to enqueue.
+# Date conditions are evaluated as of context.as_of (today without a context).
+def process_patient(patient: Dict[str, Any], cohorts: Dict[str, Any], defer_actions: bool = False,
+                    context: Optional[EvaluationContext] = None):
+    started = time.perf_counter()
+    if context is None:
+        context = EvaluationContext()
     messages = []
     current_cohort_key = patient.get("current_cohort")
     current_bucket_key = patient.get("current_actionable_bucket")
@@ -582,47 +532,120 @@ def process_patient(patient: Dict[str, Any], cohorts: Dict[str, Any]):
         messages.append(f"Patient {patient.get('id')} does not have a valid cohort or actionable bucket.")
         return {"messages": messages, "patient_id": patient.get('id')}
 
-    cohort = cohorts.get(current_cohort_key)
-    if not cohort:
+    compiled = get_compiled(cohorts)
+    cohort = compiled.get(current_cohort_key)
+    if cohort is None:
         messages.append(f"Cohort {current_cohort_key} not found for patient {patient.get('id')}.")
         return {"messages": messages, "patient_id": patient.get('id')}
 
-    bucket = cohort["actionable_buckets"].get(current_bucket_key)
-    if not bucket:
+    bucket = cohort.get(current_bucket_key)
+    if bucket is None:
         messages.append(f"Actionable bucket {current_bucket_key} not found in cohort {current_cohort_key} for patient {patient.get('id')}.")
         return {"messages": messages, "patient_id": patient.get('id')}
 
     # Check if patient meets the bucket's criteria
-    if not evaluate_condition(bucket.get("criteria", {}), patient):
+    bucket_labels = (current_cohort_key, current_bucket_key)
+    metrics.inc(metrics.PATIENTS_EVALUATED, bucket_labels)
+    if not bucket.criteria(patient, context):
+        metrics.inc(metrics.CRITERIA_MISMATCH, bucket_labels)
+        metrics.observe_stage(metrics.RULE_EVALUATION, time.perf_counter() - started)
         messages.append(f"Patient {patient['id']} does not meet the criteria for cohort {current_cohort_key} bucket {current_bucket_key}.")
         return {"messages": messages, "patient_id": patient.get('id')}
 
-    # Execute actions
-    execute_actions(bucket.get("actions", []), patient)
-
-    # Evaluate disposition rules
-    disposition_rules = bucket.get("disposition_rules", {})
-    for rule_name, rule in disposition_rules.items():
-        condition = rule.get("condition", {})
-        if evaluate_condition(condition, patient):
-            action = rule.get("action")
-            if action:
-                handle_disposition_action(action, patient, rule)
-            return {"messages": messages, "patient_id": patient.get('id')}  # Exit after handling one rule
+    # Execute actions, or hand them back to the caller (inline actions are timed on their own)
+    deferred = {}
+    if defer_actions:
+        deferred = {"actions": list(bucket.actions), "action_patient": dict(patient)}
+    else:
+        actions_started = time.perf_counter()
+        execute_actions(bucket.actions, patient)
+        started += time.perf_counter() - actions_started
+
+    # Evaluate disposition rules (first match, through the bucket's decision tree)
+    rule = bucket.match(patient, context)
+    if rule is not None:
+        metrics.inc(metrics.RULE_FIRED, (current_cohort_key, current_bucket_key, rule.name))
+        result = {"messages": messages, "patient_id": patient.get('id'), **deferred}
+        if rule.action:
+            handle_disposition_action(rule.action, patient, rule.rule)
+            result["transition"] = transition_record(patient, rule.name, rule.action, current_cohort_key, current_bucket_key)
+        metrics.observe_stage(metrics.RULE_EVALUATION, time.perf_counter() - started)
+        return result  # Exit after handling one rule
 
     # If no disposition rules matched, check for actions to end lead management
-    if disposition_rules.get("lead_management_ends"):
+    transition = None
+    if any(rule.name == "lead_management_ends" for rule in bucket.rules):
+        metrics.inc(metrics.RULE_FIRED, (current_cohort_key, current_bucket_key, "lead_management_ends"))
         handle_disposition_action("end_lead_management", patient, {})
+        transition = transition_record(patient, "lead_management_ends", "end_lead_management", current_cohort_key, current_bucket_key)
 
     # Final messages to include in the response
     messages.append("Lead Management Active: True")
+    metrics.observe_stage(metrics.RULE_EVALUATION, time.perf_counter() - started)
 
     return {
         "messages": messages,
         "patient_id": patient.get('id'),
         "current_cohort": current_cohort_key,  # Reflect the current cohort
         "current_actionable_bucket": current_bucket_key,  # Reflect the current bucket
-        "lead_management_active": True
+        "lead_management_active": True,
+        "transition": transition,
+        **deferred
+    }
+
+
+# Step limit of process_patient_until_stable
+MAX_TRANSITION_STEPS = 10
+
+# Field a bucket's criteria name the patient's status by; set when a chain enters the bucket
+STATUS_FIELD = "status"
+
+# Give a patient the status its new bucket expects, so the bucket can be evaluated right away
+def adopt_bucket_status(patient: Dict[str, Any], cohorts: Dict[str, Any]):
+    bucket = get_compiled(cohorts).get(patient.get('current_cohort'), {}).get(patient.get('current_actionable_bucket'))
+    if bucket is None:
+        return
+    for term in bucket.criteria_terms:
+        if term.key == STATUS_FIELD and term.op == OP_EQ:
+            patient[STATUS_FIELD] = term.operand
+
+# Run process_patient until no rule moves the patient any more. Each bucket entered
+# gets the status its criteria expect and is evaluated in the same call, so data that
+# already satisfies the next bucket's rules does not need another request. Stops when
+# no rule fires, lead management ends, a bucket would be entered a second time
+# (cycle), or after max_steps moves. Returns the step results of process_patient in
+# "steps", the visited [cohort, bucket] pairs in "path" and why it stopped in "stopped".
+def process_patient_until_stable(patient: Dict[str, Any], cohorts: Dict[str, Any], defer_actions: bool = False,
+                                 max_steps: int = MAX_TRANSITION_STEPS, context: Optional[EvaluationContext] = None):
+    if context is None:
+        context = EvaluationContext()
+    position = (patient.get('current_cohort'), patient.get('current_actionable_bucket'))
+    path = [position]
+    steps = []
+    stopped = "stable"
+    while True:
+        result = process_patient(patient, cohorts, defer_actions, context)
+        steps.append(result)
+        transition = result.get("transition")
+        if not transition or patient.get('lead_management_active', True) is False:
+            stopped = "ended" if transition else "stable"
+            break
+        position = (transition["to_cohort"], transition["to_bucket"])
+        path.append(position)
+        if position in path[:-1]:
+            stopped = "cycle"
+            break
+        if len(steps) >= max_steps:
+            stopped = "step_limit"
+            break
+        adopt_bucket_status(patient, cohorts)
+
+    return {
+        "messages": [message for step in steps for message in step["messages"]],
+        "patient_id": patient.get('id'),
+        "path": [list(position) for position in path],
+        "stopped": stopped,
+        "steps": steps,
     }
 
 
@@ -0,0 +1,111 @@
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+
+import django
+from django.db import connections
+
+from .models import Patient
+from .rules import EvaluationContext
+from .rulesets import Rules, current_rules
+from .services import BULK_BATCH_SIZE, sweep_chunk
+
+# Re-evaluation of every active patient across worker processes (manage.py process_all),
+# e.g. after a rule change; one process tops out at a single core.
+#
+# The active patients are split into id ranges of about equal size, a few per worker
+# so one slow range does not leave the other workers idle. A worker reads its range in
+# keyset chunks and writes each chunk back with one bulk upsert, like the due sweep,
+# so patients written by someone else meanwhile are re-read and evaluated again. The
+# parent merges the stats of each range as it finishes.
+#
+# Workers only overlap on the database's write lock, which WAL mode holds for no
+# longer than one chunk's commit.
+
+SHARDS_PER_WORKER = 4
+
+STAT_KEYS = ("processed", "moved", "ended", "conflicts")
+
+# (after_id, last_id): the ids greater than after_id, up to and including last_id;
+# None leaves that end open
+Shard = Tuple[Optional[str], Optional[str]]
+
+
+def empty_stats() -> Dict[str, int]:
+    return dict.fromkeys(STAT_KEYS, 0)
+
+
+def active_patients():
+    return Patient.objects.filter(lead_management_active=True)
+
+
+# Split the active patients into at most `count` id ranges of about equal size
+def shard_ranges(count: int) -> List[Shard]:
+    ids = active_patients().order_by('id').values_list('id', flat=True)
+    total = ids.count()
+    count = max(1, min(count, total))
+    bounds = [None] + [ids[total * index // count - 1] for index in range(1, count)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def shard_patients(shard: Shard):
+    after_id, last_id = shard
+    patients = active_patients()
+    if after_id is not None:
+        patients = patients.filter(id__gt=after_id)
+    if last_id is not None:
+        patients = patients.filter(id__lte=last_id)
+    return patients
+
+
+# Evaluate and write back every active patient of one id range
+def process_shard(shard: Shard, as_of: datetime.date, rules: Rules, chunk_size: int = BULK_BATCH_SIZE,
+                  chain: bool = False) -> Dict[str, int]:
+    context = EvaluationContext(as_of)
+    patients = shard_patients(shard)
+    stats = empty_stats()
+    page = patients
+    while True:
+        chunk = list(page.order_by('id')[:chunk_size])
+        if not chunk:
+            break
+        page = patients.filter(id__gt=chunk[-1].pk)
+        sweep_chunk(chunk, patients, context, rules, chain, stats)
+    return stats
+
+
+# Worker processes open their own database connections
+def _init_worker():
+    django.setup()
+    connections.close_all()
+
+
+# Re-evaluate every active patient as of `as_of` with `workers` processes (1 runs in
+# this process). progress(stats, shards_done, shard_count) is called with the merged
+# stats after each range. The rules are resolved once here, so every worker evaluates
+# with the same version.
+def process_all(as_of: datetime.date, workers: int = 1, chunk_size: int = BULK_BATCH_SIZE,
+                chain: bool = False, rules: Optional[Rules] = None,
+                progress: Optional[Callable[[Dict[str, int], int, int], None]] = None) -> Dict[str, int]:
+    rules = rules or current_rules()
+    shards = shard_ranges(workers * SHARDS_PER_WORKER if workers > 1 else 1)
+    stats = empty_stats()
+
+    def merge(shard_stats: Dict[str, int], done: int):
+        for key in STAT_KEYS:
+            stats[key] += shard_stats[key]
+        if progress is not None:
+            progress(dict(stats), done, len(shards))
+
+    if workers <= 1:
+        for done, shard in enumerate(shards, 1):
+            merge(process_shard(shard, as_of, rules, chunk_size, chain), done)
+        return stats
+
+    # A forked worker must not share this process's SQLite handle
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = [pool.submit(process_shard, shard, as_of, rules, chunk_size, chain) for shard in shards]
+        for done, future in enumerate(as_completed(futures), 1):
+            merge(future.result(), done)
+    return stats
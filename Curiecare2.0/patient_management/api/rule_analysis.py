@@ -0,0 +1,127 @@
+import math
+from typing import List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from .rules import (OP_BETWEEN, OP_DATE_FUTURE, OP_DATE_PAST, OP_EQ, OP_EXISTS, OP_GE, OP_LE, OP_NEVER,
+                    CompiledBucket, CompiledRule, Term, iter_buckets)
+
+# Static checks of compiled rules (manage.py rules check).
+#
+# Disposition rules fire first-match, and only for patients meeting their bucket's
+# criteria, so a rule can be dead in two ways:
+#   unreachable: its condition contradicts itself or the bucket criteria
+#                (B1's scheduled_date_in_past against the criteria's scheduled_date_in_future)
+#   shadowed:    an earlier rule of the bucket matches every patient it matches
+#                (A1's if_both_needed after if_clinical_intervention_needed)
+# Both checks are conservative: a reported rule never fires, but not every rule that
+# never fires is reported.
+
+UNREACHABLE = "unreachable"
+SHADOWED = "shadowed"
+
+
+class Finding(NamedTuple):
+    cohort: str
+    bucket: str
+    rule: str
+    kind: str
+    detail: str
+
+    def __str__(self):
+        return f"{self.cohort}.{self.bucket} {self.rule}: {self.kind} ({self.detail})"
+
+
+def describe(term: Term) -> str:
+    if term.op in (OP_DATE_PAST, OP_DATE_FUTURE):
+        return term.key
+    return f"{term.key}={term.operand!r}"
+
+
+# Numeric range the terms allow for `field`; GE/LE read a missing value as 0, BETWEEN
+# needs the value to be present (the third item)
+def bounds(terms: Sequence[Term], field: str) -> Tuple[float, float, bool]:
+    lower, upper, present = -math.inf, math.inf, False
+    for term in terms:
+        if term.op == OP_GE and term.key == field:
+            lower = max(lower, term.operand)
+        elif term.op == OP_LE and term.key == field:
+            upper = min(upper, term.operand)
+        elif term.op == OP_BETWEEN and term.source == field:
+            lower = max(lower, term.operand[0])
+            upper = min(upper, term.operand[1])
+            present = True
+    return lower, upper, present
+
+
+# Why no patient can satisfy all the terms, None when no contradiction is found
+def contradiction(terms: Sequence[Term]) -> Optional[str]:
+    for term in terms:
+        if term.op == OP_NEVER:
+            return f"malformed condition {describe(term)}"
+    for index, term in enumerate(terms):
+        for other in terms[index + 1:]:
+            if term.source != other.source:
+                continue
+            ops = {term.op, other.op}
+            if term.op == other.op == OP_EQ and term.operand != other.operand:
+                return f"{describe(term)} and {describe(other)}"
+            if ops == {OP_DATE_PAST, OP_DATE_FUTURE}:
+                return f"{describe(term)} and {describe(other)}"
+            if term.op == other.op == OP_EXISTS and term.operand != other.operand:
+                return f"{describe(term)} and {describe(other)}"
+            # A date to compare with is a value that exists
+            if OP_EXISTS in ops and ops & {OP_DATE_PAST, OP_DATE_FUTURE}:
+                exists = term if term.op == OP_EXISTS else other
+                if not exists.operand:
+                    return f"{describe(term)} and {describe(other)}"
+    for field in {term.source for term in terms if term.op in (OP_GE, OP_LE, OP_BETWEEN)}:
+        lower, upper, _ = bounds(terms, field)
+        if lower > upper:
+            return f"{field} cannot be both >= {lower} and <= {upper}"
+    return None
+
+
+# Whether every patient satisfying `terms` satisfies `term`
+def implies(terms: Sequence[Term], term: Term) -> bool:
+    if term in terms:
+        return True
+    if term.op == OP_EQ:
+        return any(other.op == OP_EQ and other.key == term.key and other.operand == term.operand
+                   for other in terms)
+    if term.op in (OP_GE, OP_LE, OP_BETWEEN):
+        lower, upper, present = bounds(terms, term.source)
+        if term.op == OP_GE:
+            return lower >= term.operand
+        if term.op == OP_LE:
+            return upper <= term.operand
+        return present and lower >= term.operand[0] and upper <= term.operand[1]
+    if term.op == OP_EXISTS and term.operand:
+        return any(other.source == term.source and other.op in (OP_DATE_PAST, OP_DATE_FUTURE)
+                   for other in terms)
+    return False
+
+
+def bucket_findings(bucket: CompiledBucket) -> List[Finding]:
+    findings = []
+    reachable: List[CompiledRule] = []
+    for rule in bucket.rules:
+        terms = rule.terms + bucket.criteria_terms
+        reason = contradiction(rule.terms)
+        if reason is None:
+            reason = contradiction(terms)
+            if reason is not None:
+                reason += ", with the bucket criteria"
+        if reason is not None:
+            findings.append(Finding(bucket.cohort, bucket.bucket, rule.name, UNREACHABLE, reason))
+            continue
+        for earlier in reachable:
+            if all(implies(terms, term) for term in earlier.terms):
+                findings.append(Finding(bucket.cohort, bucket.bucket, rule.name, SHADOWED,
+                                        f"{earlier.name} matches first"))
+                break
+        else:
+            reachable.append(rule)
+    return findings
+
+
+def rule_findings(compiled: Mapping[str, Mapping[str, CompiledBucket]]) -> List[Finding]:
+    return [finding for bucket in iter_buckets(compiled) for finding in bucket_findings(bucket)]
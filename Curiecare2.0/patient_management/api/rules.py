@@ -0,0 +1,358 @@
+import datetime
+from collections import Counter
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+# Compiled form of the COHORTS rule tree.
+#
+# Conditions are parsed once into Terms (key, op, operand) and every Term is
+# turned into a small closure, so evaluating a patient never re-walks the
+# if/elif chain or re-parses strings like ">= 5".
+#
+# Predicates take the patient and an EvaluationContext, which pins the date "today"
+# means for a whole request, sweep or import batch and parses each date string once.
+#
+# Each bucket's disposition rules are also arranged into a decision tree over the
+# equality terms they share (clinical_intervention_required, status, ...): one dict
+# lookup per tested field selects the few rules the patient can still match, which
+# are then checked in their original order, so the first matching rule still wins.
+
+Predicate = Callable[[Dict[str, Any], 'EvaluationContext'], bool]
+
+# Term operators
+OP_EQ = "eq"                    # patient.get(key) == operand
+OP_GE = "ge"                    # int(patient.get(key, 0)) >= operand
+OP_LE = "le"                    # int(patient.get(key, 0)) <= operand
+OP_BETWEEN = "between"          # operand[0] <= int(patient[source]) <= operand[1]
+OP_DATE_PAST = "date_past"      # patient[source] as a date is before the as-of date
+OP_DATE_FUTURE = "date_future"  # patient[source] as a date is after the as-of date
+OP_TODAY = "today"              # patient[key] as a date is the as-of date
+OP_EXISTS = "exists"            # bool(patient.get(source)) == operand
+OP_NEVER = "never"              # malformed condition, never matches
+
+DATE_FORMAT = "%Y-%m-%d"
+
+# Distinct date strings an EvaluationContext keeps parsed
+MAX_PARSED_DATES = 10000
+
+
+class Term(NamedTuple):
+    key: str
+    op: str
+    operand: Any
+    source: str  # patient field actually read
+
+
+class CompiledRule(NamedTuple):
+    name: str
+    terms: Tuple[Term, ...]
+    predicate: Predicate
+    action: Optional[str]
+    target_cohort: Optional[str]
+    target_bucket: Optional[str]
+    rule: Mapping[str, Any]
+
+
+# A rule as it is left in a decision tree leaf: the terms not decided by the branches
+class LeafRule(NamedTuple):
+    rule: CompiledRule
+    terms: Tuple[Term, ...]
+    predicate: Predicate
+
+
+# Inner nodes branch on patient.get(field); leaves (field None) hold candidate rules
+class DecisionNode(NamedTuple):
+    field: Optional[str]
+    branches: Mapping[Any, 'DecisionNode']
+    default: Optional['DecisionNode']   # patients whose value has no branch
+    rules: Tuple[LeafRule, ...]
+
+
+class CompiledBucket(NamedTuple):
+    cohort: str
+    bucket: str
+    name: str
+    criteria_terms: Tuple[Term, ...]
+    criteria: Predicate
+    actions: Tuple[str, ...]
+    rules: Tuple[CompiledRule, ...]
+    decisions: DecisionNode
+
+    # First disposition rule the patient matches, None if none does
+    def match(self, patient: Dict[str, Any], context: 'EvaluationContext') -> Optional[CompiledRule]:
+        node = self.decisions
+        while node.field is not None:
+            try:
+                node = node.branches.get(patient.get(node.field), node.default)
+            except TypeError:  # unhashable values equal no operand
+                node = node.default
+        for leaf in node.rules:
+            if leaf.predicate(patient, context):
+                return leaf.rule
+        return None
+
+
+# Parse a single condition entry. ">= N"/"<= N" thresholds are applied as written,
+# unlike the old evaluator, which never matched them; a malformed threshold never matches.
+def parse_term(key: str, value: Any) -> Optional[Term]:
+    if isinstance(value, str) and (value.startswith(">=") or value.startswith("<=")):
+        try:
+            operator, threshold = value.split()
+            threshold = int(threshold)
+        except ValueError:
+            return Term(key, OP_NEVER, value, key)
+        if operator == ">=":
+            return Term(key, OP_GE, threshold, key)
+        if operator == "<=":
+            return Term(key, OP_LE, threshold, key)
+        return Term(key, OP_NEVER, value, key)
+    if key == "follow_up_attempts":
+        # Only threshold comparisons are meaningful for follow-up attempts
+        return None
+    if key == "days_until_admission_between":
+        if not (isinstance(value, list) and len(value) == 2):
+            return None
+        try:
+            bounds = (int(value[0]), int(value[1]))
+        except (TypeError, ValueError):
+            return Term(key, OP_NEVER, value, "days_until_admission")
+        return Term(key, OP_BETWEEN, bounds, "days_until_admission")
+    if key == "scheduled_date_in_past":
+        return Term(key, OP_DATE_PAST, None, "scheduled_date") if value else None
+    if key == "scheduled_date_in_future":
+        return Term(key, OP_DATE_FUTURE, None, "scheduled_date") if value else None
+    if key == "follow_up_date":
+        return Term(key, OP_TODAY, None, key) if value == "today" else None
+    if key == "new_scheduled_date_exists":
+        return Term(key, OP_EXISTS, bool(value), "new_scheduled_date")
+    # status, reason, admission_status, response_received and any other key
+    return Term(key, OP_EQ, value, key)
+
+
+def parse_condition(condition: Mapping[str, Any]) -> Tuple[Term, ...]:
+    terms = []
+    for key, value in condition.items():
+        term = parse_term(key, value)
+        if term is not None:
+            terms.append(term)
+    return tuple(terms)
+
+
+# Stored patients carry dates (DateField columns), posted payloads may carry strings
+def parse_date(value: Any) -> Optional[datetime.date]:
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(value, DATE_FORMAT).date()
+    except (TypeError, ValueError):
+        return None
+
+
+# State shared by the evaluations of one request, sweep or import batch: the date
+# the date terms compare with (today unless given) and the dates parsed so far
+class EvaluationContext:
+    __slots__ = ('as_of', '_dates')
+
+    def __init__(self, as_of: Optional[datetime.date] = None):
+        self.as_of = as_of or datetime.date.today()
+        self._dates: Dict[str, Optional[datetime.date]] = {}
+
+    def date(self, value: Any) -> Optional[datetime.date]:
+        if value is None or type(value) is datetime.date:
+            return value
+        if type(value) is not str:
+            return parse_date(value)
+        try:
+            return self._dates[value]
+        except KeyError:
+            if len(self._dates) >= MAX_PARSED_DATES:
+                self._dates.clear()
+            parsed = self._dates[value] = parse_date(value)
+            return parsed
+
+
+# Turn a parsed term into a predicate closure
+def compile_term(term: Term) -> Predicate:
+    key, op, operand, source = term
+
+    if op == OP_EQ:
+        def predicate(patient, context):
+            return patient.get(key) == operand
+    elif op == OP_GE:
+        def predicate(patient, context):
+            try:
+                return int(patient.get(key, 0)) >= operand
+            except (TypeError, ValueError):
+                return False
+    elif op == OP_LE:
+        def predicate(patient, context):
+            try:
+                return int(patient.get(key, 0)) <= operand
+            except (TypeError, ValueError):
+                return False
+    elif op == OP_BETWEEN:
+        lower, upper = operand
+
+        def predicate(patient, context):
+            value = patient.get(source)
+            if value is None:
+                return False
+            try:
+                return lower <= int(value) <= upper
+            except (TypeError, ValueError):
+                return False
+    elif op == OP_DATE_PAST:
+        def predicate(patient, context):
+            scheduled = context.date(patient.get(source))
+            return scheduled is not None and scheduled < context.as_of
+    elif op == OP_DATE_FUTURE:
+        def predicate(patient, context):
+            scheduled = context.date(patient.get(source))
+            return scheduled is not None and scheduled > context.as_of
+    elif op == OP_TODAY:
+        def predicate(patient, context):
+            return context.date(patient.get(key)) == context.as_of
+    elif op == OP_EXISTS:
+        def predicate(patient, context):
+            return bool(patient.get(source)) == operand
+    else:
+        def predicate(patient, context):
+            return False
+    return predicate
+
+
+def _always(patient: Dict[str, Any], context: EvaluationContext) -> bool:
+    return True
+
+
+# Combine the term closures of a condition into a single predicate
+def compile_terms(terms: Tuple[Term, ...]) -> Predicate:
+    predicates = tuple(compile_term(term) for term in terms)
+    if not predicates:
+        return _always
+    if len(predicates) == 1:
+        return predicates[0]
+    if len(predicates) == 2:
+        first, second = predicates
+        return lambda patient, context: first(patient, context) and second(patient, context)
+
+    def predicate(patient, context):
+        for check in predicates:
+            if not check(patient, context):
+                return False
+        return True
+    return predicate
+
+
+def compile_condition(condition: Mapping[str, Any]) -> Predicate:
+    return compile_terms(parse_condition(condition))
+
+
+# Equality terms with a hashable operand can be decided by a dict lookup; hash and ==
+# agree for those (True, 1 and 1.0 are one key), so the lookup keeps == semantics
+def is_discriminating(term: Term) -> bool:
+    if term.op != OP_EQ:
+        return False
+    try:
+        hash(term.operand)
+    except TypeError:
+        return False
+    return True
+
+
+# Branch on the field most rules test for equality, splitting the rules (kept in
+# order) by the value they require; rules not testing the field go down every branch.
+# Recurses until no equality terms are left.
+def build_decisions(entries: List[Tuple[CompiledRule, Tuple[Term, ...]]]) -> DecisionNode:
+    fields = Counter(term.key for _, terms in entries for term in terms if is_discriminating(term))
+    if not fields:
+        return DecisionNode(None, MappingProxyType({}), None, tuple(
+            LeafRule(rule, terms, compile_terms(terms)) for rule, terms in entries
+        ))
+    field = max(fields, key=fields.get)  # ties: the field seen first
+
+    def split(entry):
+        rule, terms = entry
+        for term in terms:
+            if term.key == field and is_discriminating(term):
+                return term, tuple(other for other in terms if other is not term)
+        return None, terms
+
+    splits = [(rule, *split((rule, terms))) for rule, terms in entries]
+    values = {}
+    for _, term, _ in splits:
+        if term is not None:
+            values.setdefault(term.operand, None)
+    branches = {
+        value: build_decisions([(rule, rest) for rule, term, rest in splits
+                                if term is None or term.operand == value])
+        for value in values
+    }
+    default = build_decisions([(rule, rest) for rule, term, rest in splits if term is None])
+    return DecisionNode(field, MappingProxyType(branches), default, ())
+
+
+def compile_bucket(cohort_key: str, bucket_key: str, bucket: Mapping[str, Any]) -> CompiledBucket:
+    rules = []
+    for rule_name, rule in bucket.get("disposition_rules", {}).items():
+        terms = parse_condition(rule.get("condition", {}))
+        rules.append(CompiledRule(
+            name=rule_name,
+            terms=terms,
+            predicate=compile_terms(terms),
+            action=rule.get("action"),
+            target_cohort=rule.get("target_cohort"),
+            target_bucket=rule.get("target_actionable_bucket"),
+            rule=MappingProxyType(dict(rule)),
+        ))
+    criteria_terms = parse_condition(bucket.get("criteria", {}))
+    return CompiledBucket(
+        cohort=cohort_key,
+        bucket=bucket_key,
+        name=bucket.get("name", bucket_key),
+        criteria_terms=criteria_terms,
+        criteria=compile_terms(criteria_terms),
+        actions=tuple(bucket.get("actions", [])),
+        rules=tuple(rules),
+        decisions=build_decisions([(rule, rule.terms) for rule in rules]),
+    )
+
+
+# Compile the whole cohort tree into {cohort: {bucket: CompiledBucket}} (read-only)
+def compile_cohorts(cohorts: Mapping[str, Any]) -> Mapping[str, Mapping[str, CompiledBucket]]:
+    compiled = {}
+    for cohort_key, cohort in cohorts.items():
+        buckets = {
+            bucket_key: compile_bucket(cohort_key, bucket_key, bucket)
+            for bucket_key, bucket in cohort.get("actionable_buckets", {}).items()
+        }
+        compiled[cohort_key] = MappingProxyType(buckets)
+    return MappingProxyType(compiled)
+
+
+# Compiled trees are cached per cohorts object; call invalidate() after mutating one
+_compiled_cache: Dict[int, Tuple[Mapping[str, Any], Mapping[str, Mapping[str, CompiledBucket]]]] = {}
+
+
+def get_compiled(cohorts: Mapping[str, Any]) -> Mapping[str, Mapping[str, CompiledBucket]]:
+    entry = _compiled_cache.get(id(cohorts))
+    if entry is not None and entry[0] is cohorts:
+        return entry[1]
+    compiled = compile_cohorts(cohorts)
+    _compiled_cache[id(cohorts)] = (cohorts, compiled)
+    return compiled
+
+
+def invalidate(cohorts: Optional[Mapping[str, Any]] = None):
+    if cohorts is None:
+        _compiled_cache.clear()
+    else:
+        _compiled_cache.pop(id(cohorts), None)
+
+
+def iter_buckets(compiled: Mapping[str, Mapping[str, CompiledBucket]]) -> List[CompiledBucket]:
+    return [bucket for buckets in compiled.values() for bucket in buckets.values()]
@@ -0,0 +1,237 @@
+import copy
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import Max
+
+from .models import RuleSet
+from .patient_data import ACTION_MAPPING, CONFIG, COHORTS, build_cohorts
+from .rules import get_compiled, invalidate
+
+logger = logging.getLogger(__name__)
+
+# Versioned, hot-reloadable rule sets.
+#
+# A rule document is {"config": {"Y": 5, ...}, "cohorts": {...}}, cohorts having the
+# shape of patient_data.COHORTS. Strings in cohorts may refer to config values:
+# ">= {Y}" becomes ">= 5" and a bare "{Z}" becomes the value itself, so thresholds
+# change without editing the rules. Documents are stored as RuleSet rows, or read
+# from the JSON file named by settings.RULES_FILE. Each version is resolved and
+# compiled once; the process-wide current rules are replaced by a single reference
+# assignment when another version becomes active, so requests never see a
+# half-loaded rule set. Version 0 is the built-in COHORTS.
+
+BUILTIN_VERSION = 0
+DEFAULT_POLL_INTERVAL = 5.0  # seconds between checks for a newly activated version
+
+DISPOSITION_ACTIONS = frozenset(["move_to_actionable_bucket", "move_to_previous_actionable_bucket",
+                                 "end_lead_management"])
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+class Rules(NamedTuple):
+    version: int
+    config: Mapping[str, Any]
+    cohorts: Dict[str, Any]
+
+
+BUILTIN_RULES = Rules(BUILTIN_VERSION, CONFIG, COHORTS)
+
+
+# Substitute {NAME} references to config values
+def resolve_placeholders(value: Any, config: Mapping[str, Any]) -> Any:
+    if isinstance(value, str):
+        try:
+            whole = PLACEHOLDER.fullmatch(value)
+            if whole:
+                return config[whole.group(1)]
+            return PLACEHOLDER.sub(lambda match: str(config[match.group(1)]), value)
+        except KeyError as exc:
+            raise ValueError(f"Unknown config value {exc} in '{value}'.")
+    if isinstance(value, dict):
+        return {key: resolve_placeholders(item, config) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_placeholders(item, config) for item in value]
+    return value
+
+
+# Structural problems of a resolved cohorts tree, empty if it is usable
+def cohort_errors(cohorts: Any) -> List[str]:
+    if not isinstance(cohorts, dict) or not cohorts:
+        return ["cohorts must be a non-empty object"]
+    errors = []
+    buckets = {(cohort_key, bucket_key) for cohort_key, cohort in cohorts.items() if isinstance(cohort, dict)
+               for bucket_key in (cohort.get("actionable_buckets") or {})}
+    for cohort_key, cohort in cohorts.items():
+        if not isinstance(cohort, dict) or not isinstance(cohort.get("actionable_buckets"), dict):
+            errors.append(f"{cohort_key}: actionable_buckets must be an object")
+            continue
+        for bucket_key, bucket in cohort["actionable_buckets"].items():
+            where = f"{cohort_key}.{bucket_key}"
+            if not isinstance(bucket, dict):
+                errors.append(f"{where}: bucket must be an object")
+                continue
+            if not isinstance(bucket.get("criteria", {}), dict):
+                errors.append(f"{where}: criteria must be an object")
+            for action in bucket.get("actions", []):
+                if action not in ACTION_MAPPING:
+                    errors.append(f"{where}: unknown action '{action}'")
+            rules = bucket.get("disposition_rules", {})
+            if not isinstance(rules, dict):
+                errors.append(f"{where}: disposition_rules must be an object")
+                continue
+            for rule_name, rule in rules.items():
+                if not isinstance(rule, dict) or not isinstance(rule.get("condition", {}), dict):
+                    errors.append(f"{where}.{rule_name}: condition must be an object")
+                    continue
+                action = rule.get("action")
+                if action is not None and action not in DISPOSITION_ACTIONS:
+                    errors.append(f"{where}.{rule_name}: unknown disposition action '{action}'")
+                if action == "move_to_actionable_bucket" and \
+                        (rule.get("target_cohort"), rule.get("target_actionable_bucket")) not in buckets:
+                    errors.append(f"{where}.{rule_name}: target bucket "
+                                  f"{rule.get('target_cohort')}.{rule.get('target_actionable_bucket')} does not exist")
+    return errors
+
+
+# Resolve, check and compile a rule document; raises ValueError if it is unusable
+def build_rules(version: int, document: Mapping[str, Any]) -> Rules:
+    if not isinstance(document, dict):
+        raise ValueError("A rule document must be an object.")
+    config = document.get("config") or {}
+    if not isinstance(config, dict):
+        raise ValueError("config must be an object.")
+    cohorts = resolve_placeholders(document.get("cohorts"), config)
+    errors = cohort_errors(cohorts)
+    if errors:
+        raise ValueError("Invalid rule document: " + "; ".join(errors))
+    get_compiled(cohorts)
+    return Rules(version, config, cohorts)
+
+
+# Rules of a stored version (0: the built-in rules) with some config values replaced.
+# The built-in rules take the CONFIG keys; a stored document's config only affects
+# the rules through its {NAME} placeholders.
+def load_version(version: int, config: Optional[Mapping[str, Any]] = None) -> Rules:
+    config = config or {}
+    if version == BUILTIN_VERSION:
+        unknown = sorted(set(config) - set(CONFIG))
+        if unknown:
+            raise ValueError(f"Unknown config value(s) {', '.join(unknown)}; the built-in rules use "
+                             f"{', '.join(CONFIG)}.")
+        if not config:
+            return BUILTIN_RULES
+        merged = {**CONFIG, **config}
+        return Rules(BUILTIN_VERSION, merged, build_cohorts(merged))
+    document = RuleSet.objects.get(version=version).document
+    if config:
+        document = {**document, "config": {**(document.get("config") or {}), **config}}
+    return build_rules(version, document)
+
+
+def builtin_document() -> Dict[str, Any]:
+    return {"config": dict(CONFIG), "cohorts": copy.deepcopy(COHORTS)}
+
+
+def poll_interval() -> float:
+    return getattr(settings, "RULES_POLL_INTERVAL", DEFAULT_POLL_INTERVAL)
+
+
+_lock = threading.Lock()
+_current = BUILTIN_RULES
+_checked_at: Optional[float] = None
+_file_mtime: Optional[float] = None
+
+
+def _load_file(path: str) -> Rules:
+    global _file_mtime
+    mtime = os.stat(path).st_mtime
+    if mtime == _file_mtime:
+        return _current
+    with open(path) as rules_file:
+        document = json.load(rules_file)
+    version = document.get("version") if isinstance(document, dict) else None
+    if not isinstance(version, int) or version <= BUILTIN_VERSION:
+        raise ValueError(f"{path}: a rule file needs a positive integer 'version'.")
+    rules = _current if version == _current.version else build_rules(version, document)
+    _file_mtime = mtime
+    return rules
+
+
+def _load_active() -> Rules:
+    path = getattr(settings, "RULES_FILE", None)
+    if path:
+        return _load_file(path)
+    version = RuleSet.objects.filter(is_active=True).values_list('version', flat=True).first()
+    if version is None:
+        return BUILTIN_RULES
+    if version == _current.version:
+        return _current
+    return build_rules(version, RuleSet.objects.get(version=version).document)
+
+
+# Check the active version now and swap it in if it changed. On errors the
+# current rules stay in place.
+def refresh() -> Rules:
+    global _current, _checked_at
+    with _lock:
+        _checked_at = time.monotonic()
+        try:
+            rules = _load_active()
+        except (DatabaseError, OSError, ValueError, RuleSet.DoesNotExist):
+            logger.exception("Could not load the active rule set, keeping version %s.", _current.version)
+            return _current
+        if rules is not _current:
+            previous, _current = _current, rules
+            if previous is not BUILTIN_RULES:
+                invalidate(previous.cohorts)
+            logger.info("Rule set version %s is now active.", rules.version)
+        return _current
+
+
+def _refresh_due() -> bool:
+    return _checked_at is None or time.monotonic() - _checked_at >= poll_interval()
+
+
+# Rules to evaluate with; checks for a newly activated version at most every poll interval
+def current_rules() -> Rules:
+    if _refresh_due():
+        return refresh()
+    return _current
+
+
+async def acurrent_rules() -> Rules:
+    if _refresh_due():
+        return await sync_to_async(refresh)()
+    return _current
+
+
+# Store a document as the next version (checked first); optionally make it active
+def create_ruleset(document: Mapping[str, Any], description: str = '', activate: bool = False) -> RuleSet:
+    with transaction.atomic():
+        version = (RuleSet.objects.aggregate(latest=Max('version'))['latest'] or BUILTIN_VERSION) + 1
+        build_rules(version, document)
+        ruleset = RuleSet.objects.create(version=version, document=document, description=description)
+        if activate:
+            activate_version(version)
+            ruleset.is_active = True
+    return ruleset
+
+
+# Make a stored version active; version 0 falls back to the built-in rules.
+# Running processes switch at their next poll.
+def activate_version(version: int):
+    with transaction.atomic():
+        if version != BUILTIN_VERSION:
+            build_rules(version, RuleSet.objects.get(version=version).document)
+        RuleSet.objects.filter(is_active=True).update(is_active=False)
+        if version != BUILTIN_VERSION:
+            RuleSet.objects.filter(version=version).update(is_active=True)
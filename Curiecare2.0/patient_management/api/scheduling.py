@@ -0,0 +1,106 @@
+import datetime
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from .patient_data import COHORTS
+from .rules import (
+    OP_BETWEEN, OP_DATE_FUTURE, OP_DATE_PAST, OP_GE, OP_LE, OP_TODAY,
+    CompiledBucket, EvaluationContext, Predicate, Term, compile_term, get_compiled,
+)
+
+# "Next due date" of a patient: the earliest day on which one of its current
+# bucket's disposition rules can start to match purely because time passes.
+#
+# Only these inputs change with the calendar; every other field changes only
+# when a client posts the patient again, which recomputes the due date.
+DAYS_SINCE_LAST_CONTACT = "days_since_last_contact"  # grows by one per day
+DAYS_UNTIL_ADMISSION = "days_until_admission"        # shrinks by one per day when scheduled_date is known
+SCHEDULED_DATE = "scheduled_date"
+FOLLOW_UP_DATE = "follow_up_date"
+
+TIME_SOURCES = frozenset([DAYS_SINCE_LAST_CONTACT, DAYS_UNTIL_ADMISSION, SCHEDULED_DATE, FOLLOW_UP_DATE])
+
+
+def is_time_term(term: Term) -> bool:
+    return term.source in TIME_SOURCES and term.op in (
+        OP_GE, OP_LE, OP_BETWEEN, OP_DATE_PAST, OP_DATE_FUTURE, OP_TODAY)
+
+
+_term_predicates: Dict[Term, Predicate] = {}
+
+
+def holds(term: Term, record: Mapping[str, Any], context: EvaluationContext) -> bool:
+    try:
+        predicate = _term_predicates.get(term)
+    except TypeError:  # unhashable operand
+        return compile_term(term)(record, context)
+    if predicate is None:
+        predicate = _term_predicates[term] = compile_term(term)
+    return predicate(record, context)
+
+
+# Day (>= context.as_of) from which a time term holds, or None if it never will
+def term_due_date(term: Term, record: Mapping[str, Any], context: EvaluationContext) -> Optional[datetime.date]:
+    as_of = context.as_of
+    if term.op in (OP_DATE_PAST, OP_DATE_FUTURE, OP_TODAY):
+        day = context.date(record.get(term.source))
+        if day is None:
+            return None
+        if term.op == OP_DATE_PAST:
+            return max(day + datetime.timedelta(days=1), as_of)
+        if term.op == OP_DATE_FUTURE:
+            return as_of if day > as_of else None
+        return day if day >= as_of else None
+
+    if holds(term, record, context):
+        return as_of
+    try:
+        value = int(record.get(term.source))
+    except (TypeError, ValueError):
+        return None
+    if term.source == DAYS_SINCE_LAST_CONTACT and term.op == OP_GE:
+        return as_of + datetime.timedelta(days=term.operand - value)
+    if term.source == DAYS_UNTIL_ADMISSION and context.date(record.get(SCHEDULED_DATE)) is not None:
+        upper = term.operand[1] if term.op == OP_BETWEEN else term.operand
+        if term.op != OP_GE and value > upper:
+            return as_of + datetime.timedelta(days=value - upper)
+    return None
+
+
+# Day (>= context.as_of) from which all terms of a condition hold, or None
+def condition_due_date(terms: Tuple[Term, ...], record: Mapping[str, Any],
+                       context: EvaluationContext) -> Optional[datetime.date]:
+    due = context.as_of
+    for term in terms:
+        if is_time_term(term):
+            term_due = term_due_date(term, record, context)
+            if term_due is None:
+                return None
+            due = max(due, term_due)
+        elif not holds(term, record, context):
+            return None
+    return due
+
+
+def bucket_due_date(bucket: CompiledBucket, record: Mapping[str, Any],
+                    context: EvaluationContext) -> Optional[datetime.date]:
+    criteria_due = condition_due_date(bucket.criteria_terms, record, context)
+    if criteria_due is None:
+        return None
+    due = None
+    for rule in bucket.rules:
+        rule_due = condition_due_date(rule.terms, record, context)
+        if rule_due is not None:
+            rule_due = max(rule_due, criteria_due)
+            due = rule_due if due is None else min(due, rule_due)
+    return due
+
+
+# Next day the sweeper has to re-evaluate this patient, None if never
+def next_due_date(record: Dict[str, Any], as_of: datetime.date,
+                  cohorts: Mapping[str, Any] = COHORTS) -> Optional[datetime.date]:
+    if record.get("lead_management_active", True) is False:
+        return None
+    bucket = get_compiled(cohorts).get(record.get("current_cohort"), {}).get(record.get("current_actionable_bucket"))
+    if bucket is None:
+        return None
+    return bucket_due_date(bucket, record, EvaluationContext(as_of))
@@ -5,3 +5,13 @@ class PatientSerializer(serializers.ModelSerializer):
     class Meta:
         model = Patient
         fields = '__all__'
+        read_only_fields = ['attributes', 'next_due_date', 'updated_at', 'version']
+
+# Used for bulk upserts: drops the per-row uniqueness query on the primary key,
+# existing rows are looked up in one query and updated instead
+class PatientUpsertSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Patient
+        fields = '__all__'
+        read_only_fields = ['attributes', 'next_due_date', 'updated_at', 'version']
+        extra_kwargs = {'id': {'validators': []}}
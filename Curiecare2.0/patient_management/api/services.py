@@ -0,0 +1,468 @@
+import datetime
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import counters, events, metrics, patient_cache
+from .models import Patient, PatientTransition
+from .outbox import enqueue_actions
+from .patient_data import MAX_TRANSITION_STEPS, STATUS_FIELD, process_patient, process_patient_until_stable
+from .rules import EvaluationContext, parse_date
+from .rulesets import Rules, current_rules
+from .scheduling import DAYS_SINCE_LAST_CONTACT, DAYS_UNTIL_ADMISSION, SCHEDULED_DATE, next_due_date
+
+# Rows per INSERT/UPDATE statement, keeps SQLite under its bound-parameter limit
+BULK_BATCH_SIZE = 500
+
+PATIENT_UPDATE_FIELDS = [field.name for field in Patient._meta.concrete_fields if not field.primary_key]
+MODEL_FIELD_NAMES = frozenset(field.name for field in Patient._meta.concrete_fields)
+
+# Model fields that are bookkeeping rather than rule inputs
+BOOKKEEPING_FIELDS = frozenset(['attributes', 'last_contact_date', 'next_due_date', 'updated_at', 'version'])
+RECORD_FIELDS = [field.name for field in Patient._meta.concrete_fields if field.name not in BOOKKEEPING_FIELDS]
+# Columns patient_record is built from
+STORED_FIELDS = RECORD_FIELDS + ['attributes', 'last_contact_date']
+# Date columns the rules read (scheduled_date, ...)
+RULE_DATE_FIELDS = [field.name for field in Patient._meta.concrete_fields
+                    if field.get_internal_type() == 'DateField' and field.name not in BOOKKEEPING_FIELDS]
+
+# Fields the sweeper writes back after re-evaluating a patient
+SWEEP_UPDATE_FIELDS = ['current_cohort', 'current_actionable_bucket', 'status', 'lead_management_active',
+                       'previous_cohort', 'previous_bucket', 'days_since_last_contact', 'next_due_date',
+                       'rule_version', 'updated_at', 'version']
+
+# State the engine maintains itself and carries over from the stored row
+ENGINE_STATE_FIELDS = ['previous_cohort', 'previous_bucket']
+
+# Further attempts of a read-evaluate-write cycle after a VersionConflict
+MAX_CONFLICT_RETRIES = 3
+
+T = TypeVar('T')
+
+
+# Patients were written by someone else between being read and being written back.
+# Nothing of the attempt was saved, so it can be repeated from a fresh read.
+class VersionConflict(Exception):
+    def __init__(self, patient_ids: List[str]):
+        self.patient_ids = sorted(patient_ids)
+        super().__init__(f"Patients changed while being processed: {', '.join(self.patient_ids)}")
+
+
+# Run attempt() (which must read, evaluate and write) again while it raises
+# VersionConflict, at most `retries` more times; the last conflict is re-raised.
+# The conflicting patients are evicted from the cache so the retry reads them.
+def retry_on_conflict(attempt: Callable[[], T], retries: int = MAX_CONFLICT_RETRIES) -> T:
+    for remaining in range(retries, -1, -1):
+        try:
+            return attempt()
+        except VersionConflict as exc:
+            metrics.inc(metrics.VERSION_CONFLICTS, amount=len(exc.patient_ids))
+            patient_cache.invalidate(exc.patient_ids)
+            if not remaining:
+                raise
+
+
+async def aretry_on_conflict(attempt: Callable[[], Awaitable[T]], retries: int = MAX_CONFLICT_RETRIES) -> T:
+    for remaining in range(retries, -1, -1):
+        try:
+            return await attempt()
+        except VersionConflict as exc:
+            metrics.inc(metrics.VERSION_CONFLICTS, amount=len(exc.patient_ids))
+            patient_cache.invalidate(exc.patient_ids)
+            if not remaining:
+                raise
+
+
+# Stored versions of the given patients (absent ones are left out)
+def stored_versions(patient_ids: List[str]) -> Dict[str, int]:
+    versions = {}
+    for start in range(0, len(patient_ids), BULK_BATCH_SIZE):
+        versions.update(Patient.objects.filter(pk__in=patient_ids[start:start + BULK_BATCH_SIZE])
+                        .values_list('id', 'version'))
+    return versions
+
+
+# Ids of the patients whose stored row is no longer the one read into `existing`
+# (a missing entry: not stored when read). Called inside a writing transaction, which
+# holds SQLite's write lock from BEGIN (transaction_mode IMMEDIATE), so the rows that
+# pass cannot change before the transaction's own writes.
+def changed_since_read(patient_ids: List[str], existing: Dict[str, Patient]) -> List[str]:
+    stored = stored_versions(patient_ids)
+    return [patient_id for patient_id in patient_ids
+            if stored.get(patient_id) != (existing[patient_id].version if patient_id in existing else None)]
+
+
+# Ids occurring more than once, in order of their first occurrence
+def duplicate_ids(patient_ids: Iterable[str]) -> List[str]:
+    counts = Counter(patient_ids)
+    return [patient_id for patient_id, count in counts.items() if count > 1]
+
+
+# Payload keys without a model column, kept so later re-evaluation sees the full patient
+def extra_attributes(patient_data: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in patient_data.items() if key not in MODEL_FIELD_NAMES}
+
+
+def contact_date(patient_data: Dict[str, Any], as_of: datetime.date) -> Optional[datetime.date]:
+    try:
+        return as_of - datetime.timedelta(days=int(patient_data.get(DAYS_SINCE_LAST_CONTACT)))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+# Run process_patient with a rule set (actions deferred) and stamp the transitions
+# with the version that decided them. With chain, moves are followed until the
+# patient is stable (process_patient_until_stable), at most max_steps of them.
+# Callers evaluating many patients pass one context, which pins their as-of date.
+def evaluate_patient(patient_data: Dict[str, Any], rules: Rules, chain: bool = False,
+                     max_steps: int = MAX_TRANSITION_STEPS,
+                     context: Optional[EvaluationContext] = None) -> Dict[str, Any]:
+    if chain:
+        result = process_patient_until_stable(patient_data, rules.cohorts, defer_actions=True, max_steps=max_steps,
+                                              context=context)
+    else:
+        result = process_patient(patient_data, rules.cohorts, defer_actions=True, context=context)
+    for step in result_steps([result]):
+        if step.get("transition"):
+            step["transition"]["rule_version"] = rules.version
+    return result
+
+
+# Single process_patient results, with chained results expanded into their steps
+def result_steps(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [step for result in results for step in result.get("steps", [result])]
+
+
+# Rule-engine dict for a posted patient: the payload with the dates validation parsed
+def posted_record(patient_data: Dict[str, Any], validated: Dict[str, Any]) -> Dict[str, Any]:
+    record = dict(patient_data)
+    for name in RULE_DATE_FIELDS:
+        if name in validated:
+            record[name] = validated[name]
+    return record
+
+
+# Model values describing a posted patient after evaluate_patient ran on it
+def processed_fields(patient_data: Dict[str, Any], validated: Dict[str, Any],
+                     as_of: datetime.date, rules: Rules) -> Dict[str, Any]:
+    fields = {
+        "current_cohort": patient_data["current_cohort"],
+        "current_actionable_bucket": patient_data["current_actionable_bucket"],
+        "lead_management_active": patient_data.get("lead_management_active", True),
+        "previous_cohort": patient_data.get("previous_cohort"),
+        "previous_bucket": patient_data.get("previous_bucket"),
+        "attributes": extra_attributes(patient_data),
+        "next_due_date": next_due_date(patient_data, as_of, rules.cohorts),
+        "rule_version": rules.version,
+    }
+    # Not kept from the stored row when left out, as when they were attributes
+    for name in RULE_DATE_FIELDS:
+        fields[name] = validated.get(name)
+    # A chained evaluation gives the patient the status of each bucket it enters
+    status = patient_data.get(STATUS_FIELD)
+    if isinstance(status, str):
+        fields[STATUS_FIELD] = status.strip()
+    # Without a posted contact date or day count the stored one is kept
+    last_contact = validated.get("last_contact_date") or contact_date(patient_data, as_of)
+    if last_contact is not None:
+        fields["last_contact_date"] = last_contact
+    return fields
+
+
+# Carry the stored engine state (previous bucket) into a posted payload before processing
+def merge_stored_state(patient_data: Dict[str, Any], patient: Optional[Patient]):
+    if patient is None:
+        return
+    for name in ENGINE_STATE_FIELDS:
+        if patient_data.get(name) is None:
+            patient_data[name] = getattr(patient, name)
+
+
+# Create or update one processed patient together with its transitions and action jobs.
+# existing is the row the evaluation started from (None: not stored); raises
+# VersionConflict if the stored row is no longer that one.
+def save_processed_patient(existing: Optional[Patient], validated: Dict[str, Any],
+                           results: List[Dict[str, Any]]) -> Patient:
+    started = time.perf_counter()
+    deltas = Counter()
+    with transaction.atomic():
+        if existing is None:
+            patient = Patient(**validated)
+            try:
+                patient.save(force_insert=True)
+            except IntegrityError:
+                raise VersionConflict([patient.pk]) from None
+            counters.track(deltas, None, counters.state_key(patient))
+        else:
+            patient = existing
+            before = counters.state_key(patient)
+            for field, value in validated.items():
+                setattr(patient, field, value)
+            patient.updated_at = timezone.now()
+            fields = {name: getattr(patient, name) for name in PATIENT_UPDATE_FIELDS}
+            fields['version'] = patient.version + 1
+            # Compare-and-swap: matches no row if another write bumped the version
+            if not Patient.objects.filter(pk=patient.pk, version=patient.version).update(**fields):
+                raise VersionConflict([patient.pk])
+            patient.version += 1
+            counters.track(deltas, before, counters.state_key(patient))
+        patient_cache.store([patient])
+        record_results(results)
+        counters.apply_deltas(deltas)
+    metrics.observe_stage(metrics.DB_SAVE, time.perf_counter() - started)
+    return patient
+
+
+# Rule-engine dict for a stored patient, with the time-derived fields aged to as_of
+def patient_record(patient: Patient, as_of: datetime.date) -> Dict[str, Any]:
+    return stored_record({name: getattr(patient, name) for name in STORED_FIELDS}, as_of)
+
+
+# Same as patient_record, from a .values(*STORED_FIELDS) row
+def stored_record(values: Dict[str, Any], as_of: datetime.date) -> Dict[str, Any]:
+    record = dict(values['attributes'] or {})
+    for name in RECORD_FIELDS:
+        record[name] = values[name]
+    if values['last_contact_date'] is not None:
+        record[DAYS_SINCE_LAST_CONTACT] = (as_of - values['last_contact_date']).days
+    scheduled = parse_date(record.get(SCHEDULED_DATE))
+    if scheduled is not None:
+        record[DAYS_UNTIL_ADMISSION] = (scheduled - as_of).days
+    return record
+
+
+# Copy the state process_patient left in a record back onto the model instance
+def apply_record(patient: Patient, record: Dict[str, Any], as_of: datetime.date, rules: Rules):
+    patient.current_cohort = record["current_cohort"]
+    patient.current_actionable_bucket = record["current_actionable_bucket"]
+    patient.status = record[STATUS_FIELD]
+    patient.lead_management_active = record.get("lead_management_active", True)
+    patient.previous_cohort = record.get("previous_cohort")
+    patient.previous_bucket = record.get("previous_bucket")
+    patient.days_since_last_contact = record.get(DAYS_SINCE_LAST_CONTACT, patient.days_since_last_contact)
+    patient.next_due_date = next_due_date(record, as_of, rules.cohorts)
+    patient.rule_version = rules.version
+
+
+# PatientTransition rows for the "transition" records returned by process_patient
+def transition_rows(transitions: List[Dict[str, Any]]) -> List[PatientTransition]:
+    now = timezone.now()
+    return [
+        PatientTransition(
+            patient_id=transition["patient_id"],
+            from_cohort=transition["from_cohort"],
+            from_bucket=transition["from_bucket"],
+            to_cohort=transition["to_cohort"],
+            to_bucket=transition["to_bucket"],
+            rule_name=transition["rule_name"],
+            action=transition["action"],
+            rule_version=transition.get("rule_version"),
+            created_at=now,
+        )
+        for transition in transitions
+    ]
+
+
+def record_transitions(transitions: List[Dict[str, Any]]):
+    rows = transition_rows(transitions)
+    PatientTransition.objects.bulk_create(rows, batch_size=BULK_BATCH_SIZE)
+    if events.enabled():
+        events.emit_on_commit(events.TRANSITION, [
+            (row.patient_id, {"rule": row.rule_name, "action": row.action,
+                              "from_cohort": row.from_cohort, "from_bucket": row.from_bucket,
+                              "to_cohort": row.to_cohort, "to_bucket": row.to_bucket,
+                              "rule_version": row.rule_version})
+            for row in rows
+        ])
+
+
+# Persist what process_patient(..., defer_actions=True) produced besides the patient
+# state: its transitions and its action jobs. Call inside the state change's transaction.
+def record_results(results: List[Dict[str, Any]]):
+    results = result_steps(results)
+    record_transitions([result["transition"] for result in results if result.get("transition")])
+    enqueue_actions(results, batch_size=BULK_BATCH_SIZE)
+
+
+# Insert or update validated patient rows in a single transaction, together with
+# the transitions and action jobs processing produced. Each id may appear once: the
+# results of a row that would be overwritten would not match the stored patient
+# (ValueError). existing, when given, holds the stored rows the rows were computed
+# from; if any of them changed since, VersionConflict is raised and nothing is written.
+# Returns (created_ids, updated_ids).
+def upsert_patients(rows: List[Dict[str, Any]], results: List[Dict[str, Any]] = (),
+                    existing: Optional[Dict[str, Patient]] = None) -> Tuple[List[str], List[str]]:
+    by_id = {}
+    for row in rows:
+        by_id[row["id"]] = row
+    if len(by_id) != len(rows):
+        raise ValueError(f"Duplicate patient ids: {', '.join(duplicate_ids(row['id'] for row in rows))}")
+
+    started = time.perf_counter()
+    with transaction.atomic():
+        if existing is None:
+            existing = Patient.objects.in_bulk(list(by_id))
+        else:
+            changed = changed_since_read(list(by_id), existing)
+            if changed:
+                raise VersionConflict(changed)
+        to_create = []
+        to_update = []
+        deltas = Counter()
+        for patient_id, row in by_id.items():
+            patient = existing.get(patient_id)
+            if patient is None:
+                patient = Patient(**row)
+                to_create.append(patient)
+                counters.track(deltas, None, counters.state_key(patient))
+            else:
+                before = counters.state_key(patient)
+                for field, value in row.items():
+                    setattr(patient, field, value)
+                patient.version += 1
+                to_update.append(patient)
+                counters.track(deltas, before, counters.state_key(patient))
+        # One INSERT ... ON CONFLICT DO UPDATE per batch writes new and stored rows alike;
+        # bulk_update's per-field CASE expressions cost far more to build than the write
+        Patient.objects.bulk_create(to_create + to_update, batch_size=BULK_BATCH_SIZE, update_conflicts=True,
+                                    unique_fields=['id'], update_fields=PATIENT_UPDATE_FIELDS)
+        patient_cache.store(to_create + to_update)
+        record_results(results)
+        counters.apply_deltas(deltas)
+    metrics.observe_stage(metrics.DB_SAVE, time.perf_counter() - started)
+
+    return [patient.id for patient in to_create], [patient.id for patient in to_update]
+
+
+# Re-evaluate every active patient whose next_due_date has arrived, chunk by chunk.
+# Only due patients are read, in (next_due_date, id) order off the partial due index;
+# each chunk's transitions are written back with one bulk upsert. Patients another
+# writer changed in the meantime are re-read and re-evaluated, at most
+# MAX_CONFLICT_RETRIES times ("conflicts" counts those given up on).
+def sweep_due_patients(as_of: datetime.date, chunk_size: int = BULK_BATCH_SIZE,
+                       rules: Optional[Rules] = None, chain: bool = False) -> Dict[str, int]:
+    rules = rules or current_rules()
+    context = EvaluationContext(as_of)
+    due = Patient.objects.filter(lead_management_active=True, next_due_date__lte=as_of)
+    stats = {"processed": 0, "moved": 0, "ended": 0, "conflicts": 0}
+    after = None
+    while True:
+        chunk = due_chunk(due, after, chunk_size)
+        if not chunk:
+            break
+        after = (chunk[-1].next_due_date, chunk[-1].pk)
+        # Conflicting patients no longer due were already handled by the other writer
+        sweep_chunk(chunk, due, context, rules, chain, stats)
+    return stats
+
+
+# Evaluate and write back a chunk, re-reading the patients another writer changed in
+# the meantime from `pending` (those no longer in it are skipped) and evaluating them
+# again, at most MAX_CONFLICT_RETRIES times
+def sweep_chunk(chunk: List[Patient], pending, context: EvaluationContext, rules: Rules, chain: bool,
+                stats: Dict[str, int]):
+    for remaining in range(MAX_CONFLICT_RETRIES, -1, -1):
+        changed = sweep_patients(chunk, context, rules, chain, stats)
+        if not changed:
+            return
+        metrics.inc(metrics.VERSION_CONFLICTS, amount=len(changed))
+        patient_cache.invalidate(changed)
+        if not remaining:
+            stats["conflicts"] += len(changed)
+            return
+        chunk = list(pending.filter(pk__in=changed))
+
+
+# Evaluate and write back one chunk of the sweep; returns the ids of the patients
+# not written because their row changed after it was read
+def sweep_patients(chunk: List[Patient], context: EvaluationContext, rules: Rules, chain: bool,
+                   stats: Dict[str, int]) -> List[str]:
+    evaluated = []
+    for patient in chunk:
+        before = counters.state_key(patient)
+        record = patient_record(patient, context.as_of)
+        result = evaluate_patient(record, rules, chain, context=context)
+        apply_record(patient, record, context.as_of, rules)
+        evaluated.append((patient, result, before))
+
+    started = time.perf_counter()
+    with transaction.atomic():
+        changed = set(changed_since_read([patient.pk for patient in chunk],
+                                         {patient.pk: patient for patient in chunk}))
+        written = [item for item in evaluated if item[0].pk not in changed]
+        deltas = Counter()
+        for patient, _, before in written:
+            patient.version += 1
+            state = counters.state_key(patient)
+            counters.track(deltas, before, state)
+            stats["processed"] += 1
+            if state[:2] != before[:2]:
+                stats["moved"] += 1
+            if not patient.lead_management_active:
+                stats["ended"] += 1
+        # As in upsert_patients: one INSERT ... ON CONFLICT DO UPDATE per batch, as
+        # bulk_update's CASE expressions would hold the write lock for seconds a chunk.
+        # Rows deleted since the read are in `changed`, so nothing is re-inserted.
+        Patient.objects.bulk_create([patient for patient, _, _ in written], batch_size=BULK_BATCH_SIZE,
+                                    update_conflicts=True, unique_fields=['id'],
+                                    update_fields=SWEEP_UPDATE_FIELDS)
+        patient_cache.store(patient for patient, _, _ in written)
+        record_results([result for _, result, _ in written])
+        counters.apply_deltas(deltas)
+    metrics.observe_stage(metrics.DB_SAVE, time.perf_counter() - started)
+    return sorted(changed)
+
+
+# Next chunk of due patients after the (next_due_date, id) key of the previous chunk.
+# The rest of the previous key's tie group and the later dates are read as two index
+# seeks, so large groups of patients due on the same day are not rescanned.
+def due_chunk(due, after: Optional[Tuple[datetime.date, str]], chunk_size: int) -> List[Patient]:
+    if after is None:
+        return list(due.order_by('next_due_date', 'id')[:chunk_size])
+    due_date, last_id = after
+    chunk = list(due.filter(next_due_date=due_date, id__gt=last_id).order_by('id')[:chunk_size])
+    if len(chunk) < chunk_size:
+        chunk.extend(due.filter(next_due_date__gt=due_date)
+                     .order_by('next_due_date', 'id')[:chunk_size - len(chunk)])
+    return chunk
+
+
+# Fields returned by the work-queue listing
+QUEUE_FIELDS = ['id', 'current_cohort', 'current_actionable_bucket', 'status', 'days_since_last_contact',
+                'last_contact_date', 'lead_management_active', 'next_due_date']
+
+
+# One page of a work queue, most stale first: last_contact_date ascending with the
+# never contacted patients last, id as tie-breaker. The stored days_since_last_contact
+# is only refreshed when a patient is rewritten, so it is recomputed from the date as
+# of `as_of`. after=(last_contact_date or None, id) is the last row of the previous
+# page. The page is read with at most three index seeks (the rest of that row's tie
+# group, the later dates, the patients without a date), so the cost does not grow
+# with the page number.
+def patient_queue_page(filters: Dict[str, Any], after: Optional[Tuple[Optional[datetime.date], str]], limit: int,
+                       as_of: Optional[datetime.date] = None) -> List[Dict[str, Any]]:
+    as_of = as_of or datetime.date.today()
+    queue = Patient.objects.filter(**filters)
+    contacted = queue.filter(last_contact_date__isnull=False).order_by('last_contact_date', 'id')
+    never_contacted = queue.filter(last_contact_date__isnull=True).order_by('id')
+    if after is None:
+        segments = [contacted, never_contacted]
+    elif after[0] is None:
+        segments = [never_contacted.filter(id__gt=after[1])]
+    else:
+        contact_date, last_id = after
+        segments = [contacted.filter(last_contact_date=contact_date, id__gt=last_id),
+                    contacted.filter(last_contact_date__gt=contact_date), never_contacted]
+
+    rows = []
+    for segment in segments:
+        if len(rows) >= limit:
+            break
+        rows.extend(segment.values(*QUEUE_FIELDS)[:limit - len(rows)])
+    for row in rows:
+        if row['last_contact_date'] is not None:
+            row['days_since_last_contact'] = (as_of - row['last_contact_date']).days
+    return rows
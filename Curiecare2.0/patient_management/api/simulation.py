@@ -0,0 +1,266 @@
+import datetime
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+
+from .models import Patient
+from .patient_data import STATUS_FIELD, previous_actionable_bucket
+from .rules import (
+    OP_BETWEEN, OP_DATE_FUTURE, OP_DATE_PAST, OP_EQ, OP_EXISTS, OP_GE, OP_LE, OP_TODAY,
+    get_compiled, iter_buckets, parse_date,
+)
+from .rulesets import Rules
+from .scheduling import DAYS_SINCE_LAST_CONTACT, DAYS_UNTIL_ADMISSION
+from .services import STORED_FIELDS, stored_record
+from .vectorized import MISSING, PRESENT, UNKNOWN_BUCKET, BucketCodes, PatientBatch, _to_int, evaluate_batch
+
+# What-if simulation of cohort flows.
+#
+# The active patients are loaded once into NumPy columns holding only the fields
+# the simulated rule sets read. Every simulated day the whole population is
+# evaluated with evaluate_batch, as the daily sweeper would do: moves and ends of
+# lead management are applied, a patient entering a bucket takes the status its
+# criteria expect, days_since_last_contact grows by one and days_until_admission
+# shrinks by one. Bucket occupancy is recorded per day.
+
+# Column kinds, matching the PatientBatch accessors
+CATEGORICAL = "categorical"
+INTEGER = "integer"
+DATES = "dates"
+TRUTHY = "truthy"
+
+# Integer columns that change by this much per simulated day (where known)
+DAILY_CHANGES = {DAYS_SINCE_LAST_CONTACT: 1, DAYS_UNTIL_ADMISSION: -1}
+
+# Bucket code of patients whose lead management ended during the simulation
+ENDED = -2
+
+SNAPSHOT_CHUNK_SIZE = 5000
+
+
+# (kind, key) columns the rule sets' terms read
+def required_columns(rule_sets: Iterable[Rules]) -> Set[Tuple[str, str]]:
+    columns = {(CATEGORICAL, STATUS_FIELD)}
+    for rules in rule_sets:
+        for bucket in iter_buckets(get_compiled(rules.cohorts)):
+            terms = list(bucket.criteria_terms)
+            for rule in bucket.rules:
+                terms.extend(rule.terms)
+            for key, op, operand, source in terms:
+                if op == OP_EQ:
+                    columns.add((CATEGORICAL, key))
+                elif op in (OP_GE, OP_LE):
+                    columns.add((INTEGER, key))
+                elif op == OP_BETWEEN:
+                    columns.add((INTEGER, source))
+                elif op in (OP_DATE_PAST, OP_DATE_FUTURE, OP_TODAY):
+                    columns.add((DATES, source))
+                elif op == OP_EXISTS:
+                    columns.add((TRUTHY, source))
+    return columns
+
+
+_ABSENT = object()
+
+
+# Build a column from the raw values of its key (_ABSENT where a record lacks the
+# key), the same way the PatientBatch accessors build their columns from records
+def build_column(kind: str, values: List[Any]):
+    size = len(values)
+    if kind == CATEGORICAL:
+        vocabulary: Dict[Any, int] = {}
+        codes = np.empty(size, dtype=np.int32)
+        for row, value in enumerate(values):
+            if value is _ABSENT:
+                value = None
+            try:
+                codes[row] = vocabulary.setdefault(value, len(vocabulary))
+            except TypeError:  # unhashable values never equal a rule operand
+                codes[row] = -1
+        return codes, vocabulary
+    if kind == INTEGER:
+        numbers = np.zeros(size, dtype=np.int64)
+        state = np.full(size, PRESENT, dtype=np.int8)
+        for row, value in enumerate(values):
+            if type(value) is int:
+                numbers[row] = value
+            elif value is _ABSENT:
+                state[row] = MISSING
+            else:
+                numbers[row], state[row] = _to_int(value)
+        return numbers, state
+    if kind == DATES:
+        ordinals = np.zeros(size, dtype=np.int64)
+        valid = np.zeros(size, dtype=bool)
+        parsed_dates: Dict[Any, Optional[int]] = {}
+        for row, value in enumerate(values):
+            try:
+                ordinal = parsed_dates[value]
+            except KeyError:
+                parsed = parse_date(value) if value is not _ABSENT else None
+                ordinal = parsed_dates[value] = parsed.toordinal() if parsed is not None else None
+            except TypeError:
+                parsed = parse_date(value)
+                ordinal = parsed.toordinal() if parsed is not None else None
+            if ordinal is not None:
+                ordinals[row] = ordinal
+                valid[row] = True
+        return ordinals, valid
+    return np.fromiter((value is not _ABSENT and bool(value) for value in values), dtype=bool, count=size)
+
+
+class Snapshot(NamedTuple):
+    as_of: datetime.date
+    size: int
+    pairs: List[Tuple[Any, Any]]       # (cohort, bucket) pairs seen in the snapshot
+    current: np.ndarray                # index into pairs of each patient's bucket
+    previous: np.ndarray               # index into pairs of the bucket re-engagement returns to
+    columns: Dict[Tuple[str, str], Any]
+
+    # A fresh batch for one simulation run, bucket codes translated to the rule set's codes
+    def batch(self, codes: BucketCodes) -> PatientBatch:
+        batch = PatientBatch(self.size)
+        translate = np.array([codes.code(*pair) for pair in self.pairs] or [UNKNOWN_BUCKET], dtype=np.int32)
+        batch.set_bucket_codes(translate[self.current])
+        batch.set_previous_bucket_codes(translate[self.previous])
+        for (kind, key), column in self.columns.items():
+            if kind == CATEGORICAL:
+                batch.set_categorical(key, column[0].copy(), dict(column[1]))
+            elif kind == INTEGER:
+                batch.set_integer(key, column[0].copy(), column[1])
+            elif kind == DATES:
+                batch.set_dates(key, *column)
+            else:
+                batch.set_truthy(key, column)
+        return batch
+
+
+# Load the active patients (or another queryset) into a snapshot with the given columns
+def load_snapshot(columns: Set[Tuple[str, str]], as_of: datetime.date, queryset=None,
+                  chunk_size: int = SNAPSHOT_CHUNK_SIZE) -> Snapshot:
+    if queryset is None:
+        queryset = Patient.objects.filter(lead_management_active=True)
+    raw: Dict[str, List[Any]] = {key: [] for kind, key in columns}
+    raw_items = list(raw.items())
+    pair_index: Dict[Tuple[Any, Any], int] = {}
+    current = []
+    previous = []
+    for row in queryset.values(*STORED_FIELDS).iterator(chunk_size=chunk_size):
+        record = stored_record(row, as_of)
+        pair = (record["current_cohort"], record["current_actionable_bucket"])
+        current.append(pair_index.setdefault(pair, len(pair_index)))
+        previous.append(pair_index.setdefault(previous_actionable_bucket(record), len(pair_index)))
+        for key, column_values in raw_items:
+            column_values.append(record.get(key, _ABSENT))
+    return Snapshot(
+        as_of=as_of,
+        size=len(current),
+        pairs=list(pair_index),
+        current=np.array(current, dtype=np.int32),
+        previous=np.array(previous, dtype=np.int32),
+        columns={(kind, key): build_column(kind, raw[key]) for kind, key in sorted(columns)},
+    )
+
+
+def _bucket_label(pair: Tuple[Any, Any]) -> str:
+    return f"{pair[0]}.{pair[1]}"
+
+
+# Replay a rule set over the snapshot for `days` days, starting on its as_of date
+def simulate(snapshot: Snapshot, rules: Rules, days: int) -> Dict[str, Any]:
+    started = time.perf_counter()
+    compiled = get_compiled(rules.cohorts)
+    codes = BucketCodes(compiled)
+    size = len(codes.pairs)
+    batch = snapshot.batch(codes)
+    bucket_codes = batch.bucket_codes
+    previous_codes = batch.previous_codes
+    status_codes, vocabulary = batch.categorical(STATUS_FIELD)
+
+    # Status code a bucket's criteria give entering patients, -1 keeps the current one
+    entered_status = np.full(size, -1, dtype=np.int32)
+    for bucket in iter_buckets(compiled):
+        for term in bucket.criteria_terms:
+            if term.key == STATUS_FIELD and term.op == OP_EQ:
+                entered_status[codes.code(bucket.cohort, bucket.bucket)] = \
+                    vocabulary.setdefault(term.operand, len(vocabulary))
+    advancing = [(batch.integer(key), change) for key, change in DAILY_CHANGES.items()
+                 if (INTEGER, key) in snapshot.columns]
+
+    flows = np.zeros(size * size, dtype=np.int64)
+    ended_flows = np.zeros(size, dtype=np.int64)
+    # Moves to a previous bucket the rule set does not know, by source bucket
+    unknown_flows = np.zeros(size, dtype=np.int64)
+    daily = []
+    for day in range(days):
+        today = snapshot.as_of + datetime.timedelta(days=day)
+        result = evaluate_batch(batch, rules.cohorts, today, codes)
+        moved = np.flatnonzero(result.target != result.current)
+        ended = np.flatnonzero(result.ends_lead_management)
+        sources = result.current[moved]
+        targets = result.target[moved]
+        known = targets != UNKNOWN_BUCKET
+        flows += np.bincount(sources[known] * size + targets[known], minlength=size * size)
+        unknown_flows += np.bincount(sources[~known], minlength=size)
+        ended_flows += np.bincount(result.current[ended], minlength=size)
+
+        previous_codes[moved] = sources
+        bucket_codes[moved] = targets
+        entering = moved[known]
+        new_status = entered_status[targets[known]]
+        status_codes[entering[new_status >= 0]] = new_status[new_status >= 0]
+        bucket_codes[ended] = ENDED
+
+        for (values, state), change in advancing:
+            values[state == PRESENT] += change
+
+        occupancy = np.bincount(bucket_codes[bucket_codes >= 0], minlength=size)
+        daily.append({
+            "date": today.isoformat(),
+            "moved": len(moved),
+            "ended": len(ended),
+            "occupancy": {_bucket_label(codes.pairs[code]): int(count)
+                          for code, count in enumerate(occupancy.tolist()) if count},
+        })
+
+    flow_counts = {}
+    for index in np.flatnonzero(flows).tolist():
+        source, target = divmod(index, size)
+        flow_counts[f"{_bucket_label(codes.pairs[source])} -> {_bucket_label(codes.pairs[target])}"] = int(flows[index])
+    for code in np.flatnonzero(ended_flows).tolist():
+        flow_counts[f"{_bucket_label(codes.pairs[code])} -> ended"] = int(ended_flows[code])
+    for code in np.flatnonzero(unknown_flows).tolist():
+        flow_counts[f"{_bucket_label(codes.pairs[code])} -> unknown"] = int(unknown_flows[code])
+    return {
+        "version": rules.version,
+        "patients": snapshot.size,
+        "unknown_bucket": int(np.count_nonzero(batch.bucket_codes == UNKNOWN_BUCKET)),
+        "ended": int(np.count_nonzero(bucket_codes == ENDED)),
+        "days": daily,
+        "flows": dict(sorted(flow_counts.items(), key=lambda item: -item[1])),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+# Side-by-side runs of two rule sets over the same snapshot, with the final
+# occupancy difference (candidate minus baseline) per bucket
+def compare(snapshot: Snapshot, baseline: Rules, candidate: Rules, days: int) -> Dict[str, Any]:
+    runs = {"baseline": simulate(snapshot, baseline, days), "candidate": simulate(snapshot, candidate, days)}
+    final = {name: run["days"][-1]["occupancy"] if run["days"] else {} for name, run in runs.items()}
+    buckets = sorted(set(final["baseline"]) | set(final["candidate"]))
+    difference = {bucket: final["candidate"].get(bucket, 0) - final["baseline"].get(bucket, 0) for bucket in buckets}
+    difference["ended"] = runs["candidate"]["ended"] - runs["baseline"]["ended"]
+    return {**runs, "difference": {bucket: change for bucket, change in difference.items() if change}}
+
+
+# Snapshot with the columns both rule sets need, then compare them
+def compare_rule_sets(baseline: Rules, candidate: Rules, days: int, as_of: Optional[datetime.date] = None,
+                      queryset=None) -> Dict[str, Any]:
+    as_of = as_of or datetime.date.today()
+    started = time.perf_counter()
+    snapshot = load_snapshot(required_columns([baseline, candidate]), as_of, queryset)
+    loaded = time.perf_counter() - started
+    report = compare(snapshot, baseline, candidate, days)
+    return {"as_of": as_of.isoformat(), "days": days, "patients": snapshot.size,
+            "snapshot_seconds": round(loaded, 3), **report}
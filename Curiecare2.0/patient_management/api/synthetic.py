@@ -0,0 +1,143 @@
+import datetime
+import random
+from typing import Any, Dict, Iterator, List, Mapping, Optional
+
+from .patient_data import COHORTS
+from .rules import (
+    OP_BETWEEN, OP_DATE_FUTURE, OP_DATE_PAST, OP_EQ, OP_EXISTS, OP_GE, OP_LE, OP_TODAY,
+    DATE_FORMAT, CompiledBucket, Term, get_compiled, iter_buckets,
+)
+
+# Seeded synthetic patients for benchmarks and tests.
+#
+# Patients are spread over every bucket of the rule tree. Each one is given its
+# bucket's criteria (except for a small share of deliberate mismatches), and most
+# are steered into one of the bucket's disposition rules, so every rule path is
+# exercised. Free fields follow rough funnel distributions.
+
+# Relative share of patients per bucket; buckets not listed get DEFAULT_BUCKET_WEIGHT
+BUCKET_WEIGHTS = {
+    "A1": 18, "A2": 10, "A3": 12, "A4": 10,
+    "B1": 10, "B2": 6,
+    "C1": 6, "C2": 5, "C3": 5,
+    "D1": 6,
+    "E1": 8, "E2": 4,
+}
+DEFAULT_BUCKET_WEIGHT = 5
+
+# Probability that a boolean field is True when no rule or criterion sets it
+FLAG_RATES = {
+    "clinical_intervention_required": 0.35,
+    "quotation_phase_required": 0.4,
+    "patient_ready": 0.3,
+    "quotation_accepted": 0.3,
+    "clinical_intervention_completed": 0.4,
+    "scheduled_admission": 0.4,
+    "scheduled_date_exists": 0.5,
+    "admission_completed": 0.1,
+    "response_received": 0.25,
+}
+ADMISSION_STATUSES = [("Scheduled", 0.8), ("Postponed", 0.12), ("Cancelled", 0.08)]
+REASONS = [("Declined or Unresponsive", 0.7), ("Other", 0.3)]
+
+RULE_RATE = 0.6        # share of patients steered into one of their bucket's rules
+MISMATCH_RATE = 0.03   # share of patients that do not meet their bucket's criteria
+
+
+def _pick(rng: random.Random, choices):
+    threshold = rng.random()
+    for value, weight in choices:
+        threshold -= weight
+        if threshold < 0:
+            return value
+    return choices[-1][0]
+
+
+def _set_days_until_admission(patient: Dict[str, Any], days: int, as_of: datetime.date):
+    patient["days_until_admission"] = days
+    patient["scheduled_date"] = (as_of + datetime.timedelta(days=days)).strftime(DATE_FORMAT)
+
+
+# Change the patient so that one parsed condition term holds
+def satisfy(term: Term, patient: Dict[str, Any], rng: random.Random, as_of: datetime.date):
+    key, op, operand, source = term
+    if op == OP_EQ:
+        patient[key] = operand
+    elif op == OP_GE:
+        if not isinstance(patient.get(key), int) or patient[key] < operand:
+            patient[key] = operand + int(rng.expovariate(0.5))
+    elif op == OP_LE:
+        if not isinstance(patient.get(key), int) or patient[key] > operand:
+            value = operand - int(rng.expovariate(0.5))
+            if key == "days_until_admission":
+                _set_days_until_admission(patient, value, as_of)
+            else:
+                patient[key] = value
+    elif op == OP_BETWEEN:
+        lower, upper = operand
+        if not lower <= patient.get(source, lower - 1) <= upper:
+            _set_days_until_admission(patient, rng.randint(lower, upper), as_of)
+    elif op == OP_DATE_PAST:
+        if patient.get("days_until_admission", 0) >= 0:
+            _set_days_until_admission(patient, -rng.randint(1, 30), as_of)
+    elif op == OP_DATE_FUTURE:
+        if patient.get("days_until_admission", 0) <= 0:
+            _set_days_until_admission(patient, rng.randint(1, 30), as_of)
+    elif op == OP_TODAY:
+        patient[key] = as_of.strftime(DATE_FORMAT)
+    elif op == OP_EXISTS:
+        if operand:
+            patient[source] = (as_of + datetime.timedelta(days=rng.randint(3, 60))).strftime(DATE_FORMAT)
+        else:
+            patient.pop(source, None)
+
+
+def base_patient(patient_id: str, bucket: CompiledBucket, rng: random.Random, as_of: datetime.date,
+                 previous_buckets: List[CompiledBucket]) -> Dict[str, Any]:
+    patient = {
+        "id": patient_id,
+        "current_cohort": bucket.cohort,
+        "current_actionable_bucket": bucket.bucket,
+        "days_since_last_contact": min(int(rng.expovariate(0.25)), 90),
+        "follow_up_attempts": rng.randint(0, 5),
+        "admission_status": _pick(rng, ADMISSION_STATUSES),
+        "reason": _pick(rng, REASONS),
+    }
+    for key, rate in FLAG_RATES.items():
+        patient[key] = rng.random() < rate
+    if bucket.cohort in ("B", "C") or rng.random() < 0.2:
+        _set_days_until_admission(patient, rng.randint(-10, 45), as_of)
+    if rng.random() < 0.15:
+        patient["new_scheduled_date"] = (as_of + datetime.timedelta(days=rng.randint(3, 60))).strftime(DATE_FORMAT)
+    if bucket.cohort == "E" and rng.random() < 0.7:
+        # Where re-engaged patients return to
+        previous = rng.choice(previous_buckets)
+        patient["previous_cohort"] = previous.cohort
+        patient["previous_bucket"] = previous.bucket
+    return patient
+
+
+# Infinite, reproducible stream of patient payloads (JSON-compatible dicts).
+# The first patients visit every bucket once, the rest follow BUCKET_WEIGHTS.
+def generate_patients(seed: int = 0, as_of: Optional[datetime.date] = None,
+                      cohorts: Mapping[str, Any] = COHORTS, id_prefix: str = "S") -> Iterator[Dict[str, Any]]:
+    rng = random.Random(seed)
+    as_of = as_of or datetime.date.today()
+    buckets = iter_buckets(get_compiled(cohorts))
+    previous_buckets = [bucket for bucket in buckets if bucket.cohort in ("A", "B", "C")] or buckets
+    weights = [BUCKET_WEIGHTS.get(bucket.bucket, DEFAULT_BUCKET_WEIGHT) for bucket in buckets]
+    statuses = sorted({term.operand for bucket in buckets for term in bucket.criteria_terms if term.key == "status"})
+    index = 0
+    while True:
+        bucket = buckets[index] if index < len(buckets) else rng.choices(buckets, weights)[0]
+        patient = base_patient(f"{id_prefix}{index:09d}", bucket, rng, as_of, previous_buckets)
+        if bucket.rules and rng.random() < RULE_RATE:
+            for term in rng.choice(bucket.rules).terms:
+                satisfy(term, patient, rng, as_of)
+        # Criteria are applied last so they win over conflicting rule terms
+        for term in bucket.criteria_terms:
+            satisfy(term, patient, rng, as_of)
+        if index >= len(buckets) and rng.random() < MISMATCH_RATE:
+            patient["status"] = rng.choice([status for status in statuses if status != patient.get("status")])
+        yield patient
+        index += 1
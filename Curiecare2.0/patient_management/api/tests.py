@@ -1,3 +1,1306 @@
-from django.test import TestCase
+import datetime
+import json
+import itertools
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.exceptions import ValidationError
+
+from . import changefeed, counters, events, metrics, patient_cache, rulesets
+from .exporter import export_patients
+from .importer import CSV, read_records
+from .models import ActionJob, Patient, PatientTransition, RuleSet
+from .outbox import ActionWorker, claim_jobs, run_job
+from .patient_data import (
+    ACTION_MAPPING, COHORTS, CONFIG, evaluate_condition, process_patient, process_patient_until_stable,
+)
+from .reevaluation import process_all, shard_patients, shard_ranges
+from .rule_analysis import SHADOWED, UNREACHABLE, rule_findings
+from .rules import (
+    OP_NEVER, EvaluationContext, compile_cohorts, get_compiled, iter_buckets, parse_date, parse_term,
+)
+from .scheduling import next_due_date
+from .services import (
+    VersionConflict, patient_record, processed_fields, save_processed_patient, sweep_due_patients, upsert_patients,
+)
+from .simulation import compare_rule_sets, load_snapshot, required_columns, simulate
+from .serializers import PatientUpsertSerializer
+from .synthetic import generate_patients
+from .validation import patient_validator
+from .vectorized import PatientBatch, evaluate_batch
+
+
+# Without EVENT_LOG_FILE every action is logged to the console; keep the test output clean
+def setUpModule():
+    logging.getLogger("api.events").setLevel(logging.WARNING)
+
+
+def tearDownModule():
+    logging.getLogger("api.events").setLevel(logging.INFO)
+
+
+def run(patient):
+    with redirect_stdout(StringIO()):
+        return process_patient(patient, COHORTS)
+
+
+class RuleCompilerTests(SimpleTestCase):
+    def test_compiled_tree_is_cached_and_read_only(self):
+        compiled = get_compiled(COHORTS)
+        self.assertIs(compiled, get_compiled(COHORTS))
+        self.assertEqual([rule.name for rule in compiled["A"]["A1"].rules][:2],
+                         ["if_clinical_intervention_needed", "if_quotation_phase_needed"])
+        with self.assertRaises(TypeError):
+            compiled["A"]["A9"] = None
+
+    def test_threshold_terms_are_parsed_once(self):
+        self.assertEqual(parse_term("days_since_last_contact", ">= 5")[1:3], ("ge", 5))
+        self.assertEqual(parse_term("days_until_admission", "<= 2")[1:3], ("le", 2))
+        self.assertEqual(parse_term("days_since_last_contact", ">= x").op, OP_NEVER)
+
+    def test_evaluate_condition(self):
+        condition = {"days_since_last_contact": ">= 5", "status": "Lost"}
+        self.assertTrue(evaluate_condition(condition, {"days_since_last_contact": 5, "status": "Lost"}))
+        self.assertFalse(evaluate_condition(condition, {"days_since_last_contact": 4, "status": "Lost"}))
+        self.assertFalse(evaluate_condition(condition, {"days_since_last_contact": None, "status": "Lost"}))
+        tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        self.assertTrue(evaluate_condition({"scheduled_date_in_future": True}, {"scheduled_date": tomorrow}))
+        self.assertFalse(evaluate_condition({"scheduled_date_in_past": True}, {"scheduled_date": tomorrow}))
+        self.assertTrue(evaluate_condition({"new_scheduled_date_exists": False}, {}))
+
+    def test_evaluation_context_pins_the_date_and_parses_once(self):
+        bucket = get_compiled(COHORTS)["B"]["B1"]
+        patient = {"id": "P1", "current_cohort": "B", "current_actionable_bucket": "B1",
+                   "status": "Admission Scheduled", "scheduled_date_exists": True, "scheduled_date": "2024-11-10"}
+        self.assertTrue(bucket.criteria(patient, EvaluationContext(datetime.date(2024, 11, 1))))
+        self.assertFalse(bucket.criteria(patient, EvaluationContext(datetime.date(2024, 11, 10))))
+        self.assertTrue(bucket.criteria({**patient, "scheduled_date": datetime.date(2024, 11, 10)},
+                                        EvaluationContext(datetime.date(2024, 11, 1))))
+
+        context = EvaluationContext(datetime.date(2024, 11, 1))
+        with mock.patch("api.rules.parse_date", wraps=parse_date) as parse, redirect_stdout(StringIO()):
+            for _ in range(3):
+                process_patient(dict(patient), COHORTS, context=context)
+        self.assertEqual(parse.call_count, 1)
+
+    def test_decision_tree_keeps_first_match(self):
+        rng = random.Random(11)
+        buckets = iter_buckets(get_compiled(COHORTS))
+        context = EvaluationContext()
+        for index in range(3000):
+            patient = random_patient(rng, index)
+            if rng.random() < 0.2:
+                patient["status"] = rng.choice([None, ["unhashable"]])
+            if rng.random() < 0.2:
+                patient["admission_completed"] = rng.choice([1, 0, 1.0])
+            for bucket in buckets:
+                linear = next((rule for rule in bucket.rules if rule.predicate(patient, context)), None)
+                self.assertIs(bucket.match(patient, context), linear, (bucket.name, patient))
+
+    def test_findings(self):
+        findings = {(finding.cohort, finding.bucket, finding.rule): finding.kind
+                    for finding in rule_findings(get_compiled(COHORTS))}
+        self.assertEqual(findings[("A", "A1", "if_both_needed")], SHADOWED)
+        self.assertEqual(findings[("B", "B1", "on_due_date_passed_without_admission")], UNREACHABLE)
+        self.assertNotIn(("A", "A1", "if_ready_to_schedule"), findings)
+
+        rules = {
+            "stale": {"condition": {"days_since_last_contact": ">= 5"}},
+            "staler": {"condition": {"days_since_last_contact": ">= 7", "response_received": False}},
+            "recent": {"condition": {"days_since_last_contact": "<= 3"}},
+            "empty_range": {"condition": {"follow_up_attempts": ">= 4", "days_until_admission": "<= 1",
+                                          "days_until_admission_between": [2, 5]}},
+        }
+        cohorts = {"X": {"actionable_buckets": {"X1": {"criteria": {}, "disposition_rules": rules}}}}
+        self.assertEqual([(finding.rule, finding.kind) for finding in rule_findings(compile_cohorts(cohorts))],
+                         [("staler", SHADOWED), ("empty_range", UNREACHABLE)])
+
+
+class ProcessPatientTests(SimpleTestCase):
+    def test_first_matching_rule_wins(self):
+        patient = {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1",
+                   "status": "IP Recommended", "clinical_intervention_required": True,
+                   "quotation_phase_required": True}
+        run(patient)
+        self.assertEqual((patient["current_cohort"], patient["current_actionable_bucket"]), ("A", "A2"))
+
+    def test_no_response_threshold_fires(self):
+        patient = {"id": "P014", "current_cohort": "A", "current_actionable_bucket": "A3",
+                   "status": "Quotation Phase Required", "quotation_accepted": False,
+                   "days_since_last_contact": CONFIG["Y"]}
+        run(patient)
+        self.assertEqual((patient["current_cohort"], patient["current_actionable_bucket"]), ("C", "C3"))
+
+    def test_criteria_mismatch(self):
+        patient = {"id": "P002", "current_cohort": "A", "current_actionable_bucket": "A2", "status": "Lost"}
+        result = run(patient)
+        self.assertIn("does not meet the criteria", result["messages"][0])
+        self.assertEqual(patient["current_actionable_bucket"], "A2")
+
+    def test_end_lead_management(self):
+        patient = {"id": "P012", "current_cohort": "D", "current_actionable_bucket": "D1", "status": "Admitted"}
+        run(patient)
+        self.assertFalse(patient["lead_management_active"])
+
+
+class ChainedTransitionTests(SimpleTestCase):
+    def chain(self, patient, **kwargs):
+        with redirect_stdout(StringIO()):
+            return process_patient_until_stable(patient, COHORTS, defer_actions=True, **kwargs)
+
+    def test_follows_moves_until_stable(self):
+        patient = {"id": "P003", "current_cohort": "A", "current_actionable_bucket": "A1",
+                   "status": "IP Recommended", "clinical_intervention_required": False,
+                   "quotation_phase_required": True, "quotation_accepted": True}
+        result = self.chain(patient)
+        self.assertEqual(result["path"], [["A", "A1"], ["A", "A3"], ["A", "A4"]])
+        self.assertEqual(result["stopped"], "stable")
+        self.assertEqual(patient["status"], "Ready to Schedule Admission")
+        self.assertEqual([step["transition"]["rule_name"] for step in result["steps"][:2]],
+                         ["if_quotation_phase_needed", "on_quotation_accepted"])
+        self.assertIsNone(result["steps"][2]["transition"])
+        self.assertEqual([step["actions"][0] for step in result["steps"]],
+                         ["inform_recommendation", "provide_quotation", "follow_up_to_schedule_admission"])
+
+    def test_step_limit(self):
+        patient = {"id": "P003", "current_cohort": "A", "current_actionable_bucket": "A1",
+                   "status": "IP Recommended", "clinical_intervention_required": False,
+                   "quotation_phase_required": True, "quotation_accepted": True}
+        result = self.chain(patient, max_steps=1)
+        self.assertEqual((result["path"], result["stopped"]), ([["A", "A1"], ["A", "A3"]], "step_limit"))
+        self.assertEqual(patient["status"], "IP Recommended")
+
+    def test_stops_on_cycle(self):
+        patient = {"id": "P009", "current_cohort": "C", "current_actionable_bucket": "C1",
+                   "status": "Admission Postponed", "days_since_last_contact": CONFIG["Y"],
+                   "response_received": True}
+        result = self.chain(patient)
+        self.assertEqual(result["path"], [["C", "C1"], ["E", "E1"], ["C", "C1"]])
+        self.assertEqual(result["stopped"], "cycle")
+
+    def test_stops_when_lead_management_ends(self):
+        patient = {"id": "P012", "current_cohort": "D", "current_actionable_bucket": "D1", "status": "Admitted"}
+        result = self.chain(patient)
+        self.assertEqual((result["path"], result["stopped"]), ([["D", "D1"]], "ended"))
+
+
+class ProcessPatientViewTests(TestCase):
+    def test_saves_processed_state_and_extra_attributes(self):
+        patient = {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1",
+                   "status": "IP Recommended", "clinical_intervention_required": True,
+                   "days_since_last_contact": 2, "scheduled_date": "2030-01-01", "admission_status": "Scheduled"}
+        with redirect_stdout(StringIO()):
+            response = self.client.post("/api/process-patient/", json.dumps(patient), content_type="application/json")
+        self.assertEqual(response.json()["current_actionable_bucket"], "A2")
+        saved = Patient.objects.get(id="P001")
+        self.assertEqual(saved.current_actionable_bucket, "A2")
+        self.assertEqual(saved.attributes, {"admission_status": "Scheduled"})
+        self.assertEqual(saved.scheduled_date, datetime.date(2030, 1, 1))
+        self.assertEqual(saved.last_contact_date, datetime.date.today() - datetime.timedelta(days=2))
+
+    def test_repeat_post_updates_the_patient_with_one_lookup(self):
+        patient = {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1",
+                   "status": "IP Recommended", "clinical_intervention_required": True}
+        # Poll for the active rule set now rather than inside the captured requests
+        rulesets.refresh()
+        for _ in range(2):
+            with redirect_stdout(StringIO()), CaptureQueriesContext(connection) as queries:
+                response = self.client.post("/api/process-patient/", json.dumps(patient),
+                                            content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+            selects = [query["sql"] for query in queries if query["sql"].startswith("SELECT")]
+            self.assertEqual(len(selects), 1)
+        saved = Patient.objects.get(id="P001")
+        self.assertEqual((saved.current_actionable_bucket, saved.previous_bucket), ("A2", "A1"))
+        self.assertEqual(PatientTransition.objects.filter(patient_id="P001").count(), 2)
+
+
+    def test_chain_saves_every_move_and_the_final_status(self):
+        patient = {"id": "P003", "current_cohort": "A", "current_actionable_bucket": "A1",
+                   "status": "IP Recommended", "clinical_intervention_required": False,
+                   "quotation_phase_required": True, "quotation_accepted": True}
+        with redirect_stdout(StringIO()):
+            response = self.client.post("/api/process-patient/?chain=true", json.dumps(patient),
+                                        content_type="application/json")
+        self.assertEqual(response.json()["path"], [["A", "A1"], ["A", "A3"], ["A", "A4"]])
+        saved = Patient.objects.get(id="P003")
+        self.assertEqual((saved.current_actionable_bucket, saved.status), ("A4", "Ready to Schedule Admission"))
+        self.assertEqual(PatientTransition.objects.filter(patient_id="P003").count(), 2)
+        self.assertEqual(ActionJob.objects.filter(patient_id="P003").count(), 5)
+
+
+class PatientValidatorTests(SimpleTestCase):
+    def assertMatchesSerializer(self, data):
+        serializer = PatientUpsertSerializer(data=data)
+        if serializer.is_valid():
+            self.assertEqual(patient_validator.validate(data), dict(serializer.validated_data))
+            return
+        with self.assertRaises(ValidationError) as raised:
+            patient_validator.validate(data)
+        self.assertEqual(raised.exception.detail, serializer.errors)
+        self.assertEqual(list(raised.exception.detail), list(serializer.errors))
+
+    def test_matches_serializer(self):
+        base = {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1", "status": "Lost"}
+        self.assertMatchesSerializer(base)
+        self.assertMatchesSerializer({**base, "patient_ready": "true", "days_since_last_contact": "4.0",
+                                      "previous_cohort": None, "last_contact_date": "2024-01-02",
+                                      "scheduled_date": "2024-02-01", "next_due_date": "ignored"})
+        self.assertMatchesSerializer({"id": "P0000000001", "current_cohort": "", "status": None,
+                                      "patient_ready": "maybe", "days_since_last_contact": 1.5,
+                                      "previous_bucket": ["A1"], "last_contact_date": "01/02/2024"})
+        self.assertMatchesSerializer(["not", "a", "dict"])
+
+    def test_booleans_match_serializer(self):
+        base = {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1", "status": "Lost"}
+        for value in ["true", "True", "TRUE", "tRuE", "On", "yes", "Y", "1", 1, 1.0, "0", "off", "F", 0, 2, "",
+                      "null", None, "2", "truthy", True, False, []]:
+            with self.subTest(value=value):
+                self.assertMatchesSerializer({**base, "patient_ready": value})
+
+
+class AsyncProcessPatientViewTests(TestCase):
+    async def test_upserts_patient_and_enqueues_actions(self):
+        patient = {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1",
+                   "status": "IP Recommended", "clinical_intervention_required": True}
+        for _ in range(2):
+            response = await self.async_client.post("/api/process-patient-async/", json.dumps(patient),
+                                                    content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+            patient["current_actionable_bucket"] = "A1"
+        self.assertEqual(response.json()["current_actionable_bucket"], "A2")
+        saved = await Patient.objects.aget(id="P001")
+        self.assertEqual((saved.current_actionable_bucket, saved.previous_bucket), ("A2", "A1"))
+        self.assertEqual(await ActionJob.objects.filter(patient_id="P001").acount(), 4)
+        self.assertEqual(await PatientTransition.objects.filter(patient_id="P001").acount(), 2)
+
+    async def test_validation_errors(self):
+        response = await self.async_client.post("/api/process-patient-async/", json.dumps({"id": "P1"}),
+                                                content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("current_cohort", response.json())
+
+
+class BulkProcessViewTests(TestCase):
+    def post(self, body, content_type="application/json"):
+        with redirect_stdout(StringIO()):
+            return self.client.post("/api/process-patients/", body, content_type=content_type)
+
+    def test_array_body_upserts_in_input_order(self):
+        Patient.objects.create(id="P002", current_cohort="A", current_actionable_bucket="A1", status="IP Recommended")
+        patients = [
+            {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1",
+             "status": "IP Recommended", "clinical_intervention_required": True},
+            {"id": "P002", "current_cohort": "A", "current_actionable_bucket": "A1",
+             "status": "IP Recommended", "clinical_intervention_required": False,
+             "quotation_phase_required": False, "patient_ready": True},
+            {"id": "P003", "current_cohort": "A"},
+        ]
+        response = self.post(json.dumps(patients))
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual([result["patient_id"] for result in body["results"]], ["P001", "P002", "P003"])
+        self.assertEqual([result["status"] for result in body["results"]], [200, 200, 400])
+        self.assertEqual((body["created"], body["updated"], body["errors"]), (1, 1, 1))
+        self.assertEqual(Patient.objects.get(id="P001").current_actionable_bucket, "A2")
+        self.assertEqual(Patient.objects.get(id="P002").current_actionable_bucket, "A4")
+
+    def test_duplicate_ids_are_rejected(self):
+        patient = {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1",
+                   "status": "IP Recommended", "clinical_intervention_required": True}
+        response = self.post(json.dumps([patient, dict(patient, clinical_intervention_required=False)]))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("P001", response.json()["error"])
+        self.assertFalse(Patient.objects.exists())
+        self.assertFalse(PatientTransition.objects.exists())
+        with self.assertRaisesRegex(ValueError, "Duplicate patient ids: P001"):
+            upsert_patients([patient_validator.validate(patient)] * 2)
+
+    def test_ndjson_body(self):
+        lines = "\n".join(json.dumps({"id": f"P{i}", "current_cohort": "D", "current_actionable_bucket": "D1",
+                                      "status": "Admitted"}) for i in range(3))
+        response = self.post(lines, content_type="application/x-ndjson")
+        self.assertEqual(response.json()["created"], 3)
+        self.assertFalse(Patient.objects.filter(lead_management_active=True).exists())
+
+    def test_invalid_json(self):
+        self.assertEqual(self.post("[{").status_code, 400)
+
+
+def random_patient(rng, index):
+    buckets = iter_buckets(get_compiled(COHORTS))
+    bucket = rng.choice(buckets)
+    statuses = [term.operand for b in buckets for term in b.criteria_terms if term.key == "status"]
+    today = datetime.date.today()
+    patient = {
+        "id": f"P{index}",
+        "current_cohort": bucket.cohort if rng.random() > 0.02 else "Z",
+        "current_actionable_bucket": bucket.bucket,
+        "status": rng.choice(statuses),
+        "reason": rng.choice(["Declined or Unresponsive", "Other"]),
+        "admission_status": rng.choice(["Postponed", "Cancelled", "Scheduled"]),
+    }
+    for key in ["clinical_intervention_required", "quotation_phase_required", "patient_ready",
+                "clinical_intervention_completed", "quotation_accepted", "scheduled_admission",
+                "admission_completed", "response_received", "scheduled_date_exists"]:
+        choice = rng.random()
+        if choice < 0.45:
+            patient[key] = True
+        elif choice < 0.9:
+            patient[key] = False
+        elif choice < 0.95:
+            patient[key] = None
+    for key in ["days_since_last_contact", "days_until_admission", "follow_up_attempts"]:
+        choice = rng.random()
+        if choice < 0.85:
+            patient[key] = rng.randint(-2, 9)
+        elif choice < 0.9:
+            patient[key] = None
+        elif choice < 0.95:
+            patient[key] = "x"
+    if rng.random() < 0.5:
+        previous = rng.choice(buckets)
+        patient["previous_cohort"], patient["previous_bucket"] = previous.cohort, previous.bucket
+    for key in ["scheduled_date", "new_scheduled_date"]:
+        if rng.random() < 0.8:
+            patient[key] = (today + datetime.timedelta(days=rng.randint(-3, 5))).strftime("%Y-%m-%d")
+    return patient
+
+
+class VectorizedEngineTests(SimpleTestCase):
+    def test_matches_process_patient(self):
+        rng = random.Random(7)
+        patients = [random_patient(rng, index) for index in range(3000)]
+        result = evaluate_batch(PatientBatch.from_records(patients))
+        pairs = result.target_pairs()
+        for row, patient in enumerate(patients):
+            run(patient)
+            expected = (patient["current_cohort"], patient["current_actionable_bucket"])
+            self.assertEqual(pairs[row] or expected, expected, patient)
+            self.assertEqual(bool(result.ends_lead_management[row]),
+                             patient.get("lead_management_active") is False, patient)
+        self.assertGreater(int((result.target != result.current).sum()), 100)
+
+
+class SweeperTests(TestCase):
+    def test_next_due_date(self):
+        today = datetime.date(2024, 11, 1)
+        patient = {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A3",
+                   "status": "Quotation Phase Required", "quotation_accepted": False, "days_since_last_contact": 2}
+        self.assertEqual(next_due_date(patient, today), today + datetime.timedelta(days=CONFIG["Y"] - 2))
+        patient["status"] = "Lost"
+        self.assertIsNone(next_due_date(patient, today))
+        scheduled = {"id": "P2", "current_cohort": "B", "current_actionable_bucket": "B1",
+                     "status": "Admission Scheduled", "scheduled_date_exists": True,
+                     "scheduled_date": "2024-11-10", "days_until_admission": 9, "admission_completed": False}
+        self.assertEqual(next_due_date(scheduled, today), datetime.date(2024, 11, 1 + 9 - CONFIG["Z"]))
+
+    def test_sweep_moves_only_due_patients(self):
+        body = [
+            {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A3",
+             "status": "Quotation Phase Required", "quotation_accepted": False, "days_since_last_contact": 3},
+            {"id": "P2", "current_cohort": "A", "current_actionable_bucket": "A3",
+             "status": "Quotation Phase Required", "quotation_accepted": False, "days_since_last_contact": 0},
+        ]
+        with redirect_stdout(StringIO()):
+            self.client.post("/api/process-patients/", json.dumps(body), content_type="application/json")
+        today = datetime.date.today()
+        self.assertEqual(Patient.objects.get(id="P1").next_due_date, today + datetime.timedelta(days=CONFIG["Y"] - 3))
+
+        as_of = today + datetime.timedelta(days=CONFIG["Y"] - 3)
+        with redirect_stdout(StringIO()) as out:
+            call_command("sweep_patients", as_of=as_of)
+        self.assertIn("Swept 1 due patients", out.getvalue())
+        p1, p2 = Patient.objects.order_by("id")
+        self.assertEqual((p1.current_cohort, p1.current_actionable_bucket), ("C", "C3"))
+        self.assertEqual(p1.days_since_last_contact, CONFIG["Y"])
+        self.assertEqual(p2.current_actionable_bucket, "A3")
+
+
+    def test_sweep_evaluates_dates_as_of_its_day(self):
+        Patient.objects.create(id="P1", current_cohort="B", current_actionable_bucket="B1",
+                               status="Admission Scheduled", attributes={"scheduled_date_exists": True},
+                               scheduled_date=datetime.date(2024, 11, 10), next_due_date=datetime.date(2024, 11, 1))
+        counters.rebuild()
+        with redirect_stdout(StringIO()):
+            stats = sweep_due_patients(datetime.date(2024, 11, 10) - datetime.timedelta(days=CONFIG["Z"]))
+        self.assertEqual(stats["moved"], 1)
+        self.assertEqual(Patient.objects.get(id="P1").current_actionable_bucket, "B2")
+
+
+class ProcessAllTests(TestCase):
+    def setUp(self):
+        for number in range(7):
+            Patient.objects.create(id=f"P{number}", current_cohort="A", current_actionable_bucket="A3",
+                                   status="Quotation Phase Required", attributes={"quotation_accepted": False},
+                                   last_contact_date=datetime.date(2024, 11, 1))
+        Patient.objects.create(id="P9", current_cohort="A", current_actionable_bucket="A3",
+                               status="Lost", lead_management_active=False)
+        counters.rebuild()
+
+    def test_shards_split_active_patients_by_id(self):
+        shards = shard_ranges(3)
+        self.assertEqual(len(shards), 3)
+        ids = [patient_id for shard in shards for patient_id in shard_patients(shard).values_list("id", flat=True)]
+        self.assertEqual(sorted(ids), [f"P{number}" for number in range(7)])
+        self.assertEqual(shard_ranges(20)[-1], ("P5", None))
+
+    def test_processes_every_active_patient(self):
+        as_of = datetime.date(2024, 11, 1) + datetime.timedelta(days=CONFIG["Y"])
+        progress = []
+        with redirect_stdout(StringIO()):
+            stats = process_all(as_of, progress=lambda stats, done, total: progress.append((done, total)))
+        self.assertEqual((stats["processed"], stats["moved"]), (7, 7))
+        self.assertEqual(progress, [(1, 1)])
+        self.assertEqual(set(Patient.objects.filter(lead_management_active=True)
+                             .values_list("current_actionable_bucket", flat=True)), {"C3"})
+        self.assertEqual(Patient.objects.get(id="P9").version, 0)
+
+        with redirect_stdout(StringIO()) as out:
+            call_command("process_all", workers=1, as_of=as_of)
+        self.assertIn("Processed 7 active patients", out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("process_all", workers=0)
+
+
+class VersionConflictTests(TestCase):
+    def setUp(self):
+        self.patient = Patient.objects.create(id="P1", current_cohort="A", current_actionable_bucket="A1",
+                                              status="IP Recommended")
+
+    def write_concurrently(self, **fields):
+        Patient.objects.filter(pk="P1").update(version=F("version") + 1, **fields)
+
+    def test_stale_writes_are_rejected(self):
+        stale = Patient.objects.get(pk="P1")
+        self.write_concurrently(status="Unresponsive")
+        with self.assertRaises(VersionConflict):
+            save_processed_patient(stale, {"current_actionable_bucket": "A2"}, [])
+        with self.assertRaises(VersionConflict):
+            upsert_patients([{"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A2"}], [],
+                            {"P1": stale})
+        with self.assertRaises(VersionConflict):
+            save_processed_patient(None, {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A2"}, [])
+        patient = Patient.objects.get(pk="P1")
+        self.assertEqual((patient.status, patient.current_actionable_bucket, patient.version),
+                         ("Unresponsive", "A1", 1))
+
+        saved = save_processed_patient(patient, {"current_actionable_bucket": "A2"}, [])
+        self.assertEqual(saved.version, 2)
+        self.assertEqual(Patient.objects.get(pk="P1").version, 2)
+
+    def test_view_re_evaluates_after_a_concurrent_write(self):
+        from api import views
+        calls = []
+
+        def evaluate_during_a_concurrent_write(patient_data, *args):
+            calls.append(patient_data.get("previous_bucket"))
+            if len(calls) == 1:
+                self.write_concurrently(previous_cohort="E", previous_bucket="E1")
+            return evaluate(patient_data, *args)
+
+        evaluate = views.evaluate_patient
+        body = {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A1", "status": "IP Recommended",
+                "clinical_intervention_required": True}
+        with mock.patch.object(views, "evaluate_patient", evaluate_during_a_concurrent_write), \
+                redirect_stdout(StringIO()):
+            response = self.client.post("/api/process-patient/", json.dumps(body), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, [None, "E1"])
+        self.assertEqual(Patient.objects.get(pk="P1").version, 2)
+        self.assertEqual(PatientTransition.objects.count(), 1)
+
+        def always_conflicting(patient_data, *args):
+            self.write_concurrently()
+            return evaluate(patient_data, *args)
+
+        with mock.patch.object(views, "evaluate_patient", always_conflicting), redirect_stdout(StringIO()):
+            response = self.client.post("/api/process-patients/", json.dumps([body]),
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(PatientTransition.objects.count(), 1)
+
+    def test_sweeper_re_reads_patients_written_concurrently(self):
+        Patient.objects.filter(pk="P1").update(current_actionable_bucket="A3", status="Quotation Phase Required",
+                                               next_due_date=datetime.date(2024, 11, 1), days_since_last_contact=0,
+                                               last_contact_date=datetime.date(2024, 10, 1))
+        counters.rebuild()
+        from api import services
+        calls = []
+
+        def evaluate_during_a_concurrent_write(record, *args, **kwargs):
+            calls.append(record["status"])
+            if len(calls) == 1:
+                self.write_concurrently(status="Quotation Accepted", quotation_accepted=True)
+            return evaluate(record, *args, **kwargs)
+
+        evaluate = services.evaluate_patient
+        with mock.patch.object(services, "evaluate_patient", evaluate_during_a_concurrent_write), \
+                redirect_stdout(StringIO()):
+            stats = services.sweep_due_patients(datetime.date(2024, 11, 1))
+        self.assertEqual(calls, ["Quotation Phase Required", "Quotation Accepted"])
+        self.assertEqual((stats["processed"], stats["conflicts"]), (1, 0))
+        self.assertEqual(Patient.objects.get(pk="P1").version, 2)
+        self.assertEqual(counters.drift(), [])
+
+
+class ConcurrentWritersTests(TransactionTestCase):
+    def setUp(self):
+        patient_cache.clear()
+        self.addCleanup(patient_cache.clear)
+
+    def test_no_write_is_lost(self):
+        Patient.objects.create(id="P1", current_cohort="A", current_actionable_bucket="A4",
+                               status="Ready to Schedule Admission")
+        statuses = []
+        barrier = threading.Barrier(4)
+
+        def post(days):
+            try:
+                body = {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A4",
+                        "status": "Ready to Schedule Admission", "days_since_last_contact": days}
+                barrier.wait()
+                response = self.client_class().post("/api/process-patient/", json.dumps(body),
+                                                    content_type="application/json")
+                statuses.append(response.status_code)
+            finally:
+                connection.close()
+
+        with redirect_stdout(StringIO()):
+            threads = [threading.Thread(target=post, args=(days,)) for days in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # Every conflict means another writer succeeded, so four writers need at most three retries
+        self.assertEqual(statuses, [200] * 4)
+        self.assertEqual(Patient.objects.get(pk="P1").version, 4)
+
+
+class PatientCacheTests(SimpleTestCase):
+    def values(self, patient_id, version=0):
+        return patient_cache._snapshot(Patient(id=patient_id, current_cohort="A", current_actionable_bucket="A1",
+                                               status="IP Recommended", version=version))
+
+    def test_least_recently_used_and_expired_entries_are_dropped(self):
+        cache = patient_cache.PatientCache(max_size=2, ttl=10)
+        with mock.patch("api.patient_cache.time.monotonic", return_value=100):
+            cache.put([("P1", self.values("P1")), ("P2", self.values("P2"))])
+            cache.get("P1")
+            cache.put([("P3", self.values("P3"))])
+            self.assertIsNone(cache.get("P2"))
+            self.assertIsNotNone(cache.get("P1"))
+        with mock.patch("api.patient_cache.time.monotonic", return_value=110):
+            self.assertIsNone(cache.get("P3"))
+        self.assertEqual(len(cache), 1)
+
+    def test_older_versions_do_not_replace_newer_ones(self):
+        cache = patient_cache.PatientCache(max_size=10, ttl=10)
+        cache.put([("P1", self.values("P1", version=3))])
+        cache.put([("P1", self.values("P1", version=2))])
+        self.assertEqual(patient_cache._patient(cache.get("P1")).version, 3)
+
+
+class PatientCacheViewTests(TransactionTestCase):
+    def setUp(self):
+        patient_cache.clear()
+        self.addCleanup(patient_cache.clear)
+        # Poll for the active rule set now rather than inside the captured requests
+        rulesets.refresh()
+        self.addCleanup(setattr, rulesets, "_checked_at", None)
+
+    def post(self, body):
+        with redirect_stdout(StringIO()), CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/api/process-patient/", json.dumps(body), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return [query["sql"] for query in queries if query["sql"].startswith("SELECT")]
+
+    def hits(self):
+        return metrics.collect().counters.get((metrics.PATIENT_CACHE, ("hit",)), 0)
+
+    def test_repeat_posts_are_served_from_the_cache(self):
+        body = {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A1", "status": "IP Recommended"}
+        self.assertEqual(len(self.post(body)), 1)
+        hits = self.hits()
+        body["clinical_intervention_required"] = True
+        self.assertEqual(self.post(body), [])
+        self.assertEqual(self.hits(), hits + 1)
+        patient = Patient.objects.get(pk="P1")
+        self.assertEqual((patient.current_actionable_bucket, patient.version), ("A2", 1))
+
+        # Written by another process: the cached row is stale until the write-back fails
+        Patient.objects.filter(pk="P1").update(previous_cohort="E", previous_bucket="E1", version=5)
+        body.update(current_actionable_bucket="A2", status="Quotation Phase Required")
+        self.assertEqual(len(self.post(body)), 1)
+        patient = Patient.objects.get(pk="P1")
+        self.assertEqual((patient.version, patient.previous_bucket), (6, "E1"))
+        self.assertEqual(patient_cache.get_patient("P1").version, 6)
+
+
+class PatientQueueViewTests(TestCase):
+    def setUp(self):
+        today = datetime.date.today()
+        # The stored days_since_last_contact is stale on purpose; the queue goes by the date
+        Patient.objects.bulk_create([
+            Patient(id=f"P{index:03d}", current_cohort="A", current_actionable_bucket="A4",
+                    status="Ready to Schedule Admission", days_since_last_contact=0,
+                    last_contact_date=today - datetime.timedelta(days=index % 4) if index % 7 else None)
+            for index in range(23)
+        ] + [Patient(id="X1", current_cohort="A", current_actionable_bucket="A4", status="Lost",
+                     last_contact_date=today - datetime.timedelta(days=9), lead_management_active=False)])
+
+    def test_keyset_pages_cover_queue_in_staleness_order(self):
+        seen = []
+        cursor = None
+        while True:
+            params = {"bucket": "A4", "limit": 5}
+            if cursor:
+                params["cursor"] = cursor
+            body = self.client.get("/api/patients/", params).json()
+            seen.extend((row["days_since_last_contact"], row["id"]) for row in body["results"])
+            cursor = body["next_cursor"]
+            if not cursor:
+                break
+        today = datetime.date.today()
+        active = Patient.objects.filter(lead_management_active=True).values_list("last_contact_date", "id")
+        expected = [((today - contact_date).days if contact_date else 0, patient_id)
+                    for contact_date, patient_id in sorted(active, key=lambda row: (row[0] is None, row[0], row[1]))]
+        self.assertEqual(seen, expected)
+        self.assertEqual(seen[0], (3, "P003"))
+        self.assertEqual(seen[-1], (0, "P021"))
+
+    def test_queue_query_uses_index(self):
+        plan = Patient.objects.filter(current_cohort="A", current_actionable_bucket="A4",
+                                      lead_management_active__in=[True],
+                                      last_contact_date__gt=datetime.date.today()) \
+            .order_by("last_contact_date", "id").explain()
+        self.assertIn("patient_queue_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+        plan = Patient.objects.filter(current_cohort="A", current_actionable_bucket="A4",
+                                      lead_management_active__in=[True],
+                                      last_contact_date__isnull=True, id__gt="P").order_by("id").explain()
+        self.assertIn("patient_queue_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+        plan = Patient.objects.filter(lead_management_active=True, next_due_date__lte=datetime.date.today()) \
+            .order_by("next_due_date", "id").explain()
+        self.assertIn("patient_due_idx", plan)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get("/api/patients/", {"cursor": "nope"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/patients/", {"active": "maybe"}).status_code, 400)
+
+
+class TransitionHistoryTests(TestCase):
+    def post(self, patient):
+        with redirect_stdout(StringIO()):
+            return self.client.post("/api/process-patients/", json.dumps([patient]), content_type="application/json")
+
+    def test_reengaged_patient_returns_to_previous_bucket(self):
+        self.post({"id": "P9", "current_cohort": "C", "current_actionable_bucket": "C1",
+                   "status": "Admission Postponed", "days_since_last_contact": CONFIG["Y"]})
+        patient = Patient.objects.get(id="P9")
+        self.assertEqual((patient.current_actionable_bucket, patient.previous_bucket), ("E1", "C1"))
+
+        self.post({"id": "P9", "current_cohort": "E", "current_actionable_bucket": "E1",
+                   "status": "Unresponsive", "response_received": True})
+        patient.refresh_from_db()
+        self.assertEqual((patient.current_cohort, patient.current_actionable_bucket), ("C", "C1"))
+
+        history = list(patient.transitions.order_by("created_at", "id")
+                       .values_list("from_bucket", "to_bucket", "rule_name"))
+        self.assertEqual(history, [("C1", "E1", "on_no_response"), ("E1", "C1", "on_patient_reengaged")])
+
+    def test_transitions_are_append_only(self):
+        self.post({"id": "P12", "current_cohort": "D", "current_actionable_bucket": "D1", "status": "Admitted"})
+        transition = PatientTransition.objects.get()
+        self.assertEqual(transition.action, "end_lead_management")
+        with self.assertRaises(ValueError):
+            transition.save()
+
+
+@override_settings(CHANGE_FEED_POLL_INTERVAL=0.01, CHANGE_FEED_STREAM_SECONDS=0.05)
+class ChangeFeedTests(TestCase):
+    def setUp(self):
+        for patient in ({"id": "P9", "current_cohort": "C", "current_actionable_bucket": "C1",
+                         "status": "Admission Postponed", "days_since_last_contact": CONFIG["Y"]},
+                        {"id": "P12", "current_cohort": "D", "current_actionable_bucket": "D1", "status": "Admitted"}):
+            with redirect_stdout(StringIO()):
+                self.client.post("/api/process-patients/", json.dumps([patient]), content_type="application/json")
+        self.sequences = list(PatientTransition.objects.order_by("id").values_list("id", flat=True))
+        staff = User.objects.create_user("staff", is_staff=True)
+        self.client.force_login(staff)
+        self.async_client.force_login(staff)
+
+    def test_feed_is_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self.client.get("/api/changes/", {"wait": 0}).status_code, 401)
+        self.client.force_login(User.objects.create_user("clinician"))
+        self.assertEqual(self.client.get("/api/changes/stream/").status_code, 403)
+
+    def test_long_poll_pages_through_transitions(self):
+        response = self.client.get("/api/changes/", {"limit": 1, "wait": 0})
+        first = response.json()
+        self.assertEqual([(row["sequence"], row["patient_id"], row["action"]) for row in first["results"]],
+                         [(self.sequences[0], "P9", "move_to_actionable_bucket")])
+        rest = self.client.get("/api/changes/", {"cursor": first["next_cursor"], "wait": 0}).json()
+        self.assertEqual([(row["patient_id"], row["action"]) for row in rest["results"]],
+                         [("P12", "end_lead_management")])
+        done = self.client.get("/api/changes/", {"cursor": rest["next_cursor"], "wait": 0}).json()
+        self.assertEqual(done, {"results": [], "next_cursor": self.sequences[-1]})
+        self.assertEqual(self.client.get("/api/changes/", {"cursor": "-1"}).status_code, 400)
+
+    def test_long_poll_waits_for_a_transition(self):
+        row = {"sequence": 99, "patient_id": "P9"}
+        with mock.patch.object(changefeed, "changes_after", side_effect=[[], [], [row]]) as changes_after:
+            response = self.client.get("/api/changes/", {"cursor": self.sequences[-1], "wait": 5})
+        self.assertEqual(response.json(), {"results": [row], "next_cursor": 99})
+        self.assertEqual(changes_after.call_count, 3)
+
+    def test_event_stream_resumes_after_last_event_id(self):
+        response = self.client.get("/api/changes/stream/", HTTP_LAST_EVENT_ID=str(self.sequences[0]))
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join(response.streaming_content).decode()
+        self.assertNotIn(f"id: {self.sequences[0]}\n", body)
+        self.assertIn(f"id: {self.sequences[1]}\nevent: transition\ndata: ", body)
+        self.assertIn('"action": "end_lead_management"', body)
+
+    async def test_event_stream_under_asgi(self):
+        response = await self.async_client.get("/api/changes/stream/", {"cursor": 0})
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual(body.count("event: transition"), 2)
+
+
+class RuleSetTests(TestCase):
+    def setUp(self):
+        # The next current_rules() after the test re-reads the (rolled back) active version
+        self.addCleanup(setattr, rulesets, "_checked_at", None)
+
+    def a3_document(self, days):
+        document = rulesets.builtin_document()
+        document["config"]["Y"] = days
+        rule = document["cohorts"]["A"]["actionable_buckets"]["A3"]["disposition_rules"]["on_no_response"]
+        rule["condition"]["days_since_last_contact"] = ">= {Y}"
+        return document
+
+    def post(self, patient):
+        with redirect_stdout(StringIO()):
+            return self.client.post("/api/process-patient/", json.dumps(patient), content_type="application/json")
+
+    def test_activated_version_is_swapped_in_and_recorded(self):
+        patient = {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A3",
+                   "status": "Quotation Phase Required", "quotation_accepted": False,
+                   "days_since_last_contact": CONFIG["Y"]}
+        ruleset = rulesets.create_ruleset(self.a3_document(CONFIG["Y"] + 2), activate=True)
+        self.assertIs(rulesets.refresh(), rulesets.current_rules())
+        self.assertEqual(rulesets.current_rules().version, ruleset.version)
+
+        self.assertEqual(self.post(patient).json()["current_actionable_bucket"], "A3")
+        self.assertEqual(Patient.objects.get(id="P1").rule_version, ruleset.version)
+
+        rulesets.activate_version(rulesets.BUILTIN_VERSION)
+        rulesets.refresh()
+        self.assertEqual(self.post(patient).json()["current_actionable_bucket"], "C3")
+        transition = PatientTransition.objects.get(patient_id="P1")
+        self.assertEqual((transition.rule_name, transition.rule_version), ("on_no_response", 0))
+
+    def test_invalid_documents_are_rejected(self):
+        document = self.a3_document(7)
+        document["cohorts"]["A"]["actionable_buckets"]["A3"]["actions"].append("send_fax")
+        with self.assertRaisesRegex(ValueError, "unknown action 'send_fax'"):
+            rulesets.create_ruleset(document)
+        document = self.a3_document(7)
+        del document["config"]["Y"]
+        with self.assertRaisesRegex(ValueError, "Unknown config value"):
+            rulesets.create_ruleset(document)
+        self.assertFalse(RuleSet.objects.exists())
+
+    def test_rules_command_checks_rules(self):
+        out = StringIO()
+        call_command("rules", "check", stdout=out)
+        self.assertIn("A.A1 if_both_needed: shadowed (if_clinical_intervention_needed matches first)",
+                      out.getvalue())
+        self.assertIn("2 rule(s) can never fire.", out.getvalue())
+        with self.assertRaisesRegex(CommandError, "Rule check failed"):
+            call_command("rules", "check", "--strict", stdout=StringIO())
+
+    def test_rules_command_runs_with_system_checks(self):
+        for subcommand in ("list", "check"):
+            call_command("rules", subcommand, skip_checks=False, stdout=StringIO())
+
+    def test_rules_command_imports_and_activates(self):
+        with redirect_stdout(StringIO()) as out:
+            call_command("rules", "export", stdout=out)
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as document_file:
+            document_file.write(out.getvalue())
+            document_file.flush()
+            with redirect_stdout(StringIO()) as out:
+                call_command("rules", "import", document_file.name, "--activate", stdout=out)
+        self.assertIn("Stored rule set version 1 (active)", out.getvalue())
+        self.assertEqual(RuleSet.objects.get(is_active=True).document, rulesets.builtin_document())
+
+
+class BucketCounterTests(TestCase):
+    def post(self, url, body):
+        with redirect_stdout(StringIO()):
+            response = self.client.post(url, json.dumps(body), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_counters_follow_every_state_change(self):
+        self.post("/api/process-patient/", {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A1",
+                                            "status": "IP Recommended", "clinical_intervention_required": True})
+        self.post("/api/process-patient/", {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A2",
+                                            "status": "Clinical Intervention Required"})
+        self.post("/api/process-patients/", [
+            {"id": "P2", "current_cohort": "D", "current_actionable_bucket": "D1", "status": "Admitted"},
+            {"id": "P3", "current_cohort": "A", "current_actionable_bucket": "A3",
+             "status": "Quotation Phase Required", "quotation_accepted": False, "days_since_last_contact": 1},
+        ])
+        as_of = datetime.date.today() + datetime.timedelta(days=CONFIG["Y"])
+        with redirect_stdout(StringIO()):
+            call_command("sweep_patients", as_of=as_of)
+        self.assertEqual(counters.drift(), [])
+
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/bucket-counts/")
+        self.assertEqual(response.json(), {"results": [
+            {"cohort": "A", "bucket": "A2", "count": 1},
+            {"cohort": "C", "bucket": "C3", "count": 1},
+        ], "total": 2})
+        self.assertEqual(self.client.get("/api/bucket-counts/?active=false").json()["results"],
+                         [{"cohort": "D", "bucket": "D1", "count": 1}])
+        self.assertEqual(self.client.get("/api/bucket-counts/?active=any").json()["total"], 3)
+
+    def test_rebuild_repairs_drift(self):
+        Patient.objects.create(id="P9", current_cohort="A", current_actionable_bucket="A4",
+                               status="Ready to Schedule Admission")
+        with redirect_stdout(StringIO()) as out, self.assertRaises(SystemExit):
+            call_command("rebuild_bucket_counters", "--check", stdout=out)
+        self.assertIn("A.A4 (active): counter 0, actual 1", out.getvalue())
+        with redirect_stdout(StringIO()) as out:
+            call_command("rebuild_bucket_counters", stdout=out)
+        self.assertIn("1 corrected", out.getvalue())
+        self.assertEqual(counters.drift(), [])
+
+
+class ImportPatientsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, text):
+        path = f"{self.directory}/{name}"
+        with open(path, "w", encoding="utf-8") as import_file:
+            import_file.write(text)
+        return path
+
+    def test_csv_import_resumes_after_a_failed_batch(self):
+        path = self.write("leads.csv", "\ufeffid,current_cohort,current_actionable_bucket,status,days_since_last_contact,"
+                                       "response_received\n"
+                          "P1,A,A1,IP Recommended,2,\n"
+                          "P2,A,A3,Quotation Phase Required,,true\n"
+                          "P3,A,A1,IP Recommended,not a number,\n"
+                          "P4,E,E1,Unresponsive,9,false\n"
+                          "P5,A,A4,\"Ready to Schedule Admission\",1,\n")
+        from api.management.commands import import_patients
+        calls = []
+
+        def failing_second_batch(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError("database went away")
+            return import_batch(*args, **kwargs)
+
+        import_batch = import_patients.import_batch
+        with mock.patch.object(import_patients, "import_batch", failing_second_batch), \
+                self.assertRaises(RuntimeError):
+            call_command("import_patients", path, "--batch-size", "2", stdout=StringIO())
+        self.assertEqual(sorted(Patient.objects.values_list("id", flat=True)), ["P1", "P2"])
+
+        out = StringIO()
+        call_command("import_patients", path, "--batch-size", "2", stdout=out)
+        self.assertIn("Resuming after record 2.", out.getvalue())
+        self.assertIn("Imported 4 patients, rejected 1 records", out.getvalue())
+        self.assertEqual(sorted(Patient.objects.values_list("id", flat=True)), ["P1", "P2", "P4", "P5"])
+        self.assertEqual(Patient.objects.get(id="P2").attributes, {"response_received": True})
+        self.assertEqual(Patient.objects.get(id="P4").days_since_last_contact, 9)
+        self.assertFalse(os.path.exists(path + ".checkpoint"))
+        with open(path + ".errors") as errors_file:
+            rejected = [json.loads(line) for line in errors_file]
+        self.assertEqual([(error["record"], error["id"]) for error in rejected], [(3, "P3")])
+        self.assertIn("days_since_last_contact", rejected[0]["errors"])
+        self.assertEqual(counters.drift(), [])
+
+    def test_ndjson_import_runs_the_rule_engine(self):
+        path = self.write("leads.ndjson", "\n".join(json.dumps(patient) for patient in [
+            {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A1", "status": "IP Recommended",
+             "clinical_intervention_required": True},
+            {"id": "P2", "current_cohort": "D", "current_actionable_bucket": "D1", "status": "Admitted"},
+        ]) + "\n{not json\n")
+        call_command("import_patients", path, "--process", stdout=StringIO())
+        self.assertEqual(Patient.objects.get(id="P1").current_actionable_bucket, "A2")
+        self.assertFalse(Patient.objects.get(id="P2").lead_management_active)
+        self.assertEqual(PatientTransition.objects.count(), 2)
+        self.assertFalse(ActionJob.objects.exists())
+
+    def test_a_later_record_of_the_same_patient_wins(self):
+        path = self.write("leads.ndjson", "\n".join(json.dumps(patient) for patient in [
+            {"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A1", "status": "IP Recommended",
+             "clinical_intervention_required": True},
+            {"id": "P1", "current_cohort": "D", "current_actionable_bucket": "D1", "status": "Admitted"},
+        ]))
+        call_command("import_patients", path, "--process", stdout=StringIO())
+        self.assertFalse(Patient.objects.get(id="P1").lead_management_active)
+        self.assertEqual(list(PatientTransition.objects.values_list("action", flat=True)), ["end_lead_management"])
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        Patient.objects.bulk_create([
+            Patient(id=f"P{index}", current_cohort="A", current_actionable_bucket="A1",
+                    status="123" if index == 2 else "IP Recommended", days_since_last_contact=index,
+                    attributes={"response_received": True} if index == 1 else {})
+            for index in range(1, 6)
+        ])
+        self.client.force_login(User.objects.create_user("staff", is_staff=True))
+
+    def stream(self, response):
+        return b"".join(response.streaming_content).decode("utf-8")
+
+    def test_export_is_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self.client.get("/api/export/patients/").status_code, 401)
+        self.client.force_login(User.objects.create_user("clinician"))
+        self.assertEqual(self.client.get("/api/export/transitions/").status_code, 403)
+
+    def test_ndjson_export_is_paged_and_incremental(self):
+        export = export_patients(chunk_size=2)
+        self.assertEqual([row["id"] for row in export.rows], ["P1", "P2", "P3", "P4", "P5"])
+
+        response = self.client.get("/api/export/patients/")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in self.stream(response).splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]["attributes"], {"response_received": True})
+        cursor = response["X-Export-Cursor"]
+
+        response = self.client.get("/api/export/patients/", {"cursor": cursor})
+        self.assertEqual(self.stream(response), "")
+        self.assertEqual(response["X-Export-Cursor"], cursor)
+
+        patient = Patient.objects.get(id="P3")
+        patient.status = "Unresponsive"
+        patient.save()
+        response = self.client.get("/api/export/patients/", {"cursor": cursor})
+        rows = [json.loads(line) for line in self.stream(response).splitlines()]
+        self.assertEqual([(row["id"], row["status"]) for row in rows], [("P3", "Unresponsive")])
+
+        since = patient.updated_at.isoformat()
+        response = self.client.get("/api/export/patients/", {"since": since, "format": "csv"})
+        self.assertEqual(self.stream(response).splitlines()[1].split(",")[0], "P3")
+        self.assertEqual(self.client.get("/api/export/patients/", {"cursor": "nope"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/export/patients/", {"since": "yesterday"}).status_code, 400)
+
+    def test_csv_export_reads_back_through_the_importer(self):
+        text = self.stream(self.client.get("/api/export/patients/", {"format": "csv"}))
+        records = list(read_records(StringIO(text), CSV))
+        self.assertEqual(records[1]["status"], "123")
+        self.assertEqual(records[0]["attributes"], {"response_received": True})
+        self.assertEqual(records[3]["days_since_last_contact"], 4)
+        self.assertNotIn("next_due_date", records[0])
+
+    def test_transition_export_command(self):
+        patient = Patient.objects.get(id="P1")
+        PatientTransition.objects.create(patient=patient, from_cohort="A", from_bucket="A1", to_cohort="A",
+                                         to_bucket="A2", rule_name="first", action="move")
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/transitions.ndjson"
+            err = StringIO()
+            call_command("export_patients", "--transitions", "--output", path, stderr=err)
+            with open(path) as export_file:
+                self.assertEqual([json.loads(line)["rule_name"] for line in export_file], ["first"])
+            self.assertIn("Exported 1 rows.", err.getvalue())
+            cursor = err.getvalue().split("Next cursor: ")[1].strip()
+
+            PatientTransition.objects.create(patient=patient, from_cohort="A", from_bucket="A2", to_cohort="A",
+                                             to_bucket="A3", rule_name="second", action="move")
+            out = StringIO()
+            call_command("export_patients", "--transitions", "--cursor", cursor, stdout=out, stderr=StringIO())
+            self.assertEqual([json.loads(line)["rule_name"] for line in out.getvalue().splitlines()], ["second"])
+
+
+class SimulationTests(TestCase):
+    def store(self, patients, as_of):
+        rows = []
+        with redirect_stdout(StringIO()):
+            for patient in patients:
+                validated = patient_validator.validate(patient)
+                validated.update(processed_fields(dict(patient), validated, as_of, rulesets.BUILTIN_RULES))
+                rows.append(validated)
+        upsert_patients(rows)
+
+    def test_first_day_matches_process_patient(self):
+        as_of = datetime.date.today()
+        self.store(itertools.islice(generate_patients(3, as_of), 400), as_of)
+        snapshot = load_snapshot(required_columns([rulesets.BUILTIN_RULES]), as_of)
+        day = simulate(snapshot, rulesets.BUILTIN_RULES, 1)["days"][0]
+
+        expected = {}
+        ended = 0
+        with redirect_stdout(StringIO()):
+            for patient in Patient.objects.filter(lead_management_active=True):
+                record = patient_record(patient, as_of)
+                process_patient(record, COHORTS)
+                if record.get("lead_management_active") is False:
+                    ended += 1
+                    continue
+                bucket = f"{record['current_cohort']}.{record['current_actionable_bucket']}"
+                expected[bucket] = expected.get(bucket, 0) + 1
+        self.assertEqual(day["occupancy"], expected)
+        self.assertEqual(day["ended"], ended)
+
+    def test_compares_a_changed_threshold(self):
+        as_of = datetime.date(2024, 11, 1)
+        self.store([{"id": "P1", "current_cohort": "A", "current_actionable_bucket": "A3",
+                     "status": "Quotation Phase Required", "quotation_accepted": False,
+                     "days_since_last_contact": CONFIG["Y"] - 2}], as_of)
+        report = compare_rule_sets(rulesets.BUILTIN_RULES, rulesets.load_version(0, {"Y": CONFIG["Y"] + 2}),
+                                   days=3, as_of=as_of)
+        self.assertEqual([day["occupancy"] for day in report["baseline"]["days"]],
+                         [{"A.A3": 1}, {"A.A3": 1}, {"C.C3": 1}])
+        self.assertEqual(report["baseline"]["flows"], {"A.A3 -> C.C3": 1})
+        self.assertEqual(report["candidate"]["flows"], {})
+        self.assertEqual(report["difference"], {"A.A3": 1, "C.C3": -1})
+
+        with redirect_stdout(StringIO()) as out:
+            call_command("simulate_flows", "--days", "3", "--as-of", "2024-11-01", "--set", "Y=7", stdout=out)
+        self.assertIn("A.A3", out.getvalue())
+
+
+    def test_moves_to_an_unknown_previous_bucket_are_counted_apart(self):
+        Patient.objects.create(id="P1", current_cohort="E", current_actionable_bucket="E1", status="Unresponsive",
+                               previous_cohort="Z", previous_bucket="Z9", attributes={"response_received": True})
+        snapshot = load_snapshot(required_columns([rulesets.BUILTIN_RULES]), datetime.date(2024, 11, 1))
+        report = simulate(snapshot, rulesets.BUILTIN_RULES, 1)
+        self.assertEqual(report["flows"], {"E.E1 -> unknown": 1})
+        self.assertEqual(report["unknown_bucket"], 1)
+
+
+class ActionOutboxTests(TestCase):
+    def setUp(self):
+        for patient_id in ["P1", "P2"]:
+            Patient.objects.create(id=patient_id, current_cohort="A", current_actionable_bucket="A1", status="IP Recommended")
+
+    def test_views_enqueue_actions_instead_of_running_them(self):
+        patient = {"id": "P3", "current_cohort": "A", "current_actionable_bucket": "A1", "status": "IP Recommended"}
+        with redirect_stdout(StringIO()) as out:
+            self.client.post("/api/process-patient/", json.dumps(patient), content_type="application/json")
+        self.assertNotIn("Action:", out.getvalue())
+        jobs = list(ActionJob.objects.filter(patient_id="P3").order_by("id"))
+        self.assertEqual([job.action for job in jobs], ["inform_recommendation", "assess_additional_requirements"])
+        self.assertEqual(jobs[0].payload["status"], "IP Recommended")
+
+    def test_claims_one_job_per_patient_in_order(self):
+        first = ActionJob.objects.create(patient_id="P1", action="provide_quotation")
+        ActionJob.objects.create(patient_id="P1", action="discuss_financial_options")
+        other = ActionJob.objects.create(patient_id="P2", action="provide_quotation")
+        self.assertEqual({job.id for job in claim_jobs(10)}, {first.id, other.id})
+        self.assertEqual(claim_jobs(10), [])
+
+    def test_failed_job_is_retried_with_backoff_then_failed(self):
+        job = ActionJob.objects.create(patient_id="P1", action="provide_quotation")
+        with mock.patch.dict(ACTION_MAPPING, {"provide_quotation": mock.Mock(side_effect=RuntimeError("sms down"))}):
+            self.assertFalse(run_job(job, max_attempts=2))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (ActionJob.PENDING, 1))
+            self.assertGreater(job.available_at, job.created_at)
+            self.assertEqual(claim_jobs(10), [])
+            self.assertFalse(run_job(job, max_attempts=2))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (ActionJob.FAILED, 2))
+        self.assertIn("sms down", job.last_error)
+
+
+class ActionWorkerTests(TransactionTestCase):
+    def test_worker_drains_queue_keeping_per_patient_order(self):
+        calls = []
+        for patient_id in ["P1", "P2"]:
+            Patient.objects.create(id=patient_id, current_cohort="A", current_actionable_bucket="A1", status="IP Recommended")
+            for action in ["provide_quotation", "discuss_financial_options", "provide_quotation"]:
+                ActionJob.objects.create(patient_id=patient_id, action=action)
+        recorder = {name: (lambda patient, name=name: calls.append((patient["id"], name)))
+                    for name in ["provide_quotation", "discuss_financial_options"]}
+        with mock.patch.dict(ACTION_MAPPING, recorder):
+            stats = ActionWorker(concurrency=3, poll_interval=0.01).run(once=True)
+        self.assertEqual(stats, {"succeeded": 6, "failed": 0})
+        self.assertFalse(ActionJob.objects.exclude(status=ActionJob.DONE).exists())
+        for patient_id in ["P1", "P2"]:
+            self.assertEqual([name for pid, name in calls if pid == patient_id],
+                             ["provide_quotation", "discuss_financial_options", "provide_quotation"])
+
+
+    def test_jobs_running_at_stop_are_counted(self):
+        Patient.objects.create(id="P1", current_cohort="A", current_actionable_bucket="A1", status="IP Recommended")
+        ActionJob.objects.create(patient_id="P1", action="provide_quotation")
+        worker = ActionWorker(concurrency=1, poll_interval=0.01)
+        started = threading.Event()
+
+        def slow_action(patient):
+            started.set()
+            worker.stop()
+            time.sleep(0.05)
+
+        with mock.patch.dict(ACTION_MAPPING, {"provide_quotation": slow_action}):
+            stats = worker.run()
+        self.assertTrue(started.is_set())
+        self.assertEqual(stats, {"succeeded": 1, "failed": 0})
+
+    def test_pool_threads_keep_their_connections_between_jobs(self):
+        Patient.objects.create(id="P1", current_cohort="A", current_actionable_bucket="A1", status="IP Recommended")
+        for _ in range(2):
+            ActionJob.objects.create(patient_id="P1", action="provide_quotation")
+        with mock.patch.object(type(connections["default"]), "close", autospec=True) as close:
+            ActionWorker(concurrency=1, poll_interval=0.01).run(once=True)
+        close.assert_not_called()
+
+class DatabaseSettingsTests(TestCase):
+    def test_connections_are_tuned_and_reused(self):
+        with connection.cursor() as cursor:
+            pragmas = {}
+            for name in ("journal_mode", "synchronous", "busy_timeout", "cache_size"):
+                cursor.execute(f"PRAGMA {name}")
+                pragmas[name] = cursor.fetchone()[0]
+        self.assertEqual(pragmas, {"journal_mode": "wal", "synchronous": 1, "busy_timeout": 5000,
+                                   "cache_size": -64000})
+        self.assertGreater(connection.settings_dict["CONN_MAX_AGE"], 0)
+
+
+class EventLogTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "events.jsonl")
+        events.configure(path=self.path, flush_interval=0.01)
+        self.addCleanup(events.configure)
+
+    def test_actions_and_committed_transitions_are_logged(self):
+        patient = {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1",
+                   "status": "IP Recommended", "clinical_intervention_required": True}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/api/process-patient/", json.dumps(patient), content_type="application/json")
+        run(dict(patient, id="P002"))
+        # One job per patient is claimed at a time
+        while jobs := claim_jobs(10):
+            for job in jobs:
+                run_job(job)
+        self.assertTrue(events.flush(timeout=5))
+
+        logged = list(events.read_events(self.path, patient_id="P001"))
+        transition, = [event for event in logged if event["event"] == events.TRANSITION]
+        self.assertEqual((transition["rule"], transition["to_bucket"]), ("if_clinical_intervention_needed", "A2"))
+        worker_actions = {event["action"] for event in logged if event["event"] == events.ACTION}
+        self.assertEqual(worker_actions, set(COHORTS["A"]["actionable_buckets"]["A1"]["actions"]))
+        inline = list(events.read_events(self.path, patient_id="P002", event=events.ACTION))
+        self.assertEqual({(event["bucket"], event["outcome"]) for event in inline}, {("A1", "succeeded")})
+
+        out = StringIO()
+        call_command("events", "--file", self.path, "--patient", "P001", "--summary", stdout=out)
+        self.assertIn("1  transition move_to_actionable_bucket", out.getvalue())
+
+    def test_without_a_file_events_go_to_the_logger(self):
+        events.configure(path=None, flush_interval=0.01)
+        run({"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1",
+             "status": "IP Recommended", "clinical_intervention_required": True})
+        self.assertFalse(events.enabled())
+        self.assertTrue(events.flush(timeout=5))
+        with self.assertLogs("api.events", logging.INFO) as logs:
+            self.assertTrue(events.enabled())
+            run({"id": "P002", "current_cohort": "A", "current_actionable_bucket": "A1",
+                 "status": "IP Recommended", "clinical_intervention_required": True})
+            self.assertTrue(events.flush(timeout=5))
+        logged = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual({(event["patient_id"], event["bucket"]) for event in logged}, {("P002", "A1")})
+
+    def test_sampling_keeps_whole_patients(self):
+        log = events.EventLog(self.path, sampling={"*": 0.5, events.TRANSITION: 0})
+        kept = [patient_id for patient_id in map("P{}".format, range(2000)) if log.sampled(events.ACTION, patient_id)]
+        self.assertTrue(800 < len(kept) < 1200)
+        self.assertEqual(kept, [patient_id for patient_id in map("P{}".format, range(2000))
+                                if log.sampled(events.ACTION, patient_id)])
+        self.assertFalse(log.sampled(events.TRANSITION, kept[0]))
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        metrics.reset()
+        log = events.EventLog(self.path, queue_size=2)
+        with mock.patch.object(log, "_start"):
+            for _ in range(5):
+                log.emit(events.ACTION, "P1", {"action": "provide_quotation"})
+        self.assertEqual(metrics.collect().counters[(metrics.EVENTS, (events.ACTION, "dropped"))], 3)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_endpoint_exposes_rule_counters_and_stage_histograms(self):
+        fires = {"id": "P001", "current_cohort": "A", "current_actionable_bucket": "A1",
+                 "status": "IP Recommended", "clinical_intervention_required": True}
+        mismatch = {"id": "P002", "current_cohort": "A", "current_actionable_bucket": "A2", "status": "Lost"}
+        with redirect_stdout(StringIO()):
+            for patient in (fires, mismatch):
+                self.client.post("/api/process-patient/", json.dumps(patient), content_type="application/json")
+        response = self.client.get("/api/metrics/")
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        lines = response.content.decode().splitlines()
+        self.assertIn('curiecare_rule_fired_total{cohort="A",bucket="A1",rule="if_clinical_intervention_needed"} 1',
+                      lines)
+        self.assertIn('curiecare_criteria_mismatch_total{cohort="A",bucket="A2"} 1', lines)
+        self.assertIn('curiecare_stage_duration_seconds_count{stage="validation"} 2', lines)
+        self.assertIn('curiecare_stage_duration_seconds_count{stage="db_save"} 2', lines)
+        self.assertIn('curiecare_stage_duration_seconds_bucket{stage="rule_evaluation",le="+Inf"} 2', lines)
+
+    def test_thread_shards_are_summed_and_kept_after_the_thread_ends(self):
+        def work():
+            for _ in range(1000):
+                metrics.inc(metrics.ACTIONS, ("provide_quotation", "succeeded"))
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.inc(metrics.ACTIONS, ("provide_quotation", "succeeded"))
+        total = metrics.collect()
+        self.assertEqual(total.counters[(metrics.ACTIONS, ("provide_quotation", "succeeded"))], 4001)
+        self.assertEqual(metrics.collect().counters[(metrics.ACTIONS, ("provide_quotation", "succeeded"))], 4001)
+
+
+class SyntheticPatientTests(SimpleTestCase):
+    def test_seeded_stream_covers_every_bucket_and_passes_validation(self):
+        patients = list(itertools.islice(generate_patients(seed=7), 2000))
+        self.assertEqual(patients, list(itertools.islice(generate_patients(seed=7), 2000)))
+        buckets = {(bucket.cohort, bucket.bucket) for bucket in iter_buckets(get_compiled(COHORTS))}
+        self.assertEqual({(p["current_cohort"], p["current_actionable_bucket"]) for p in patients}, buckets)
+        for patient in patients:
+            patient_validator.validate(patient)
+
+        results = [run(dict(patient)) for patient in patients]
+        mismatches = sum(any("does not meet the criteria" in message for message in result["messages"])
+                         for result in results)
+        self.assertLess(mismatches, len(patients) * 0.1)
+        fired = {(t["from_bucket"], t["rule_name"]) for t in (r.get("transition") for r in results) if t}
+        self.assertIn(("E1", "on_patient_reengaged"), fired)
+        self.assertIn(("B1", "when_admission_date_approaches"), fired)
 
-# Create your tests here.
@@ -1,6 +1,18 @@
 from django.urls import path
-from .views import process_patient_view  # Ensure you import your view
+from .views import (  # Ensure you import your view
+    bucket_counts_view, changes_stream_view, changes_view, export_patients_view, export_transitions_view,
+    list_patients_view, metrics_view, process_patient_async_view, process_patient_view, process_patients_bulk_view,
+)
 
 urlpatterns = [
     path('process-patient/', process_patient_view, name='process_patient'),
+    path('process-patient-async/', process_patient_async_view, name='process_patient_async'),
+    path('process-patients/', process_patients_bulk_view, name='process_patients_bulk'),
+    path('patients/', list_patients_view, name='list_patients'),
+    path('bucket-counts/', bucket_counts_view, name='bucket_counts'),
+    path('export/patients/', export_patients_view, name='export_patients'),
+    path('export/transitions/', export_transitions_view, name='export_transitions'),
+    path('metrics/', metrics_view, name='metrics'),
+    path('changes/', changes_view, name='changes'),
+    path('changes/stream/', changes_stream_view, name='changes_stream'),
 ]
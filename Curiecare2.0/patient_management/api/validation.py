@@ -0,0 +1,207 @@
+import datetime
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import models
+from django.utils.dateparse import parse_date
+from rest_framework import serializers
+from rest_framework.exceptions import ErrorDetail, ValidationError
+
+from . import metrics
+from .models import Patient
+from .serializers import PatientSerializer
+
+# Request validation without DRF serializers.
+#
+# The checks are generated once from the model fields and follow what
+# PatientUpsertSerializer does for them (same coercions, same error messages and
+# error shape), but a request costs a dict walk instead of building serializer
+# fields, and there is no uniqueness query on the primary key: callers look the
+# patient up themselves and upsert it.
+
+REQUIRED = "This field is required."
+NULL = "This field may not be null."
+BLANK = "This field may not be blank."
+INVALID_STRING = "Not a valid string."
+MAX_LENGTH = "Ensure this field has no more than {max_length} characters."
+NULL_CHARACTERS = "Null characters are not allowed."
+INVALID_BOOLEAN = "Must be a valid boolean."
+INVALID_INTEGER = "A valid integer is required."
+INTEGER_TOO_LONG = "String value too large."
+MAX_VALUE = "Ensure this value is less than or equal to {max_value}."
+MIN_VALUE = "Ensure this value is greater than or equal to {min_value}."
+INVALID_DATE = "Date has wrong format. Use one of these formats instead: YYYY-MM-DD."
+DATETIME_NOT_DATE = "Expected a date but got a datetime."
+INVALID_DATA = "Invalid data. Expected a dictionary, but got {datatype}."
+
+TRUE_VALUES = serializers.BooleanField.TRUE_VALUES
+FALSE_VALUES = serializers.BooleanField.FALSE_VALUES
+# The lookup key BooleanField uses: DRF 3.15 lowercases strings first, earlier
+# versions match the listed spellings exactly
+BOOLEAN_KEY = getattr(serializers.BooleanField, '_lower_if_str', lambda value: value)
+MAX_INTEGER_STRING_LENGTH = serializers.IntegerField.MAX_STRING_LENGTH
+TRAILING_DECIMAL = serializers.IntegerField.re_decimal
+
+Converter = Callable[[Any], Any]
+
+
+class FieldError(Exception):
+    def __init__(self, *details: ErrorDetail):
+        super().__init__(*details)
+        self.details = list(details)
+
+
+def error(message: str, code: str, **params) -> ErrorDetail:
+    return ErrorDetail(message.format(**params) if params else message, code=code)
+
+
+class FieldCheck(NamedTuple):
+    name: str
+    required: bool
+    allow_null: bool
+    convert: Converter
+
+
+def char_converter(max_length: Optional[int], allow_blank: bool) -> Converter:
+    def convert(value):
+        if str(value).strip() == '':
+            if allow_blank:
+                return ''
+            raise FieldError(error(BLANK, 'blank'))
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise FieldError(error(INVALID_STRING, 'invalid'))
+        value = str(value).strip()
+        errors = []
+        if max_length is not None and len(value) > max_length:
+            errors.append(error(MAX_LENGTH, 'max_length', max_length=max_length))
+        if '\x00' in value:
+            errors.append(error(NULL_CHARACTERS, 'null_characters_not_allowed'))
+        if errors:
+            raise FieldError(*errors)
+        return value
+    return convert
+
+
+def boolean_converter() -> Converter:
+    def convert(value):
+        try:
+            key = BOOLEAN_KEY(value)
+            if key in TRUE_VALUES:
+                return True
+            if key in FALSE_VALUES:
+                return False
+        except TypeError:  # unhashable
+            pass
+        raise FieldError(error(INVALID_BOOLEAN, 'invalid'))
+    return convert
+
+
+def integer_converter(min_value: Optional[int], max_value: Optional[int]) -> Converter:
+    def convert(value):
+        if isinstance(value, str) and len(value) > MAX_INTEGER_STRING_LENGTH:
+            raise FieldError(error(INTEGER_TOO_LONG, 'max_string_length'))
+        if isinstance(value, int) and not isinstance(value, bool):
+            number = value
+        else:
+            # "5.0" and 5.0 are accepted as 5
+            try:
+                number = int(TRAILING_DECIMAL.sub('', str(value)))
+            except (ValueError, TypeError):
+                raise FieldError(error(INVALID_INTEGER, 'invalid'))
+        errors = []
+        if max_value is not None and number > max_value:
+            errors.append(error(MAX_VALUE, 'max_value', max_value=max_value))
+        if min_value is not None and number < min_value:
+            errors.append(error(MIN_VALUE, 'min_value', min_value=min_value))
+        if errors:
+            raise FieldError(*errors)
+        return number
+    return convert
+
+
+def date_converter() -> Converter:
+    def convert(value):
+        if isinstance(value, datetime.datetime):
+            raise FieldError(error(DATETIME_NOT_DATE, 'datetime'))
+        if isinstance(value, datetime.date):
+            return value
+        try:
+            parsed = parse_date(value)
+        except (ValueError, TypeError):
+            parsed = None
+        if parsed is None:
+            raise FieldError(error(INVALID_DATE, 'invalid'))
+        return parsed
+    return convert
+
+
+def _limit(field: models.Field, validator_class) -> Optional[int]:
+    for validator in field.validators:
+        if isinstance(validator, validator_class):
+            return validator.limit_value
+    return None
+
+
+# Build the check of one model field, mirroring ModelSerializer's field mapping
+def field_check(field: models.Field) -> FieldCheck:
+    if isinstance(field, models.BooleanField):
+        convert = boolean_converter()
+    elif isinstance(field, models.IntegerField):
+        convert = integer_converter(_limit(field, MinValueValidator), _limit(field, MaxValueValidator))
+    elif isinstance(field, models.DateField) and not isinstance(field, models.DateTimeField):
+        convert = date_converter()
+    elif isinstance(field, models.CharField):
+        convert = char_converter(field.max_length, field.blank)
+    else:
+        raise ValueError(f"No fast validator for {type(field).__name__} '{field.name}'.")
+    required = not (field.has_default() or field.blank or field.null)
+    return FieldCheck(field.name, required, field.null, convert)
+
+
+# Validator for the writable fields of a model
+class ModelValidator:
+    def __init__(self, model, read_only_fields=()):
+        self.checks: List[FieldCheck] = [
+            field_check(field) for field in model._meta.concrete_fields if field.name not in read_only_fields
+        ]
+
+    # Validated values of the fields present in data; raises DRF's ValidationError
+    # with the same detail PatientUpsertSerializer would produce
+    def validate(self, data: Any) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            return self._validate(data)
+        finally:
+            metrics.observe_stage(metrics.VALIDATION, time.perf_counter() - started)
+
+    def _validate(self, data: Any) -> Dict[str, Any]:
+        if not isinstance(data, dict):
+            raise ValidationError({"non_field_errors": [error(INVALID_DATA, 'invalid', datatype=type(data).__name__)]})
+        validated = {}
+        errors = None
+        for name, required, allow_null, convert in self.checks:
+            if name not in data:
+                if required:
+                    errors = errors or {}
+                    errors[name] = [error(REQUIRED, 'required')]
+                continue
+            value = data[name]
+            if value is None:
+                if allow_null:
+                    validated[name] = None
+                else:
+                    errors = errors or {}
+                    errors[name] = [error(NULL, 'null')]
+                continue
+            try:
+                validated[name] = convert(value)
+            except FieldError as exc:
+                errors = errors or {}
+                errors[name] = exc.details
+        if errors:
+            raise ValidationError(errors)
+        return validated
+
+
+patient_validator = ModelValidator(Patient, PatientSerializer.Meta.read_only_fields)
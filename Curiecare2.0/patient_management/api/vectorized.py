@@ -0,0 +1,276 @@
+import datetime
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .patient_data import COHORTS, DEFAULT_REENGAGE_BUCKET, previous_actionable_bucket
+from .rules import (
+    OP_BETWEEN, OP_DATE_FUTURE, OP_DATE_PAST, OP_EQ, OP_EXISTS, OP_GE, OP_LE, OP_TODAY,
+    CompiledBucket, Term, parse_date, get_compiled, iter_buckets,
+)
+
+# Vectorized evaluation of the compiled rule tree over a columnar batch of patients.
+#
+# Every term is evaluated as a NumPy mask over all rows of a bucket at once, and
+# disposition rules are applied in order with a "still unmatched" mask, so the
+# result is identical to calling process_patient row by row (first match wins).
+
+# State codes of integer columns
+MISSING = 0   # key absent, treated as 0 by threshold comparisons
+PRESENT = 1
+INVALID = 2   # None or not convertible to int, never matches
+
+NO_RULE = -1
+UNKNOWN_BUCKET = -1
+
+
+# Integer codes for every (cohort, bucket) pair the rule tree can produce
+class BucketCodes:
+    def __init__(self, compiled: Mapping[str, Mapping[str, CompiledBucket]]):
+        pairs = [(bucket.cohort, bucket.bucket) for bucket in iter_buckets(compiled)]
+        for bucket in iter_buckets(compiled):
+            for rule in bucket.rules:
+                if rule.target_cohort is not None and rule.target_bucket is not None:
+                    pairs.append((rule.target_cohort, rule.target_bucket))
+        pairs.append(DEFAULT_REENGAGE_BUCKET)
+        self.pairs: List[Tuple[str, str]] = list(dict.fromkeys(pairs))
+        self.codes: Dict[Tuple[str, str], int] = {pair: code for code, pair in enumerate(self.pairs)}
+
+    def code(self, cohort: Any, bucket: Any) -> int:
+        return self.codes.get((cohort, bucket), UNKNOWN_BUCKET)
+
+    def encode(self, cohorts: Sequence[Any], buckets: Sequence[Any]) -> np.ndarray:
+        return self.encode_pairs(list(zip(cohorts, buckets)))
+
+    def encode_pairs(self, pairs: Sequence[Tuple[Any, Any]]) -> np.ndarray:
+        codes = self.codes
+        return np.fromiter((codes.get(pair, UNKNOWN_BUCKET) for pair in pairs), dtype=np.int32, count=len(pairs))
+
+    def decode(self, code: int) -> Optional[Tuple[str, str]]:
+        return self.pairs[code] if code >= 0 else None
+
+
+def _to_int(value: Any) -> Tuple[int, int]:
+    try:
+        return int(value), PRESENT
+    except (TypeError, ValueError, OverflowError):
+        return 0, INVALID
+
+
+# Columnar view over many patients. Columns can be set directly from NumPy arrays
+# or are built lazily from the records the batch was created from.
+class PatientBatch:
+    def __init__(self, size: int, records: Optional[Sequence[Mapping[str, Any]]] = None):
+        self.size = size
+        self.records = records
+        self.bucket_codes: Optional[np.ndarray] = None
+        self.previous_codes: Optional[np.ndarray] = None
+        self._categorical: Dict[str, Tuple[np.ndarray, Dict[Any, int]]] = {}
+        self._integer: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._dates: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._truthy: Dict[str, np.ndarray] = {}
+
+    @classmethod
+    def from_records(cls, records: Sequence[Mapping[str, Any]]) -> "PatientBatch":
+        return cls(len(records), records)
+
+    def _require_records(self, key: str):
+        if self.records is None:
+            raise KeyError(f"Column '{key}' was not provided and the batch has no records to build it from.")
+        return self.records
+
+    # Columns supplied by the caller
+    def set_categorical(self, key: str, codes: np.ndarray, vocabulary: Dict[Any, int]):
+        self._categorical[key] = (np.asarray(codes, dtype=np.int32), vocabulary)
+
+    def set_integer(self, key: str, values: np.ndarray, state: Optional[np.ndarray] = None):
+        values = np.asarray(values, dtype=np.int64)
+        if state is None:
+            state = np.full(self.size, PRESENT, dtype=np.int8)
+        self._integer[key] = (values, np.asarray(state, dtype=np.int8))
+
+    def set_dates(self, key: str, ordinals: np.ndarray, valid: Optional[np.ndarray] = None):
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        if valid is None:
+            valid = np.ones(self.size, dtype=bool)
+        self._dates[key] = (ordinals, np.asarray(valid, dtype=bool))
+
+    def set_truthy(self, key: str, mask: np.ndarray):
+        self._truthy[key] = np.asarray(mask, dtype=bool)
+
+    def set_bucket_codes(self, codes: np.ndarray):
+        self.bucket_codes = np.asarray(codes, dtype=np.int32)
+
+    # Codes of the buckets re-engaged patients return to (already resolved to the default)
+    def set_previous_bucket_codes(self, codes: np.ndarray):
+        self.previous_codes = np.asarray(codes, dtype=np.int32)
+
+    # Column accessors
+    def categorical(self, key: str) -> Tuple[np.ndarray, Dict[Any, int]]:
+        column = self._categorical.get(key)
+        if column is None:
+            vocabulary: Dict[Any, int] = {}
+            codes = np.empty(self.size, dtype=np.int32)
+            for row, record in enumerate(self._require_records(key)):
+                value = record.get(key)
+                try:
+                    codes[row] = vocabulary.setdefault(value, len(vocabulary))
+                except TypeError:  # unhashable values never equal a rule operand
+                    codes[row] = -1
+            column = self._categorical[key] = (codes, vocabulary)
+        return column
+
+    def integer(self, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        column = self._integer.get(key)
+        if column is None:
+            values = np.zeros(self.size, dtype=np.int64)
+            state = np.zeros(self.size, dtype=np.int8)
+            for row, record in enumerate(self._require_records(key)):
+                if key in record:
+                    values[row], state[row] = _to_int(record[key])
+            column = self._integer[key] = (values, state)
+        return column
+
+    def dates(self, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        column = self._dates.get(key)
+        if column is None:
+            ordinals = np.zeros(self.size, dtype=np.int64)
+            valid = np.zeros(self.size, dtype=bool)
+            for row, record in enumerate(self._require_records(key)):
+                parsed = parse_date(record.get(key))
+                if parsed is not None:
+                    ordinals[row] = parsed.toordinal()
+                    valid[row] = True
+            column = self._dates[key] = (ordinals, valid)
+        return column
+
+    def truthy(self, key: str) -> np.ndarray:
+        column = self._truthy.get(key)
+        if column is None:
+            records = self._require_records(key)
+            column = self._truthy[key] = np.fromiter(
+                (bool(record.get(key)) for record in records), dtype=bool, count=self.size)
+        return column
+
+    def current_bucket_codes(self, codes: BucketCodes) -> np.ndarray:
+        if self.bucket_codes is None:
+            records = self._require_records("current_actionable_bucket")
+            self.bucket_codes = codes.encode(
+                [record.get("current_cohort") for record in records],
+                [record.get("current_actionable_bucket") for record in records],
+            )
+        return self.bucket_codes
+
+    def previous_bucket_codes(self, codes: BucketCodes) -> np.ndarray:
+        if self.previous_codes is None:
+            records = self._require_records("previous_bucket")
+            self.previous_codes = codes.encode_pairs([previous_actionable_bucket(record) for record in records])
+        return self.previous_codes
+
+
+class BatchResult(NamedTuple):
+    codes: BucketCodes
+    current: np.ndarray                  # int32 bucket code before evaluation
+    target: np.ndarray                   # int32 bucket code after evaluation
+    rule: np.ndarray                     # int16 index into the bucket's rules, NO_RULE if none fired
+    criteria_met: np.ndarray             # bool, False for unknown buckets and criteria mismatches
+    ends_lead_management: np.ndarray     # bool, end_lead_management fired
+
+    def target_pairs(self) -> List[Optional[Tuple[str, str]]]:
+        pairs = self.codes.pairs
+        return [pairs[code] if code >= 0 else None for code in self.target.tolist()]
+
+
+# Evaluate one term for the selected rows
+def term_mask(term: Term, batch: PatientBatch, rows: np.ndarray, today: datetime.date) -> np.ndarray:
+    key, op, operand, source = term
+    if op == OP_EQ:
+        codes, vocabulary = batch.categorical(key)
+        try:
+            code = vocabulary.get(operand)
+        except TypeError:
+            records = batch._require_records(key)
+            return np.fromiter((records[row].get(key) == operand for row in rows.tolist()),
+                               dtype=bool, count=len(rows))
+        if code is None:
+            return np.zeros(len(rows), dtype=bool)
+        return codes[rows] == code
+    if op == OP_GE or op == OP_LE:
+        values, state = batch.integer(key)
+        values = values[rows]
+        compared = values >= operand if op == OP_GE else values <= operand
+        return compared & (state[rows] != INVALID)
+    if op == OP_BETWEEN:
+        lower, upper = operand
+        values, state = batch.integer(source)
+        values = values[rows]
+        return (state[rows] == PRESENT) & (values >= lower) & (values <= upper)
+    if op == OP_DATE_PAST or op == OP_DATE_FUTURE or op == OP_TODAY:
+        ordinals, valid = batch.dates(source)
+        ordinals = ordinals[rows]
+        today_ordinal = today.toordinal()
+        if op == OP_TODAY:
+            compared = ordinals == today_ordinal
+        else:
+            compared = ordinals < today_ordinal if op == OP_DATE_PAST else ordinals > today_ordinal
+        return compared & valid[rows]
+    if op == OP_EXISTS:
+        return batch.truthy(source)[rows] == operand
+    return np.zeros(len(rows), dtype=bool)
+
+
+def _terms_mask(terms, batch, rows, today, cache) -> np.ndarray:
+    mask = np.ones(len(rows), dtype=bool)
+    for term in terms:
+        term_result = cache.get(term)
+        if term_result is None:
+            term_result = cache[term] = term_mask(term, batch, rows, today)
+        mask &= term_result
+    return mask
+
+
+# Evaluate every patient's current bucket criteria and disposition rules at once
+def evaluate_batch(batch: PatientBatch, cohorts: Mapping[str, Any] = COHORTS,
+                   today: Optional[datetime.date] = None,
+                   codes: Optional[BucketCodes] = None) -> BatchResult:
+    compiled = get_compiled(cohorts)
+    if codes is None:
+        codes = BucketCodes(compiled)
+    if today is None:
+        today = datetime.date.today()
+
+    current = batch.current_bucket_codes(codes)
+    target = current.copy()
+    rule_index = np.full(batch.size, NO_RULE, dtype=np.int16)
+    criteria_met = np.zeros(batch.size, dtype=bool)
+    ends = np.zeros(batch.size, dtype=bool)
+
+    for bucket in iter_buckets(compiled):
+        rows = np.flatnonzero(current == codes.code(bucket.cohort, bucket.bucket))
+        if not len(rows):
+            continue
+        cache: Dict[Term, np.ndarray] = {}
+        remaining = _terms_mask(bucket.criteria_terms, batch, rows, today, cache)
+        criteria_met[rows] = remaining
+
+        for index, rule in enumerate(bucket.rules):
+            if not remaining.any():
+                break
+            fired = remaining & _terms_mask(rule.terms, batch, rows, today, cache)
+            if not fired.any():
+                continue
+            remaining &= ~fired
+            fired_rows = rows[fired]
+            rule_index[fired_rows] = index
+            if rule.action == "move_to_actionable_bucket":
+                target[fired_rows] = codes.code(rule.target_cohort, rule.target_bucket)
+            elif rule.action == "move_to_previous_actionable_bucket":
+                target[fired_rows] = batch.previous_bucket_codes(codes)[fired_rows]
+            elif rule.action == "end_lead_management":
+                ends[fired_rows] = True
+
+        # Mirrors process_patient: no rule fired but the bucket ends lead management
+        if remaining.any() and any(rule.name == "lead_management_ends" for rule in bucket.rules):
+            ends[rows[remaining]] = True
+
+    return BatchResult(codes, current, target, rule_index, criteria_met, ends)
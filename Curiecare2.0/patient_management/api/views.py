@@ -1,9 +1,46 @@
+import base64
+import binascii
+import datetime
 import json
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.csrf import csrf_exempt
-from .patient_data import COHORTS, process_patient
-from .models import Patient
-from .serializers import PatientSerializer
+from rest_framework.exceptions import ValidationError
+from . import changefeed, counters, exporter, metrics, patient_cache
+from .importer import FORMATS, NDJSON
+from .patient_data import MAX_TRANSITION_STEPS
+from .rules import EvaluationContext, get_compiled
+from .rulesets import acurrent_rules, current_rules
+from .services import (
+    VersionConflict, aretry_on_conflict, duplicate_ids, evaluate_patient, merge_stored_state, patient_queue_page,
+    posted_record, processed_fields, retry_on_conflict, save_processed_patient, upsert_patients,
+)
+from .validation import patient_validator
+
+# Maximum number of patients accepted by one bulk request
+MAX_BULK_PATIENTS = 10000
+
+# Page sizes of the patient work-queue listing
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Seconds a change-feed long poll waits for a transition (?wait=)
+DEFAULT_FEED_WAIT = 25
+MAX_FEED_WAIT = 60
+
+# ?chain=true evaluates each bucket a patient moves into in the same request, until no
+# rule fires; ?max_steps= lowers the step limit. Raises ValueError on a bad max_steps.
+def chain_options(request):
+    chain = request.GET.get('chain', 'false').lower() in ('true', '1')
+    max_steps = int(request.GET.get('max_steps', MAX_TRANSITION_STEPS))
+    return chain, max(1, min(max_steps, MAX_TRANSITION_STEPS))
+
+# Path and stop reason of a chained evaluation for the response
+def chain_summary(response_data):
+    return {key: response_data[key] for key in ("path", "stopped") if key in response_data}
 
 @csrf_exempt
 def process_patient_view(request):
@@ -14,28 +51,51 @@ def process_patient_view(request):
             if not patient_data:
                 return JsonResponse({"error": "Received empty data"}, status=400)
 
-            # Validate and save the patient data
-            serializer = PatientSerializer(data=patient_data)
-            if serializer.is_valid():
-                patient = serializer.save()
-
-                # Call process_patient and get the response
-                response_data = process_patient(patient_data, COHORTS)
-
-                # Check if response_data contains messages
-                if 'messages' in response_data:
-                    return JsonResponse({
-                        "messages": response_data["messages"],
-                        "patient_id": patient.id,
-                        "current_cohort": response_data.get("current_cohort", patient_data["current_cohort"]),
-                        "current_actionable_bucket": response_data.get("current_actionable_bucket", patient_data["current_actionable_bucket"]),
-                        "lead_management_active": response_data.get("lead_management_active", True)
-                    }, status=200)
-                else:
-                    return JsonResponse({"error": "No messages returned from processing."}, status=400)
-
-            # If the serializer is invalid, return the errors
-            return JsonResponse(serializer.errors, status=400)
+            # Validate the patient data; a patient that is already stored is updated
+            try:
+                validated = patient_validator.validate(patient_data)
+            except ValidationError as exc:
+                return JsonResponse(exc.detail, status=400)
+            try:
+                chain, max_steps = chain_options(request)
+            except ValueError:
+                return JsonResponse({"error": "max_steps must be an integer"}, status=400)
+
+            # Read, evaluate and save; repeated from a fresh read if the patient is written concurrently.
+            # Every attempt evaluates the dates as of the same day.
+            context = EvaluationContext()
+
+            def attempt():
+                posted = posted_record(patient_data, validated)
+                fields = dict(validated)
+                existing = patient_cache.get_patient(fields["id"])
+                merge_stored_state(posted, existing)
+
+                # Evaluate the active rule set and get the response; actions are enqueued, not run inline
+                rules = current_rules()
+                response_data = evaluate_patient(posted, rules, chain, max_steps, context)
+
+                # Save the patient in the state processing left it in, with its transition and action jobs
+                fields.update(processed_fields(posted, fields, context.as_of, rules))
+                return save_processed_patient(existing, fields, [response_data]), response_data
+
+            try:
+                patient, response_data = retry_on_conflict(attempt)
+            except VersionConflict as exc:
+                return JsonResponse({"error": str(exc)}, status=409)
+
+            # Check if response_data contains messages
+            if 'messages' in response_data:
+                return JsonResponse({
+                    "messages": response_data["messages"],
+                    "patient_id": patient.id,
+                    "current_cohort": patient.current_cohort,
+                    "current_actionable_bucket": patient.current_actionable_bucket,
+                    "lead_management_active": patient.lead_management_active,
+                    **chain_summary(response_data),
+                }, status=200)
+            else:
+                return JsonResponse({"error": "No messages returned from processing."}, status=400)
 
         except json.JSONDecodeError:
             return JsonResponse({"error": "Invalid JSON format"}, status=400)
@@ -45,3 +105,348 @@ def process_patient_view(request):
     
     # Handle non-POST requests
     return JsonResponse({"error": "Only POST requests are allowed"}, status=405)
+
+
+# Async (ASGI) variant of process_patient_view with upsert semantics.
+# Validation needs no database access, the stored row is read with afirst (or taken
+# from the patient cache), and the patient, its transitions and action jobs are
+# written in one atomic step. Django cannot run transaction.atomic() from async
+# code, so that step is the only sync_to_async hop of the request.
+@csrf_exempt
+async def process_patient_async_view(request):
+    if request.method != 'POST':
+        return JsonResponse({"error": "Only POST requests are allowed"}, status=405)
+
+    try:
+        patient_data = json.loads(request.body)
+        if not patient_data:
+            return JsonResponse({"error": "Received empty data"}, status=400)
+
+        try:
+            validated = patient_validator.validate(patient_data)
+        except ValidationError as exc:
+            return JsonResponse(exc.detail, status=400)
+
+        try:
+            chain, max_steps = chain_options(request)
+        except ValueError:
+            return JsonResponse({"error": "max_steps must be an integer"}, status=400)
+
+        context = EvaluationContext()
+
+        async def attempt():
+            posted = posted_record(patient_data, validated)
+            fields = dict(validated)
+            existing = await patient_cache.aget_patient(fields["id"])
+            merge_stored_state(posted, existing)
+
+            rules = await acurrent_rules()
+            response_data = evaluate_patient(posted, rules, chain, max_steps, context)
+            fields.update(processed_fields(posted, fields, context.as_of, rules))
+            return await sync_to_async(save_processed_patient)(existing, fields, [response_data]), response_data
+
+        try:
+            patient, response_data = await aretry_on_conflict(attempt)
+        except VersionConflict as exc:
+            return JsonResponse({"error": str(exc)}, status=409)
+
+        return JsonResponse({
+            "messages": response_data["messages"],
+            "patient_id": patient.id,
+            "current_cohort": patient.current_cohort,
+            "current_actionable_bucket": patient.current_actionable_bucket,
+            "lead_management_active": patient.lead_management_active,
+            **chain_summary(response_data),
+        }, status=200)
+
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON format"}, status=400)
+
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+# Parse a bulk body: a JSON array, or NDJSON (one JSON object per line)
+def parse_bulk_body(request):
+    body = request.body.decode('utf-8')
+    content_type = request.content_type or ''
+    if 'ndjson' not in content_type and body.lstrip().startswith('['):
+        records = json.loads(body)
+        if not isinstance(records, list):
+            raise json.JSONDecodeError("Expected a JSON array", body, 0)
+        return records
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+@csrf_exempt
+def process_patients_bulk_view(request):
+    if request.method != 'POST':
+        return JsonResponse({"error": "Only POST requests are allowed"}, status=405)
+
+    try:
+        records = parse_bulk_body(request)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JsonResponse({"error": "Invalid JSON format"}, status=400)
+
+    if not records:
+        return JsonResponse({"error": "Received empty data"}, status=400)
+    if len(records) > MAX_BULK_PATIENTS:
+        return JsonResponse({"error": f"At most {MAX_BULK_PATIENTS} patients are allowed per request"}, status=400)
+    try:
+        chain, max_steps = chain_options(request)
+    except ValueError:
+        return JsonResponse({"error": "max_steps must be an integer"}, status=400)
+
+    try:
+        # Validate everything first; the whole request is evaluated as of one day
+        context = EvaluationContext()
+        results = []
+        valid = []
+        for patient_data in records:
+            try:
+                validated = patient_validator.validate(patient_data)
+            except ValidationError as exc:
+                results.append({
+                    "patient_id": patient_data.get("id") if isinstance(patient_data, dict) else None,
+                    "status": 400,
+                    "errors": exc.detail,
+                })
+                continue
+            results.append(None)
+            valid.append((len(results) - 1, patient_data, validated))
+
+        # Each row records its own transitions and action jobs, so a patient given
+        # twice would end up with a history that does not match the stored row
+        duplicates = duplicate_ids(validated["id"] for _, _, validated in valid)
+        if duplicates:
+            return JsonResponse({"error": f"Patient ids must be unique within a request: {', '.join(duplicates)}"},
+                                status=400)
+
+        # One query for the stored rows, their previous buckets feed re-engagement.
+        # The whole request is evaluated with one rule set version, and evaluated
+        # again from a fresh read if any of its patients is written concurrently.
+        def attempt():
+            rules = current_rules()
+            existing = patient_cache.get_patients([validated["id"] for _, _, validated in valid])
+            rows = []
+            processed = []
+            for index, patient_data, validated in valid:
+                posted = posted_record(patient_data, validated)
+                fields = dict(validated)
+                merge_stored_state(posted, existing.get(fields["id"]))
+                response_data = evaluate_patient(posted, rules, chain, max_steps, context)
+                fields.update(processed_fields(posted, fields, context.as_of, rules))
+                rows.append(fields)
+                processed.append(response_data)
+                results[index] = {
+                    "patient_id": fields["id"],
+                    "status": 200,
+                    "messages": response_data.get("messages", []),
+                    "current_cohort": fields["current_cohort"],
+                    "current_actionable_bucket": fields["current_actionable_bucket"],
+                    "lead_management_active": fields["lead_management_active"],
+                    **chain_summary(response_data),
+                }
+
+            # Upsert all valid rows, their transitions and action jobs in one transaction
+            return upsert_patients(rows, processed, existing)
+
+        created, updated = retry_on_conflict(attempt)
+
+    except VersionConflict as exc:
+        return JsonResponse({"error": str(exc)}, status=409)
+
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+    return JsonResponse({
+        "results": results,
+        "created": len(created),
+        "updated": len(updated),
+        "errors": sum(1 for result in results if result["status"] != 200),
+    }, status=200)
+
+
+def encode_cursor(row):
+    contact_date = row["last_contact_date"]
+    raw = json.dumps([contact_date.isoformat() if contact_date else None, row["id"]]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    contact_date, patient_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return (datetime.date.fromisoformat(contact_date) if contact_date is not None else None), str(patient_id)
+
+# Work queue of patients, filtered by cohort/bucket/active flag and sorted by staleness
+# (least recently contacted first).
+# Keyset-paginated: pass the returned next_cursor as ?cursor= to get the next page.
+def list_patients_view(request):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Only GET requests are allowed"}, status=405)
+
+    filters = {}
+    cohort = request.GET.get('cohort')
+    bucket = request.GET.get('bucket')
+    if bucket and not cohort:
+        # Bucket keys are unique across cohorts; adding the cohort lets the queue index be used
+        cohort = next((key for key, buckets in get_compiled(current_rules().cohorts).items() if bucket in buckets), None)
+    if cohort:
+        filters['current_cohort'] = cohort
+    if bucket:
+        filters['current_actionable_bucket'] = bucket
+
+    # __in keeps the flag an equality SQLite can match against the queue index
+    # (an exact filter on a boolean is rendered as a bare column)
+    active = request.GET.get('active', 'true').lower()
+    if active in ('true', '1'):
+        filters['lead_management_active__in'] = [True]
+    elif active in ('false', '0'):
+        filters['lead_management_active__in'] = [False]
+    elif active != 'any':
+        return JsonResponse({"error": "active must be true, false or any"}, status=400)
+
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({"error": "limit must be an integer"}, status=400)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    after = None
+    cursor = request.GET.get('cursor')
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except (ValueError, TypeError, binascii.Error, UnicodeEncodeError):
+            return JsonResponse({"error": "Invalid cursor"}, status=400)
+
+    rows = patient_queue_page(filters, after, limit)
+    return JsonResponse({
+        "results": rows,
+        "next_cursor": encode_cursor(rows[-1]) if len(rows) == limit else None,
+    }, status=200)
+
+
+# Patients per bucket from the materialized counters, one row read per bucket.
+# ?active=true|false|any as in the patient listing (default true).
+def bucket_counts_view(request):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Only GET requests are allowed"}, status=405)
+    active = request.GET.get('active', 'true').lower()
+    if active in ('true', '1'):
+        rows = counters.occupancy(True)
+    elif active in ('false', '0'):
+        rows = counters.occupancy(False)
+    elif active == 'any':
+        rows = counters.occupancy()
+    else:
+        return JsonResponse({"error": "active must be true, false or any"}, status=400)
+    return JsonResponse({
+        "results": rows,
+        "total": sum(row["count"] for row in rows),
+    }, status=200)
+
+
+# Rule, bucket and latency metrics of this process in the Prometheus text format
+def metrics_view(request):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Only GET requests are allowed"}, status=405)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# Error response for a user who may not read bulk patient data (the export and the
+# change feed), None for a staff user. Async views pass `await request.auser()`.
+def staff_only(user):
+    if not user.is_authenticated:
+        return JsonResponse({"error": "Authentication required"}, status=401)
+    if not user.is_staff:
+        return JsonResponse({"error": "Staff access required"}, status=403)
+    return None
+
+
+# Streamed NDJSON/CSV response of an exporter.export_* function. Staff only. ?format=ndjson|csv,
+# ?since=ISO datetime limits the export to rows written since then, ?cursor= takes the
+# X-Export-Cursor header of a previous export and returns only rows written after it.
+def export_response(request, export):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Only GET requests are allowed"}, status=405)
+    if (denied := staff_only(request.user)) is not None:
+        return denied
+    file_format = request.GET.get('format', NDJSON).lower()
+    if file_format not in FORMATS:
+        return JsonResponse({"error": f"format must be one of {', '.join(FORMATS)}"}, status=400)
+    since = request.GET.get('since')
+    if since:
+        since = parse_datetime(since.replace(' ', '+'))
+        if since is None:
+            return JsonResponse({"error": "since must be an ISO 8601 datetime"}, status=400)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+    try:
+        result = export(since or None, request.GET.get('cursor') or None)
+    except ValueError:
+        return JsonResponse({"error": "Invalid cursor"}, status=400)
+    response = StreamingHttpResponse(exporter.export_lines(result, file_format),
+                                     content_type=exporter.CONTENT_TYPES[file_format])
+    if result.cursor:
+        response['X-Export-Cursor'] = result.cursor
+    return response
+
+
+def export_patients_view(request):
+    return export_response(request, exporter.export_patients)
+
+
+def export_transitions_view(request):
+    return export_response(request, exporter.export_transitions)
+
+
+# Sequence number a change-feed consumer has read up to; raises ValueError
+def feed_cursor(value) -> int:
+    after = int(value or 0)
+    if after < 0:
+        raise ValueError("negative cursor")
+    return after
+
+
+# Bucket transitions after ?cursor= (a sequence number, 0 or none: from the start),
+# oldest first, at most ?limit=. When there are none yet the request waits up to
+# ?wait= seconds for one. Pass next_cursor as ?cursor= of the next poll. Staff only.
+async def changes_view(request):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Only GET requests are allowed"}, status=405)
+    if (denied := staff_only(await request.auser())) is not None:
+        return denied
+    try:
+        after = feed_cursor(request.GET.get('cursor'))
+        limit = int(request.GET.get('limit', changefeed.PAGE_SIZE))
+        wait = float(request.GET.get('wait', DEFAULT_FEED_WAIT))
+    except ValueError:
+        return JsonResponse({"error": "cursor and limit must be non-negative integers, wait a number"}, status=400)
+    limit = max(1, min(limit, changefeed.PAGE_SIZE))
+    wait = max(0.0, min(wait, MAX_FEED_WAIT))
+
+    rows = await changefeed.await_changes(after, limit, wait)
+    return JsonResponse({
+        "results": rows,
+        "next_cursor": rows[-1]["sequence"] if rows else after,
+    }, status=200)
+
+
+# Server-Sent Events stream of bucket transitions after the Last-Event-ID header
+# (sent by a reconnecting EventSource) or ?cursor=. The stream ends after
+# CHANGE_FEED_STREAM_SECONDS and the client reconnects where it left off. Staff only.
+async def changes_stream_view(request):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Only GET requests are allowed"}, status=405)
+    if (denied := staff_only(await request.auser())) is not None:
+        return denied
+    try:
+        after = feed_cursor(request.headers.get('Last-Event-ID') or request.GET.get('cursor'))
+    except ValueError:
+        return JsonResponse({"error": "cursor must be a non-negative integer"}, status=400)
+    if isinstance(request, ASGIRequest):
+        events = changefeed.astream_changes(after, changefeed.stream_seconds())
+    else:
+        events = changefeed.stream_changes(after, changefeed.stream_seconds())
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    # Keeps nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
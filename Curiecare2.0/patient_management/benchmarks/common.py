@@ -0,0 +1,62 @@
+"""
+Shared setup of the benchmark scripts: Django on a scratch database and
+machine-readable output.
+"""
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "patient_management.settings")
+
+
+# Configure Django against a scratch database (in memory unless a path is given)
+# and create the schema. The project's db.sqlite3 is never touched.
+def setup_django(database=":memory:"):
+    import django
+    from django.conf import settings
+
+    if database != ":memory:":
+        # A leftover WAL would be replayed into the new database
+        for path in (database, database + "-wal", database + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+    settings.DATABASES["default"]["NAME"] = database
+    django.setup()
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+    call_command("migrate", verbosity=0)
+    # Allows the test client's host and keeps DEBUG query logging off
+    setup_test_environment()
+
+
+def environment():
+    import django
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIR,
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+    }
+
+
+def write_json(data, path=None):
+    if path:
+        with open(path, "w") as output:
+            json.dump(data, output, indent=2)
+            output.write("\n")
+    else:
+        json.dump(data, sys.stdout, indent=2)
+        sys.stdout.write("\n")
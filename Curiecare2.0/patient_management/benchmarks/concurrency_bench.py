@@ -0,0 +1,160 @@
+"""
+Write throughput of POST api/process-patient/ under concurrent clients, with the
+tuned SQLite configuration (patient_management/database.py) against the old
+untuned one (rollback journal, no pragmas, a new connection per request):
+
+    python benchmarks/concurrency_bench.py --clients 1 4 8 --duration 10
+
+Every configuration runs in its own process on a fresh database file. Each client
+is a forked process, like a worker of a multi-process server, posting new patients
+through the Django test client for --duration seconds. Results are JSON: requests per second,
+latency percentiles and the number of failed requests ("database is locked")
+per configuration and client count.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import environment, setup_django, write_json
+
+CONFIGURATIONS = ("untuned", "tuned")
+
+
+def configure(name, database):
+    from django.conf import settings
+    from patient_management.database import sqlite_database
+
+    if name == "untuned":
+        # As before the tuning layer: the backend's default 5 s busy handler only
+        settings.DATABASES["default"] = sqlite_database(database, pragmas={"journal_mode": "DELETE"},
+                                                        conn_max_age=0)
+        settings.DATABASES["default"]["CONN_HEALTH_CHECKS"] = False
+    else:
+        settings.DATABASES["default"] = sqlite_database(database)
+    setup_django(database)
+
+
+def post_patients(prefix, deadline, results):
+    from django.db import connections
+    from django.test import Client
+
+    # Forked from the process that created the schema; never share its connection
+    connections.close_all()
+    client = Client()
+    latencies = []
+    errors = 0
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for number in itertools.count():
+            if time.perf_counter() >= deadline:
+                break
+            body = json.dumps({
+                "id": f"{prefix}{number:06d}",  # ids are at most 10 characters
+                "current_cohort": "A",
+                "current_actionable_bucket": "A1",
+                "status": "IP Recommended",
+                "clinical_intervention_required": True,
+                "days_since_last_contact": 1,
+            })
+            started = time.perf_counter()
+            response = client.post("/api/process-patient/", body, content_type="application/json")
+            latencies.append(time.perf_counter() - started)
+            errors += response.status_code != 200
+    connections.close_all()
+    results.put((latencies, errors))
+
+
+def run_clients(clients, duration):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    deadline = time.perf_counter() + duration
+    workers = [context.Process(target=post_patients, args=(f"C{clients % 10}{index:02d}", deadline, results))
+               for index in range(clients)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    latencies = []
+    errors = 0
+    for _ in workers:
+        worker_latencies, worker_errors = results.get()
+        latencies.extend(worker_latencies)
+        errors += worker_errors
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(fraction):
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 2)
+
+    return {
+        "clients": clients,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round((len(latencies) - errors) / elapsed, 1),
+        "p50_ms": percentile(0.5) if latencies else None,
+        "p99_ms": percentile(0.99) if latencies else None,
+    }
+
+
+# Child process: one configuration, every client count
+def run_configuration(name, clients, duration):
+    directory = tempfile.mkdtemp(prefix="curiecare-concurrency-")
+    database = os.path.join(directory, "bench.sqlite3")
+    try:
+        configure(name, database)
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            journal_mode = cursor.fetchone()[0]
+        connection.close()
+        return {"journal_mode": journal_mode, "runs": [run_clients(count, duration) for count in clients]}
+    finally:
+        for name_in_directory in os.listdir(directory):
+            os.remove(os.path.join(directory, name_in_directory))
+        os.rmdir(directory)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", nargs="+", type=int, default=[1, 4, 8],
+                        help="Concurrent client processes per run")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per run")
+    parser.add_argument("--configurations", nargs="+", choices=CONFIGURATIONS, default=list(CONFIGURATIONS))
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--child", choices=CONFIGURATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        json.dump(run_configuration(args.child, args.clients, args.duration), sys.stdout)
+        return 0
+
+    results = {}
+    for name in args.configurations:
+        command = [sys.executable, os.path.abspath(__file__), "--child", name, "--duration", str(args.duration),
+                   "--clients", *map(str, args.clients)]
+        child = subprocess.run(command, capture_output=True, text=True, check=True)
+        results[name] = json.loads(child.stdout)
+    if "untuned" in results and "tuned" in results:
+        results["speedup"] = {
+            str(tuned["clients"]): round(tuned["requests_per_second"] / max(untuned["requests_per_second"], 0.1), 2)
+            for untuned, tuned in zip(results["untuned"]["runs"], results["tuned"]["runs"])
+        }
+
+    write_json({
+        "benchmark": "sqlite_concurrency",
+        "environment": environment(),
+        "parameters": {"clients": args.clients, "duration": args.duration},
+        "results": results,
+    }, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""
+Load test comparing process-patient/ served over WSGI with process-patient-async/
+served over ASGI.
+
+Start both servers with the same database, e.g.:
+
+    python manage.py runserver 8000 --noreload
+    uvicorn patient_management.asgi:application --port 8001
+
+then run:
+
+    python benchmarks/load_test.py --wsgi http://127.0.0.1:8000 --asgi http://127.0.0.1:8001
+
+Each target gets the same number of concurrent keep-alive connections posting
+fresh patients for a fixed duration. Results are printed as JSON.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import statistics
+import sys
+import time
+from urllib.parse import urlsplit
+
+WSGI_PATH = "/api/process-patient/"
+ASGI_PATH = "/api/process-patient-async/"
+
+_ids = itertools.count()
+# Ids are unique across runs too, so every run measures the same work (creating
+# patients) rather than updating the rows an earlier run left behind
+RUN_TAG = "".join(random.choices("ABCDEFGHJKLMNPQRSTUVWXYZ", k=3))
+
+
+def patient_payload(prefix):
+    return {
+        "id": f"{prefix}{RUN_TAG}{next(_ids):06d}",
+        "current_cohort": "A",
+        "current_actionable_bucket": "A1",
+        "status": "IP Recommended",
+        "clinical_intervention_required": True,
+        "days_since_last_contact": 1,
+    }
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by server")
+    status = int(status_line.split()[1])
+    length = 0
+    close = False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "connection" and value.strip().lower() == "close":
+            close = True
+    await reader.readexactly(length)
+    return status, close
+
+
+async def client(url, path, prefix, deadline, latencies, errors):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        if writer is None:
+            reader, writer = await asyncio.open_connection(host, port)
+        body = json.dumps(patient_payload(prefix)).encode()
+        request = (
+            f"POST {path} HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        ).encode() + body
+        started = time.perf_counter()
+        try:
+            writer.write(request)
+            await writer.drain()
+            status, close = await read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            errors.append("connection")
+            writer.close()
+            writer = None
+            continue
+        latencies.append(time.perf_counter() - started)
+        if status != 200:
+            errors.append(status)
+        if close:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return round(sorted_values[index] * 1000, 3)
+
+
+async def run_target(name, url, path, concurrency, duration):
+    latencies, errors = [], []
+    started = time.perf_counter()
+    deadline = started + duration
+    prefix = "W" if name == "wsgi" else "S"
+    await asyncio.gather(*(client(url, path, prefix, deadline, latencies, errors) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "target": name,
+        "url": url + path,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies) * 1000, 3) if latencies else None,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": percentile(latencies, 1.0),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wsgi", help="Base URL of the WSGI server")
+    parser.add_argument("--asgi", help="Base URL of the ASGI server")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per target")
+    args = parser.parse_args(argv)
+    if not args.wsgi and not args.asgi:
+        parser.error("give --wsgi and/or --asgi")
+
+    results = []
+    for name, url, path in (("wsgi", args.wsgi, WSGI_PATH), ("asgi", args.asgi, ASGI_PATH)):
+        if url:
+            results.append(asyncio.run(run_target(name, url.rstrip("/"), path, args.concurrency, args.duration)))
+    json.dump({"benchmark": "load_test", "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Benchmark suite of the rule engine, run on seeded synthetic patients
+(api/synthetic.py) that cover every cohort and bucket:
+
+  engine  process_patient throughput per population size
+  http    end-to-end latency of POST api/process-patient/ through the Django
+          test client (creates, then updates of the same patients)
+  db      write throughput of upsert_patients (patients plus their transitions
+          and action jobs) per population size, inserts then updates
+
+    python benchmarks/run_benchmarks.py --sizes 10000 100000 1000000 --output bench.json
+    python benchmarks/run_benchmarks.py --sections engine --baseline bench.json
+
+Results are JSON. With --baseline, throughput and latency figures are compared
+against an earlier run and the script exits with status 1 if any of them got
+worse by more than --tolerance.
+"""
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from common import environment, setup_django, write_json
+
+SECTIONS = ("engine", "http", "db")
+DEFAULT_SIZES = (10000, 100000, 1000000)
+CHUNK_SIZE = 10000  # patients generated and written per step, same as the bulk endpoint's limit
+
+
+def chunks(iterator, total, size=CHUNK_SIZE):
+    remaining = total
+    while remaining > 0:
+        chunk = list(itertools.islice(iterator, min(size, remaining)))
+        remaining -= len(chunk)
+        yield chunk
+
+
+def latency_summary(latencies, elapsed):
+    ordered = sorted(latencies)
+
+    def percentile(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        "requests": len(ordered),
+        "requests_per_second": round(len(ordered) / elapsed, 1),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def bench_engine(sizes, seed, as_of):
+    from api.patient_data import COHORTS, process_patient
+    from api.rules import EvaluationContext
+    from api.synthetic import generate_patients
+
+    results = []
+    for size in sizes:
+        elapsed = 0.0
+        context = EvaluationContext(as_of)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for chunk in chunks(generate_patients(seed, as_of), size):
+                started = time.perf_counter()
+                for patient in chunk:
+                    process_patient(patient, COHORTS, defer_actions=True, context=context)
+                elapsed += time.perf_counter() - started
+        results.append({
+            "patients": size,
+            "seconds": round(elapsed, 4),
+            "patients_per_second": round(size / elapsed, 1),
+            "us_per_patient": round(elapsed / size * 1e6, 3),
+        })
+    return results
+
+
+def bench_http(requests, seed, as_of):
+    from django.test import Client
+    from api.synthetic import generate_patients
+
+    client = Client()
+    patients = list(itertools.islice(generate_patients(seed, as_of, id_prefix="H"), requests))
+    results = {}
+    for phase in ("create", "update"):
+        latencies = []
+        errors = 0
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            phase_started = time.perf_counter()
+            for patient in patients:
+                body = json.dumps(patient)
+                started = time.perf_counter()
+                response = client.post("/api/process-patient/", body, content_type="application/json")
+                latencies.append(time.perf_counter() - started)
+                errors += response.status_code != 200
+            elapsed = time.perf_counter() - phase_started
+        results[phase] = {**latency_summary(latencies, elapsed), "errors": errors}
+    return results
+
+
+def clear_tables():
+    from django.db import connection
+    from api.models import ActionJob, Patient, PatientTransition
+
+    with connection.cursor() as cursor:
+        for model in (ActionJob, PatientTransition, Patient):
+            cursor.execute(f"DELETE FROM {model._meta.db_table}")
+
+
+def bench_db(sizes, seed, as_of):
+    from django.db import connection
+    from api.models import ActionJob, PatientTransition
+    from api.rulesets import BUILTIN_RULES
+    from api.services import evaluate_patient, processed_fields, upsert_patients
+    from api.synthetic import generate_patients
+    from api.validation import patient_validator
+
+    results = []
+    for size in sizes:
+        clear_tables()
+        entry = {"patients": size}
+        # The second pass regenerates the same ids, so every row is updated
+        for phase in ("insert", "update"):
+            elapsed = 0.0
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                for chunk in chunks(generate_patients(seed, as_of, id_prefix="D"), size):
+                    rows = []
+                    processed = []
+                    for patient in chunk:
+                        validated = patient_validator.validate(patient)
+                        processed.append(evaluate_patient(patient, BUILTIN_RULES))
+                        validated.update(processed_fields(patient, validated, as_of, BUILTIN_RULES))
+                        rows.append(validated)
+                    started = time.perf_counter()
+                    upsert_patients(rows, processed)
+                    elapsed += time.perf_counter() - started
+            entry[phase] = {
+                "seconds": round(elapsed, 4),
+                "patients_per_second": round(size / elapsed, 1),
+            }
+        entry["transitions"] = PatientTransition.objects.count()
+        entry["action_jobs"] = ActionJob.objects.count()
+        results.append(entry)
+        connection.close()
+    clear_tables()
+    return results
+
+
+# Flatten results into {"section.size.metric": value} for the figures compared across runs
+def comparable(results, prefix=""):
+    flat = {}
+    if isinstance(results, list):
+        for entry in results:
+            flat.update(comparable(entry, f"{prefix}{entry['patients']}."))
+    elif isinstance(results, dict):
+        for key, value in results.items():
+            if isinstance(value, (dict, list)):
+                flat.update(comparable(value, f"{prefix}{key}."))
+            elif key.endswith("_per_second") or key in ("p50_ms", "p95_ms", "p99_ms"):
+                flat[prefix + key] = value
+    return flat
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    current = comparable(results)
+    for key, old in comparable(baseline).items():
+        new = current.get(key)
+        if new is None or not old:
+            continue
+        # Throughput should not drop, latency should not grow
+        change = (old - new) / old if key.endswith("_per_second") else (new - old) / old
+        if change > tolerance:
+            found.append({"metric": key, "baseline": old, "current": new, "change": round(change, 3)})
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", nargs="+", choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES),
+                        help="Population sizes of the engine and db sections")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per phase of the http section")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database", help="SQLite file to benchmark against (default: a temporary file)")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args(argv)
+
+    database = args.database or os.path.join(tempfile.mkdtemp(prefix="curiecare-bench-"), "bench.sqlite3")
+    setup_django(database)
+    as_of = datetime.date.today()
+
+    results = {}
+    if "engine" in args.sections:
+        results["process_patient"] = bench_engine(args.sizes, args.seed, as_of)
+    if "http" in args.sections:
+        results["http_process_patient"] = bench_http(args.requests, args.seed, as_of)
+    if "db" in args.sections:
+        results["db_write"] = bench_db(args.sizes, args.seed, as_of)
+
+    report = {
+        "benchmark": "rule_engine",
+        "environment": environment(),
+        "parameters": {"sections": args.sections, "sizes": args.sizes, "requests": args.requests,
+                       "seed": args.seed, "as_of": as_of.isoformat()},
+        "results": results,
+    }
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        report["regressions"] = regressions(results, baseline, args.tolerance)
+        if report["regressions"]:
+            status = 1
+            print(f"{len(report['regressions'])} regression(s) beyond {args.tolerance:.0%}", file=sys.stderr)
+
+    write_json(report, args.output)
+    if not args.database:
+        from django.db import connections
+
+        # WAL mode keeps -wal and -shm files next to the database while it is open
+        connections.close_all()
+        shutil.rmtree(os.path.dirname(database))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
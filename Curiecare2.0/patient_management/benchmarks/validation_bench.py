@@ -0,0 +1,99 @@
+"""
+Benchmark of request validation: DRF's PatientSerializer (with its uniqueness
+query on the primary key), PatientUpsertSerializer and the generated
+patient_validator.
+
+    python benchmarks/validation_bench.py --patients 20000
+
+Runs against a fresh in-memory database, half of the payloads refer to stored
+patients. Results are printed as JSON.
+"""
+import argparse
+import random
+import time
+
+from common import setup_django, write_json
+
+
+def payloads(count, seed):
+    rng = random.Random(seed)
+    statuses = ["IP Recommended", "Quotation Phase Required", "Lost", "Admitted"]
+    for index in range(count):
+        yield {
+            "id": f"B{index:07d}",
+            "current_cohort": rng.choice("ABCDE"),
+            "current_actionable_bucket": rng.choice(["A1", "A2", "B1", "C3", "E1"]),
+            "status": rng.choice(statuses),
+            "clinical_intervention_required": rng.random() < 0.5,
+            "quotation_phase_required": rng.choice([True, False, "true", "false"]),
+            "days_since_last_contact": rng.choice([rng.randint(0, 60), str(rng.randint(0, 60))]),
+            "scheduled_date": "2030-01-01",
+        }
+
+
+def measure(name, validate, records):
+    started = time.perf_counter()
+    valid = sum(1 for record in records if validate(record))
+    elapsed = time.perf_counter() - started
+    return {
+        "validator": name,
+        "patients": len(records),
+        "valid": valid,
+        "seconds": round(elapsed, 4),
+        "per_patient_us": round(elapsed / len(records) * 1e6, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    setup_django()
+    from django.db import connection
+    from rest_framework.exceptions import ValidationError
+    from api.models import Patient
+    from api.serializers import PatientSerializer, PatientUpsertSerializer
+    from api.validation import patient_validator
+
+    records = list(payloads(args.patients, args.seed))
+    # Half of the patients already exist, as for clients re-posting updates
+    Patient.objects.bulk_create([Patient(**patient_validator.validate(record)) for record in records[::2]],
+                                batch_size=500)
+
+    def drf(record):
+        return PatientSerializer(data=record).is_valid()
+
+    def drf_upsert(record):
+        return PatientUpsertSerializer(data=record).is_valid()
+
+    def fast(record):
+        try:
+            patient_validator.validate(record)
+        except ValidationError:
+            return False
+        return True
+
+    results = []
+    for name, validate in (("PatientSerializer", drf), ("PatientUpsertSerializer", drf_upsert),
+                           ("patient_validator", fast)):
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            result = measure(name, validate, records)
+        result["queries"] = len(queries)
+        results.append(result)
+
+    baseline = results[0]["seconds"]
+    for result in results:
+        result["speedup"] = round(baseline / result["seconds"], 2) if result["seconds"] else None
+    write_json({"benchmark": "validation", "results": results})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+from typing import Any, Dict, Optional
+
+# SQLite configuration of settings.DATABASES.
+#
+# The pragmas run on every new connection through the backend's init_command
+# option; connections are kept open between requests (CONN_MAX_AGE), so that cost
+# and the connection setup are paid once per thread rather than once per request.
+
+SQLITE_PRAGMAS = {
+    # Readers and the writer no longer block each other; stored in the database file
+    'journal_mode': 'WAL',
+    # Sync at checkpoints only: in WAL mode a power loss can lose the last commits but
+    # cannot corrupt the database
+    'synchronous': 'NORMAL',
+    # Milliseconds to wait for the write lock before failing with "database is locked"
+    'busy_timeout': 5000,
+    # Page cache per connection, negative values are KiB (64 MB)
+    'cache_size': -64000,
+    # Read the file through a memory map of up to this many bytes
+    'mmap_size': 256 * 1024 * 1024,
+    # Keep the WAL file from growing past 64 MB after checkpoints
+    'journal_size_limit': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# Seconds a connection is reused for
+CONN_MAX_AGE = 600
+
+
+def init_command(pragmas: Dict[str, Any]) -> str:
+    return ";".join(f"PRAGMA {name}={value}" for name, value in pragmas.items())
+
+
+# DATABASES entry of a tuned SQLite database; pragmas=None uses SQLITE_PRAGMAS
+def sqlite_database(name, test_name=None, pragmas: Optional[Dict[str, Any]] = None,
+                    conn_max_age: int = CONN_MAX_AGE) -> Dict[str, Any]:
+    database = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+        'OPTIONS': {
+            # Take the write lock when a transaction starts, so concurrent writers wait
+            # for each other instead of failing a read-then-write upgrade with "locked"
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': init_command(SQLITE_PRAGMAS if pragmas is None else pragmas),
+        },
+        'CONN_MAX_AGE': conn_max_age,
+        # A reused connection is checked before a request uses it
+        'CONN_HEALTH_CHECKS': True,
+    }
+    if test_name is not None:
+        database['TEST'] = {'NAME': test_name}
+    return database
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 
+from .database import sqlite_database
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -75,11 +77,11 @@ WSGI_APPLICATION = 'patient_management.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Tuned SQLite: WAL, connection pragmas and persistent connections (database.py).
+# The outbox worker writes from several threads; an on-disk test database
+# honours the busy timeout, the shared in-memory one does not.
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': sqlite_database(BASE_DIR / 'db.sqlite3', test_name=BASE_DIR / 'test_db.sqlite3'),
 }
 
 
@@ -123,3 +125,47 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Rule sets (api/rulesets.py)
+# Seconds between checks for a newly activated rule set version
+RULES_POLL_INTERVAL = 5
+# Path of a JSON rule document with a "version" key to use instead of the
+# RuleSet table; reloaded when the file changes
+RULES_FILE = None
+
+# Patient cache of the processing path (api/patient_cache.py)
+# Patients kept per process, 0 disables the cache
+PATIENT_CACHE_SIZE = 10000
+# Seconds a cached patient is used for, bounding how long a write by another
+# process goes unnoticed (a stale entry is also dropped when its write-back fails)
+PATIENT_CACHE_TTL = 60
+
+# Structured event log (api/events.py, read with manage.py events)
+# JSON lines file actions and transitions are appended to; None sends them to the
+# api.events logger (LOGGING below), silencing that logger turns the log off
+EVENT_LOG_FILE = None
+# Events buffered for the writer thread; further events are dropped until it catches up
+EVENT_LOG_QUEUE_SIZE = 10000
+# Events per write, and seconds an incomplete batch waits for more
+EVENT_LOG_BATCH_SIZE = 500
+EVENT_LOG_FLUSH_INTERVAL = 1.0
+# Share of patients whose events are logged, per event type ("*": every other type)
+EVENT_LOG_SAMPLING = {"*": 1.0}
+
+# Change feed of bucket transitions (api/changefeed.py)
+# Seconds between checks for new transitions while a consumer waits
+CHANGE_FEED_POLL_INTERVAL = 0.5
+# Seconds an event stream stays open before the client has to reconnect
+CHANGE_FEED_STREAM_SECONDS = 300
+
+# Console output of the event log when EVENT_LOG_FILE is not set
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'stream': 'ext://sys.stdout'},
+    },
+    'loggers': {
+        'api.events': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}